@@ -0,0 +1,212 @@
+"""
+Benchmark concurrent send_async() over HTTP/1.1 and HTTP/2.
+
+Starts a local TLS server that answers like a Slack webhook after a fixed
+delay, negotiating h2 or http/1.1 with ALPN like slack.com,
+api.telegram.org and api.twilio.com do, then sends the same burst of
+concurrent SlackWebhook.send_async() calls through messages._http.HTTP_CLIENTS
+with http2 off and on, reporting latency and the connections the server saw.
+
+Usage:
+    pip install messages[http2]
+    python benchmarks/http2.py [--messages 500] [--delay 0.05] [--rounds 3]
+
+Needs the openssl command to create a throwaway certificate.
+"""
+
+import argparse
+import asyncio
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    raise ImportError("HTTP/2 requires h2: pip install messages[http2]") from None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from messages import SlackWebhook  # noqa: E402
+from messages._http import HTTP_CLIENTS  # noqa: E402
+
+
+class Stats:
+    """Connections the server accepted, and the most open at once."""
+
+    def __init__(self):
+        self.opened = self.open = self.peak = 0
+
+    def connect(self):
+        self.opened += 1
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+
+    def disconnect(self):
+        self.open -= 1
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate for localhost, return (cert, key)."""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost",
+            "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+async def serve_h2(reader, writer, delay):
+    """Answer every stream with 200 ok after delay, multiplexed."""
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+    conn.initiate_connection()
+    writer.write(conn.data_to_send())
+    pending = set()
+
+    async def respond(stream_id):
+        await asyncio.sleep(delay)
+        conn.send_headers(
+            stream_id, [(":status", "200"), ("content-length", "2")]
+        )
+        conn.send_data(stream_id, b"ok", end_stream=True)
+        writer.write(conn.data_to_send())
+
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.StreamEnded):
+                task = asyncio.ensure_future(respond(event.stream_id))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            elif isinstance(event, h2.events.DataReceived):
+                conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                return
+        writer.write(conn.data_to_send())
+
+
+async def serve_http1(reader, writer, delay):
+    """Answer keep-alive requests one at a time with 200 ok after delay."""
+    while True:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":", 1)[1])
+        await reader.readexactly(length)
+        await asyncio.sleep(delay)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+
+async def start_server(cert, key, delay, stats):
+    """Start the webhook stand-in on a free port, return (server, url)."""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    context.set_alpn_protocols(["h2", "http/1.1"])
+
+    async def handle(reader, writer):
+        stats.connect()
+        try:
+            ssl_object = writer.get_extra_info("ssl_object")
+            if ssl_object.selected_alpn_protocol() == "h2":
+                await serve_h2(reader, writer, delay)
+            else:
+                await serve_http1(reader, writer, delay)
+        except ConnectionError:
+            pass
+        finally:
+            stats.disconnect()
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, ssl=context)
+    port = server.sockets[0].getsockname()[1]
+    return server, "https://localhost:{}/services/T0/B0/x".format(port)
+
+
+async def burst(url, count):
+    """Send count messages at once, return each one's latency in seconds."""
+
+    async def send(i):
+        start = time.perf_counter()
+        await SlackWebhook(auth=url, body="message {}".format(i)).send_async()
+        return time.perf_counter() - start
+
+    return await asyncio.gather(*(send(i) for i in range(count)))
+
+
+async def run(http2, args, cert, key):
+    """Benchmark one protocol, return its report line."""
+    stats = Stats()
+    server, url = await start_server(cert, key, args.delay, stats)
+    HTTP_CLIENTS.configure(http2=http2)
+    try:
+        latencies, walls = [], []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            latencies += await burst(url, args.messages)
+            walls.append(time.perf_counter() - start)
+        await HTTP_CLIENTS.aclose()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    latencies.sort()
+    return (
+        "{:<9} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.0f} {:>8} {:>6}".format(
+            "HTTP/2" if http2 else "HTTP/1.1",
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            statistics.mean(walls) * 1000,
+            args.messages / statistics.mean(walls),
+            stats.opened,
+            stats.peak,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--messages", type=int, default=500,
+                        help="concurrent send_async() calls per round")
+    parser.add_argument("--delay", type=float, default=0.05,
+                        help="seconds the server takes to answer")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory)
+        # new clients trust the throwaway certificate
+        os.environ["SSL_CERT_FILE"] = cert
+        print(
+            "{} messages x {} rounds, {:.0f} ms server delay\n".format(
+                args.messages, args.rounds, args.delay * 1000
+            )
+        )
+        print("{:<9} {:>8} {:>8} {:>8} {:>10} {:>8} {:>6}".format(
+            "protocol", "p50 ms", "p95 ms", "wall ms", "msgs/sec", "conns",
+            "peak"))
+        for http2 in (False, True):
+            print(asyncio.run(run(http2, args, cert, key)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ messages - A package designed to make sending various types of messages easy.
 import logging
 
 from .email_ import Email
+from .email_ import EmailTemplate
+from .email_ import SenderPool
 from .slack import SlackWebhook
 from .slack import SlackPost
 from .telegram import TelegramBot
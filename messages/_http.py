@@ -0,0 +1,160 @@
+"""HTTP Module - connection handling shared by the HTTP message classes."""
+
+import asyncio
+import atexit
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+
+
+def base_url(url):
+    """Return the scheme://host[:port] of url, which clients are keyed by."""
+    parts = urlsplit(str(url))
+    return "{}://{}".format(parts.scheme.lower(), parts.netloc.lower())
+
+
+class HTTPClientRegistry:
+    """
+    Process-wide registry of long-lived httpx clients, one per base host
+    (scheme://host[:port]), so every Slack, Telegram and Twilio message sent
+    to the same API reuses a keep-alive connection instead of paying DNS,
+    TCP and TLS setup per request.
+
+    Args:
+        :limits: (httpx.Limits) connection pool limits of each client, i.e.
+            max_connections, max_keepalive_connections, keepalive_expiry
+        :timeout: (httpx.Timeout or float) default timeout of each client
+        :http2: (bool) negotiate HTTP/2 with hosts that support it, so any
+            number of concurrent requests to a host are multiplexed over one
+            connection instead of one HTTP/1.1 connection each; needs the h2
+            package (the http2 extra)
+
+    Usage:
+        self.get(url) returns the httpx.Client for the host of url, and
+        self.get_async(url) the httpx.AsyncClient for it on the running
+        event loop.  Clients of your own (i.e. with proxies, certificates
+        or a mock transport) are used instead with self.inject(client, url),
+        for one host, or every host if url is None; injected clients are
+        never closed by the registry.  Settings can be changed at any time
+        with self.configure(); they apply to clients created afterwards, so
+        call self.close() first to apply them to every host.
+
+    Note:
+        Clients inherited across os.fork() are dropped (never closed) by the
+        child, and async clients belong to the event loop that created them;
+        a registry used from another loop starts over with new ones.
+    """
+
+    def __init__(self, limits=None, timeout=httpx.Timeout(5.0), http2=False):
+        self.limits = limits or httpx.Limits(
+            max_connections=100, max_keepalive_connections=20, keepalive_expiry=30
+        )
+        self.timeout = timeout
+        self.http2 = http2
+        self._injected = {}
+        self._reset()
+
+    def _reset(self):
+        """Start with a fresh state, used on init and after a fork."""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _check_pid(self):
+        """Forget every client inherited from a parent process."""
+        if self._pid != os.getpid():
+            self._reset()
+
+    def configure(self, **settings):
+        """Update the registry settings: limits, timeout, http2."""
+        for name, value in settings.items():
+            if name not in ("limits", "timeout", "http2"):
+                raise TypeError("Unknown HTTP client setting: " + name)
+            if name == "http2" and value:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    raise ImportError(
+                        "HTTP/2 requires h2: pip install messages[http2]"
+                    ) from None
+            setattr(self, name, value)
+
+    def _settings(self):
+        """Return the keyword arguments new clients are created with."""
+        return {"limits": self.limits, "timeout": self.timeout, "http2": self.http2}
+
+    def _find_injected(self, key, kind):
+        """Return the injected client of kind for key (or every host), if any."""
+        for candidate in (key, None):
+            client = self._injected.get((candidate, kind))
+            if client is not None:
+                return client
+        return None
+
+    def inject(self, client, url=None):
+        """
+        Use client, an httpx.Client or httpx.AsyncClient, for the host of url,
+        or for every host without a client of its own if url is None.
+        Pass client=None to remove an injected client again.
+        """
+        key = None if url is None else base_url(url)
+        kind = httpx.Client
+        if isinstance(client, httpx.AsyncClient):
+            kind = httpx.AsyncClient
+        if client is None:
+            self._injected.pop((key, httpx.Client), None)
+            self._injected.pop((key, httpx.AsyncClient), None)
+        else:
+            self._injected[(key, kind)] = client
+
+    def get(self, url):
+        """Return the shared httpx.Client for the host of url."""
+        key = base_url(url)
+        injected = self._find_injected(key, httpx.Client)
+        if injected is not None:
+            return injected
+        self._check_pid()
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None or client.is_closed:
+                client = self._clients[key] = httpx.Client(**self._settings())
+        return client
+
+    def get_async(self, url):
+        """Return the shared httpx.AsyncClient for the host of url on this loop."""
+        key = base_url(url)
+        injected = self._find_injected(key, httpx.AsyncClient)
+        if injected is not None:
+            return injected
+        self._check_pid()
+        loop = asyncio.get_running_loop()
+        for stale in [old for old in self._loops.keys() if old.is_closed()]:
+            self._loops.pop(stale, None)
+        clients = self._loops.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None or client.is_closed:
+            client = clients[key] = httpx.AsyncClient(**self._settings())
+        return client
+
+    def close(self):
+        """Close every sync client the registry created."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """Close every async client the registry created on the running loop."""
+        clients = self._loops.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+
+HTTP_CLIENTS = HTTPClientRegistry()
+atexit.register(HTTP_CLIENTS.close)
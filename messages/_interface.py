@@ -4,10 +4,17 @@ import reprlib
 from abc import ABCMeta
 from abc import abstractmethod
 
+from ._utils import deep_sizeof
+
 
 class Message(metaclass=ABCMeta):
     """Interface for standard message classes."""
 
+    # attributes holding what send() built, with the factory of their empty
+    # value; release() resets them
+    _built_attrs = {"message": dict}
+    lean = False
+
     @abstractmethod
     def send(self):
         """Send message synchronously."""
@@ -19,6 +26,8 @@ class Message(metaclass=ABCMeta):
         for attr in self:
             if attr == "_auth":
                 output += "auth=***obfuscated***,\n"
+            elif attr.startswith("_"):
+                continue
             elif attr == "body":
                 output += "{}={!r},\n".format(attr, reprlib.repr(getattr(self, attr)))
             else:
@@ -28,3 +37,20 @@ class Message(metaclass=ABCMeta):
 
     def __iter__(self):
         return iter(self.__dict__)
+
+    def __sizeof__(self):
+        """
+        sys.getsizeof(self): bytes retained by the message, including its
+        arguments and whatever send() built and kept.
+        """
+        return object.__sizeof__(self) + deep_sizeof(self.__dict__)
+
+    def release(self):
+        """
+        Drop what send() built, keeping the arguments it is built from, so
+        it is built again on the next send.  Messages created with lean=True
+        release it after every send.
+        """
+        for attr, empty in self._built_attrs.items():
+            if attr in self.__dict__:
+                setattr(self, attr, empty())
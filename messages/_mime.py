@@ -0,0 +1,813 @@
+"""MIME Module - message parts and serialization used by the Email class."""
+
+import binascii
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from email.generator import Generator
+from email.mime.base import MIMEBase
+from email.mime.nonmultipart import MIMENonMultipart
+
+
+CRLF = b"\r\n"
+_NEWLINE = re.compile(r"\r\n|\r|\n")
+LINE_BYTES = 57  # raw bytes per 76 character line of base64
+CHUNK_LINES = 1024  # base64 lines encoded per chunk read from disk
+SAMPLE_BYTES = 64 * 1024  # bytes of a file sampled to choose its encoding
+MAX_LINE = 998  # longest line allowed in 7bit and 8bit bodies (RFC 5322)
+COMPRESS_THRESHOLD = 64 * 1024  # smallest attachment compressed by default
+SPOOL_BYTES = 8 * 2 ** 20  # compressed bytes kept in memory before a temp file
+
+
+"""
+Functions below this header encode raw bytes for the wire.
+"""
+
+
+def encode_base64(data):
+    """Base64 encode data as CRLF-terminated 76 character lines."""
+    view = memoryview(data)
+    return b"".join(
+        binascii.b2a_base64(view[i : i + LINE_BYTES], newline=False) + CRLF
+        for i in range(0, len(view), LINE_BYTES)
+    )
+
+
+def iter_base64(fp):
+    """Yield the contents of binary file object fp base64 encoded in chunks."""
+    rest = b""
+    while True:
+        chunk = fp.read(LINE_BYTES * CHUNK_LINES)
+        if not chunk:
+            break
+        if rest:
+            chunk, rest = bytes(rest) + chunk, b""
+        cut = len(chunk) - len(chunk) % LINE_BYTES
+        if cut < len(chunk):
+            chunk, rest = chunk[:cut], chunk[cut:]
+        if chunk:
+            yield encode_base64(chunk)
+    if rest:
+        yield encode_base64(rest)
+
+
+def encode_qp(data):
+    """
+    Quoted-printable encode binary data losslessly (line breaks in data are
+    escaped too) as CRLF-terminated lines, the last one a soft line break.
+    """
+    encoded = binascii.b2a_qp(data, istext=False)
+    return encoded.replace(b"\r\n", b"\n").replace(b"\n", CRLF) + b"=" + CRLF
+
+
+def iter_qp(fp):
+    """Yield the contents of binary file object fp encode_qp()'d in chunks."""
+    while True:
+        chunk = fp.read(LINE_BYTES * CHUNK_LINES)
+        if not chunk:
+            break
+        yield encode_qp(chunk)
+
+
+def iter_text_qp(chunks):
+    """
+    Yield UTF-8 text from chunks (str or bytes) quoted-printable encoded as
+    CRLF-terminated lines.  Line breaks are kept as line breaks, a last line
+    without one (or a line longer than a chunk) ends in a soft line break.
+    """
+    rest = b""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = rest + chunk if rest else chunk
+        cut = data.rfind(b"\n") + 1
+        if cut:
+            data, rest = data[:cut], data[cut:]
+        elif len(data) < LINE_BYTES * CHUNK_LINES:
+            rest = data
+            continue
+        else:
+            rest = b""
+        yield _text_qp(data)
+    if rest:
+        yield _text_qp(rest)
+
+
+def _text_qp(data):
+    encoded = binascii.b2a_qp(data.replace(b"\r\n", b"\n"), istext=True)
+    encoded = encoded.replace(b"\n", CRLF)
+    return encoded if encoded.endswith(CRLF) else encoded + b"=" + CRLF
+
+
+def base64_size(size):
+    """Return the length of encode_base64() output for size raw bytes."""
+    lines = -(-size // LINE_BYTES)
+    return 4 * -(-size // 3) + 2 * lines
+
+
+"""
+Classes below this header are message parts, caches and wire-format
+serializers.
+"""
+
+
+class AttachmentCache:
+    """
+    Cache of base64 encoded attachment bodies, so a file attached to many
+    messages is read and encoded only once.
+
+    Entries are keyed by (path, size, mtime) of the file, so an edited file
+    is encoded again.  Memory use is bounded by max_bytes, evicting the
+    least recently used entries first.
+
+    Args:
+        :max_bytes: (int) memory budget for encoded bodies, 0 to disable
+        :directory: (str) optional directory where encoded bodies are also
+            written, so they survive restarts of the process
+
+    Usage:
+        Used by FileAttachment through the module-level ATTACHMENT_CACHE,
+        which can be tuned with ATTACHMENT_CACHE.configure().
+
+    Note:
+        The directory tier is never pruned automatically, call self.clear()
+        or empty the directory to reclaim the disk space.
+    """
+
+    def __init__(self, max_bytes=32 * 2 ** 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """Update the cache settings: max_bytes, directory."""
+        for name, value in settings.items():
+            if name not in ("max_bytes", "directory"):
+                raise TypeError("Unknown cache setting: " + name)
+            setattr(self, name, value)
+        with self._lock:
+            self._evict()
+
+    def accepts(self, size):
+        """Return True if an encoded body of size bytes may be cached."""
+        return 0 < size <= self.max_bytes
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".b64")
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, encoded = self._entries.popitem(last=False)
+            self._bytes -= len(encoded)
+
+    def _store(self, key, encoded):
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self._bytes += len(encoded)
+                self._evict()
+
+    def get(self, key):
+        """Return the cached encoded body for key, or None."""
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                return encoded
+        if self.directory:
+            try:
+                with open(self._disk_path(key), "rb") as fp:
+                    encoded = fp.read()
+            except OSError:
+                return None
+            self._store(key, encoded)
+        return encoded
+
+    def put(self, key, encoded):
+        """Cache encoded as the body for key."""
+        if not self.accepts(len(encoded)):
+            return
+        self._store(key, encoded)
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(encoded)
+                os.replace(tmp, self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """Empty the cache, including the directory tier."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.directory and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(".b64"):
+                    os.remove(os.path.join(self.directory, name))
+
+
+ATTACHMENT_CACHE = AttachmentCache()
+
+
+class FileAttachment(MIMEBase):
+    """
+    An application/octet-stream attachment that is read from disk and
+    encoded a chunk at a time only while the message is being sent, so the
+    file is never held in memory as a whole.
+
+    Files are base64 encoded, unless a sample of the file shows it is mostly
+    printable ASCII, in which case the smaller quoted-printable encoding is
+    used (escaping line breaks too, so the file arrives unchanged).
+
+    Args:
+        :path: (str) path of the file to attach
+
+    Note:
+        Encoded bodies small enough are kept in ATTACHMENT_CACHE, so sending
+        the same file again does not read or encode it again.  The encoded
+        length of a quoted-printable file is counted while it is streamed
+        and kept, so SIZE and bytes_saved do not encode it again.
+        get_payload() still returns the whole encoded file so the message
+        can be flattened with the standard library generators if needed.
+    """
+
+    def __init__(self, path):
+        super().__init__("application", "octet-stream")
+        self.path = path
+        st = os.stat(path)
+        self.size = st.st_size
+        self.key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        self.encoding = self._choose_encoding()
+        self["Content-Transfer-Encoding"] = self.encoding
+        self._payload = ""
+        self._encoded_size = None
+
+    def _open(self):
+        """Return a binary file object of the contents, to use with 'with'."""
+        return open(self.path, "rb")
+
+    def _choose_encoding(self):
+        """Return the cheaper of base64 and quoted-printable for a sample."""
+        with self._open() as fp:
+            sample = fp.read(SAMPLE_BYTES)
+        if sample and len(encode_qp(sample)) < base64_size(len(sample)):
+            return "quoted-printable"
+        return "base64"
+
+    def encoded_size(self):
+        """Return the length of the encoded file contents."""
+        if self.encoding == "base64":
+            return base64_size(self.size)
+        if self._encoded_size is None:
+            for _ in self.iter_encoded():
+                pass
+        return self._encoded_size
+
+    def iter_encoded(self):
+        """Yield the encoded file contents in CRLF-terminated chunks."""
+        cached = ATTACHMENT_CACHE.get(self.key)
+        if cached is not None:
+            self._encoded_size = len(cached)
+            yield cached
+            return
+
+        chunks = [] if ATTACHMENT_CACHE.accepts(base64_size(self.size)) else None
+        encode = iter_base64 if self.encoding == "base64" else iter_qp
+        size = 0
+        with open(self.path, "rb") as fp:
+            st = os.fstat(fp.fileno())
+            unchanged = (st.st_size, st.st_mtime_ns) == self.key[1:]
+            if not unchanged:
+                chunks = None
+            for chunk in encode(fp):
+                size += len(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+        if unchanged:
+            self._encoded_size = size
+        if chunks is not None:
+            ATTACHMENT_CACHE.put(self.key, b"".join(chunks))
+
+    def get_payload(self, i=None, decode=False):
+        """Return the file contents, encoded unless decode is True."""
+        if decode:
+            with self._open() as fp:
+                return bytes(fp.read())
+        return b"".join(self.iter_encoded()).decode("ascii").replace("\r\n", "\n")
+
+
+def _seekable(fp):
+    """Return True if file object fp can seek, i.e. a SpooledTemporaryFile."""
+    try:
+        return fp.seekable()
+    except AttributeError:
+        return hasattr(fp, "seek")
+
+
+class _Reader:
+    """
+    Minimal binary file object over in-memory data for MemoryAttachment:
+    reads of a memoryview are slices of it (no copy), reads of a seekable
+    file object start at its own offset, so several sends may read one
+    attachment concurrently.
+    """
+
+    def __init__(self, view=None, fp=None, start=0, lock=None):
+        self.view, self.fp, self.pos, self.lock = view, fp, start, lock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def read(self, size=-1):
+        if self.view is not None:
+            end = len(self.view) if size < 0 else self.pos + size
+            chunk = self.view[self.pos : end]
+        else:
+            with self.lock:
+                self.fp.seek(self.pos)
+                chunk = self.fp.read(size)
+        self.pos += len(chunk)
+        return chunk
+
+
+class MemoryAttachment(FileAttachment):
+    """
+    An application/octet-stream attachment generated in memory, encoded a
+    chunk at a time while the message is sent just like a FileAttachment,
+    without copying the data or writing it to a temporary file.
+
+    Args:
+        :filename: (str) name the attachment is sent as
+        :data: (bytes, bytearray, memoryview or binary file object) the
+            contents; a file object is read from its current position
+        :subtype: (str) application subtype, i.e. 'zip'
+
+    Note:
+        The data must not change while the message is in use.  Seekable
+        file objects are read again on every send, others are read into
+        memory once.  Encoded bodies are not kept in ATTACHMENT_CACHE.
+    """
+
+    def __init__(self, filename, data, subtype="octet-stream"):
+        MIMEBase.__init__(self, "application", subtype)
+        self.path = None
+        self.key = None
+        self.filename = filename
+        self._fp, self._view = None, None
+        if hasattr(data, "read") and _seekable(data):
+            self._fp, self._start = data, data.tell()
+            self._lock = threading.Lock()
+            self.size = data.seek(0, os.SEEK_END) - self._start
+            data.seek(self._start)
+        else:
+            if hasattr(data, "read"):
+                data = data.read()
+            self._view = memoryview(data).cast("B")
+            self.size = len(self._view)
+        self.encoding = self._choose_encoding()
+        self["Content-Transfer-Encoding"] = self.encoding
+        self._payload = ""
+        self._encoded_size = None
+
+    def _open(self):
+        if self._view is not None:
+            return _Reader(view=self._view)
+        return _Reader(fp=self._fp, start=self._start, lock=self._lock)
+
+    def iter_encoded(self):
+        """Yield the encoded contents in CRLF-terminated chunks."""
+        encode = iter_base64 if self.encoding == "base64" else iter_qp
+        size = 0
+        with self._open() as fp:
+            for chunk in encode(fp):
+                size += len(chunk)
+                yield chunk
+        self._encoded_size = size
+
+
+def _blocks(fp):
+    """Yield the contents of file object fp in blocks until its end."""
+    while True:
+        block = fp.read(LINE_BYTES * CHUNK_LINES)
+        if not block:
+            break
+        yield block
+
+
+def _spool():
+    """Return a temporary file kept in memory up to SPOOL_BYTES."""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+
+
+def _gzip(name, doc):
+    """Return a spooled gzip file of attachment doc, positioned at its end."""
+    spool = _spool()
+    with doc._open() as src, gzip.GzipFile(
+        os.path.basename(name), "wb", fileobj=spool, mtime=0
+    ) as dst:
+        shutil.copyfileobj(src, dst, LINE_BYTES * CHUNK_LINES)
+    return spool
+
+
+def _zip(parts):
+    """Return a spooled zip archive of (name, attachment) parts, at its end."""
+    spool = _spool()
+    with zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, doc in parts:
+            info = zipfile.ZipInfo(os.path.basename(name), time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = doc.size
+            with doc._open() as src, archive.open(info, "w") as dst:
+                shutil.copyfileobj(src, dst, LINE_BYTES * CHUNK_LINES)
+    return spool
+
+
+def compress_attachments(parts, method="zip", threshold=COMPRESS_THRESHOLD,
+                         bundle=None):
+    """
+    Compress the attachments of at least threshold bytes, each into its own
+    .zip or .gz file, or all of them into one zip archive named bundle.
+    Compressed data is spooled in memory (on disk past SPOOL_BYTES) and
+    attached as a MemoryAttachment.  Attachments that do not get smaller,
+    i.e. images or archives, are kept as they are.
+
+    Args:
+        :parts: (list) (filename, FileAttachment) pairs
+        :method: (str) 'zip' or 'gzip'
+        :threshold: (int) size in bytes from which attachments are compressed
+        :bundle: (str) filename of the zip archive bundling them, if any
+
+    Returns the new list of (filename, attachment) pairs.
+    """
+    if method not in ("zip", "gzip"):
+        raise ValueError("Unknown compression method: " + str(method))
+    large = [(name, doc) for name, doc in parts if doc.size >= threshold]
+    if bundle:
+        if not large:
+            return parts
+        spool = _zip(large)
+        if spool.tell() >= sum(doc.size for _, doc in large):
+            return parts
+        spool.seek(0)
+        archive = (bundle, MemoryAttachment(bundle, spool, "zip"))
+        first = parts.index(large[0])
+        rest = [part for part in parts if part not in large]
+        return rest[:first] + [archive] + rest[first:]
+
+    compressed = []
+    for name, doc in parts:
+        if doc.size >= threshold:
+            spool = _zip([(name, doc)]) if method == "zip" else _gzip(name, doc)
+            if spool.tell() < doc.size:
+                spool.seek(0)
+                suffix = ".zip" if method == "zip" else ".gz"
+                name, doc = name + suffix, MemoryAttachment(
+                    name + suffix, spool, method
+                )
+        compressed.append((name, doc))
+    return compressed
+
+
+class TextBody(MIMENonMultipart):
+    """
+    A text part sent with the cheapest Content-Transfer-Encoding it allows:
+    7bit for ASCII text, 8bit for other text when the server supports
+    8BITMIME, otherwise the shorter of quoted-printable and base64.
+    Non-ASCII text is sent as UTF-8.
+
+    Args:
+        :text: (str) the text
+        :subtype: (str) text subtype, i.e. 'plain' or 'html'
+
+    Note:
+        The headers and payload held by the part are the 7bit safe form, the
+        8bit form is only written by iter_bytes(msg, eightbit=True).
+    """
+
+    def __init__(self, text, subtype="plain"):
+        self.text = text
+        self._forms = {}
+        charset, encoding, body = self.encode(eightbit=False)
+        super().__init__("text", subtype, charset=charset)
+        self["Content-Transfer-Encoding"] = encoding
+        self._payload = body.decode("ascii").replace("\r\n", "\n")
+
+    def encode(self, eightbit=False):
+        """Return (charset, Content-Transfer-Encoding, encoded body)."""
+        if eightbit not in self._forms:
+            self._forms[eightbit] = self._encode(eightbit)
+        return self._forms[eightbit]
+
+    def _encode(self, eightbit):
+        text = _NEWLINE.sub("\n", self.text)
+        data = text.encode("utf-8")
+        charset = "us-ascii" if text.isascii() else "utf-8"
+        short = all(len(line) <= MAX_LINE for line in data.split(b"\n"))
+        if short and (eightbit or charset == "us-ascii"):
+            return (
+                charset,
+                "7bit" if charset == "us-ascii" else "8bit",
+                data.replace(b"\n", CRLF),
+            )
+        qp = binascii.b2a_qp(data, istext=True).replace(b"\n", CRLF)
+        if len(qp) <= base64_size(len(data) + text.count("\n")):
+            return charset, "quoted-printable", qp
+        return charset, "base64", encode_base64(data.replace(b"\n", CRLF))
+
+    def wire(self, policy, eightbit=False):
+        """Return headers and body of the part for the given 8BITMIME support."""
+        _, encoding, body = self.encode(eightbit)
+        headers = b"".join(
+            header_bytes(
+                name,
+                encoding if name.lower() == "content-transfer-encoding" else value,
+                policy,
+            )
+            for name, value in self.raw_items()
+        )
+        return headers + CRLF + body
+
+
+class Payload:
+    """
+    Wire format (CRLF line endings) of a message as an iterable of bytes
+    chunks.  Headers and text parts are rendered on the first iteration and
+    kept, while attachments are encoded from disk (or ATTACHMENT_CACHE) on
+    every iteration, so the payload can be re-sent (e.g. after a reconnect
+    or a retry) without re-rendering or holding attachments in memory.
+
+    Args:
+        :message: (email.message.Message) the message to serialize
+        :eightbit: (bool) default form of iter() and bytes(): TextBody
+            parts may be sent unencoded, as to a server supporting 8BITMIME
+
+    Usage:
+        The same Payload may be sent to several servers at once, i.e. by
+        sendmail() from several threads, so the form a server gets is
+        passed to chunks(), size() and is_8bit() per session and never
+        stored on the payload.
+
+    Note:
+        Changes to message after the first iteration are not picked up,
+        create a new Payload instead.
+    """
+
+    def __init__(self, message, eightbit=False):
+        self.message = message
+        self.eightbit = eightbit
+        self._rendered = {}
+
+    def _chunks(self, eightbit):
+        chunks = self._rendered.get(eightbit)
+        if chunks is None:
+            policy = self.message.policy.clone(linesep="\r\n")
+            chunks = list(_iter_parts(self.message, policy, eightbit))
+            self._rendered[eightbit] = chunks
+        return chunks
+
+    def chunks(self, eightbit=None):
+        """Yield the wire format in bytes chunks, 8bit if eightbit."""
+        if eightbit is None:
+            eightbit = self.eightbit
+        return _encode_parts(self._chunks(eightbit))
+
+    def __iter__(self):
+        return self.chunks()
+
+    def __bytes__(self):
+        return b"".join(self)
+
+    def size(self, eightbit=None):
+        """Return the length of the wire format in bytes, None if unknown."""
+        if eightbit is None:
+            eightbit = self.eightbit
+        return _parts_size(self._chunks(eightbit))
+
+    def is_8bit(self, eightbit=None):
+        """Return True if the 8bit wire format has 8bit parts (BODY=8BITMIME)."""
+        if eightbit is None:
+            eightbit = self.eightbit
+        return eightbit and any(
+            part.encode(True)[1] == "8bit"
+            for part in self.message.walk()
+            if isinstance(part, TextBody)
+        )
+
+    def bytes_saved(self):
+        """
+        Return how many bytes the chosen transfer encodings save, compared
+        to base64 encoding every text part and attachment.  Attachments
+        whose encoded length is unknown (i.e. a file changed while it was
+        sent) are left out.
+        """
+        saved = 0
+        for part in self.message.walk():
+            if isinstance(part, FileAttachment):
+                size = part.encoded_size()
+                if size is not None:
+                    saved += base64_size(part.size) - size
+            elif isinstance(part, TextBody):
+                body = part.encode(self.eightbit)[2]
+                raw = _NEWLINE.sub("\r\n", part.text).encode("utf-8")
+                saved += base64_size(len(raw)) - len(body)
+        return saved
+
+
+class TextStream(MIMENonMultipart):
+    """
+    A text part streamed from a file or an iterator while the message is
+    sent, quoted-printable encoded a chunk at a time, so a large body is
+    never held in memory as a whole.
+
+    Args:
+        :source: (pathlib.Path, file object or iterable) the UTF-8 text, as
+            the path of a file, a text or binary file object, or an
+            iterable of str or bytes chunks
+        :subtype: (str) text subtype, i.e. 'plain' or 'html'
+
+    Note:
+        A path is read again on every send.  Other sources can only be read
+        once, so what was read is kept in a temporary file (in memory up to
+        SPOOL_BYTES) to be replayed when the message is sent again.
+        The encoded size is unknown before sending, so no SIZE is declared.
+    """
+
+    def __init__(self, source, subtype="plain"):
+        super().__init__("text", subtype, charset="utf-8")
+        self["Content-Transfer-Encoding"] = "quoted-printable"
+        self.source = source
+        self._lock = threading.Lock()
+        self._spool = None
+        self._unread = None
+        self._payload = ""
+
+    def _read(self):
+        """Yield the text in chunks, from its start on every call."""
+        if isinstance(self.source, os.PathLike):
+            with open(self.source, "rb") as fp:
+                yield from _blocks(fp)
+            return
+
+        with self._lock:
+            if self._spool is None:
+                self._spool = _spool()
+                if hasattr(self.source, "read"):
+                    self._unread = _blocks(self.source)
+                else:
+                    self._unread = iter(self.source)
+        # the lock is never held across a yield, so a send abandoned midway
+        # (i.e. by a disconnect) does not block the next one
+        pos = 0
+        while True:
+            with self._lock:
+                self._spool.seek(pos)
+                chunk = self._spool.read(LINE_BYTES * CHUNK_LINES)
+                if not chunk:
+                    chunk = next(self._unread, None)
+                    if chunk is None:
+                        return
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    self._spool.seek(0, os.SEEK_END)
+                    self._spool.write(chunk)
+            pos += len(chunk)
+            yield chunk
+
+    def encoded_size(self):
+        """Return None, the length is only known once the text is read."""
+        return None
+
+    def iter_encoded(self):
+        """Yield the encoded text in CRLF-terminated chunks."""
+        return iter_text_qp(self._read())
+
+    def get_payload(self, i=None, decode=False):
+        """Return the whole text, encoded unless decode is True."""
+        if decode:
+            return b"".join(self._read())
+        return b"".join(self.iter_encoded()).decode("ascii").replace("\r\n", "\n")
+
+
+def text_bytes(text):
+    """Return ASCII text with its line endings converted to CRLF."""
+    return _NEWLINE.sub("\r\n", text).encode("ascii")
+
+
+def header_bytes(name, value, policy):
+    """Return one header folded by policy, skipping it for short ASCII lines."""
+    if isinstance(value, str) and value.isascii() and not _NEWLINE.search(value):
+        line = name + ": " + value
+        if len(line) <= (policy.max_line_length or len(line)):
+            return line.encode("ascii") + CRLF
+    return policy.fold_binary(name, value)
+
+
+def headers_bytes(msg, policy):
+    """Return the header block of msg, including the blank line after it."""
+    return b"".join(header_bytes(h, v, policy) for h, v in msg.raw_items()) + CRLF
+
+
+def ensure_boundary(msg):
+    """Return the boundary of multipart msg, choosing one if it has none."""
+    boundary = msg.get_boundary()
+    if not boundary:
+        boundary = Generator._make_boundary()
+        msg.set_boundary(boundary)
+    return boundary
+
+
+def _iter_parts(msg, policy, eightbit):
+    """
+    Yield msg serialized as bytes chunks, except for the bodies of
+    FileAttachments and TextStreams which are yielded as the part itself.
+    """
+    if isinstance(msg, TextBody):
+        yield msg.wire(policy, eightbit)
+    elif isinstance(msg, (FileAttachment, TextStream)):
+        yield headers_bytes(msg, policy)
+        yield msg
+    elif msg.is_multipart():
+        boundary = ensure_boundary(msg)
+        yield headers_bytes(msg, policy)
+        if msg.preamble is not None:
+            yield msg.preamble.encode("ascii").replace(b"\n", CRLF) + CRLF
+        delimiter = b"--" + boundary.encode("ascii")
+        yield delimiter + CRLF
+        for i, part in enumerate(msg.get_payload()):
+            if i:
+                yield CRLF + delimiter + CRLF
+            yield from _iter_parts(part, policy, eightbit)
+        yield CRLF + delimiter + b"--" + CRLF
+        if msg.epilogue is not None:
+            yield msg.epilogue.encode("ascii").replace(b"\n", CRLF)
+    elif (
+        msg.get_content_maintype() == "text"
+        and isinstance(msg._payload, str)
+        and msg._payload.isascii()
+    ):
+        yield headers_bytes(msg, policy) + text_bytes(msg._payload)
+    else:
+        yield msg.as_bytes(policy=policy)
+
+
+def iter_bytes(msg, policy=None, eightbit=False):
+    """
+    Yield msg serialized like msg.as_bytes() with CRLF line endings, one
+    part at a time, encoding FileAttachment bodies lazily from disk.
+
+    Headers, ASCII text parts and multipart structure are written as bytes
+    directly; any other part falls back to the email.generator path.
+    With eightbit, TextBody parts are written in their 8bit form.
+    """
+    policy = (policy or msg.policy).clone(linesep="\r\n")
+    return _encode_parts(_iter_parts(msg, policy, eightbit))
+
+
+def message_size(msg, policy=None, eightbit=False):
+    """
+    Return the length of the iter_bytes() output for msg, without reading
+    the files of its base64 encoded FileAttachments, or None if it has a
+    TextStream.
+    """
+    policy = (policy or msg.policy).clone(linesep="\r\n")
+    return _parts_size(_iter_parts(msg, policy, eightbit))
+
+
+def _encode_parts(chunks):
+    """Yield the _iter_parts() chunks, encoding the streamed parts."""
+    for chunk in chunks:
+        if isinstance(chunk, (FileAttachment, TextStream)):
+            yield from chunk.iter_encoded()
+        else:
+            yield chunk
+
+
+def _parts_size(chunks):
+    """Return the encoded length of the _iter_parts() chunks, None if unknown."""
+    total = 0
+    for chunk in chunks:
+        if isinstance(chunk, (FileAttachment, TextStream)):
+            size = chunk.encoded_size()
+            if size is None:
+                return None
+            total += size
+        else:
+            total += len(chunk)
+    return total
@@ -0,0 +1,1220 @@
+"""SMTP Module - connection handling shared by the email message classes."""
+
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import re
+import smtplib
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from smtplib import quoteaddr
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+
+import aiosmtplib
+
+
+CRLF = "\r\n"
+_BCRLF = b"\r\n"
+_DOT_LINE = re.compile(rb"(?m)^\.")
+_THROTTLED = re.compile(rb"(?i)rate|limit|too many|try again later|throttl")
+_EXHAUSTED = re.compile(rb"(?i)quota|5\.4\.5|daily|sending limit|rate limit")
+RCPT_LIMIT = 100  # recipients per transaction most providers accept
+PROBE_PORTS = (465, 587, 25)  # submission ports tried by server discovery
+
+
+"""
+What discovery learned about an SMTP server:
+    :server: (str) host name
+    :port: (int) port that accepted the connection
+    :transport: (str) 'ssl', 'starttls' or 'plain'
+    :auth: (list) AUTH mechanisms advertised
+    :pipelining: (bool) PIPELINING is supported
+    :size: (int) SIZE limit in bytes, 0 if none
+    :eightbitmime: (bool) 8BITMIME is supported
+    :checked: (float) time.time() of the probe
+"""
+ServerProfile = namedtuple(
+    "ServerProfile",
+    ["server", "port", "transport", "auth", "pipelining", "size", "eightbitmime",
+     "checked"],
+)
+
+
+"""
+Functions below this header are helpers for inspecting SMTP sessions and the
+errors raised by them.
+"""
+
+
+def is_disconnect(exc):
+    """
+    Return True if the exception means the session can no longer be used,
+    i.e. the connection dropped, a socket error occurred or the server
+    answered with 421 (service not available, closing transmission channel).
+    """
+    if isinstance(exc, SMTPServerDisconnected):
+        return True
+    if isinstance(exc, SMTPResponseException):
+        return exc.smtp_code == 421
+    return isinstance(exc, OSError) and not isinstance(exc, SMTPException)
+
+
+def is_async_disconnect(exc):
+    """is_disconnect() for the exceptions raised by aiosmtplib clients."""
+    if isinstance(exc, aiosmtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return exc.code == 421
+    return isinstance(exc, OSError)
+
+
+def throttle_state(exc):
+    """
+    Return what an SMTP error says about the sending account: 'exhausted'
+    when it used up its quota (i.e. gmail's '550 5.4.5 Daily user sending
+    quota exceeded'), 'throttled' when it should slow down (421, or a 4xx
+    reply mentioning a rate or limit), else None.
+    """
+    if isinstance(exc, SMTPResponseException):
+        code, resp = exc.smtp_code, exc.smtp_error
+    elif isinstance(exc, SMTPRecipientsRefused) and exc.recipients:
+        code, resp = next(iter(exc.recipients.values()))
+    else:
+        return None
+    if isinstance(resp, str):
+        resp = resp.encode("utf-8", "replace")
+    if code == 421 or (400 <= code < 500 and _THROTTLED.search(resp or b"")):
+        return "throttled"
+    if code >= 500 and _EXHAUSTED.search(resp or b""):
+        return "exhausted"
+    return None
+
+
+def close_session(session):
+    """Politely end a session, falling back to closing the socket."""
+    try:
+        session.quit()
+    except (SMTPException, OSError):
+        session.close()
+
+
+async def close_client(client):
+    """Politely end an aiosmtplib client connection, falling back to closing it."""
+    try:
+        await client.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        client.close()
+
+
+def max_size(session):
+    """Return the message size limit the server advertised, or 0 if none."""
+    try:
+        return int(session.esmtp_features.get("size") or 0)
+    except ValueError:
+        return 0
+
+
+def message_size(msg, eightbit=None):
+    """
+    Return the size in bytes of msg as given to sendmail(), without
+    serializing attachments, or None if it cannot be known up front.
+    eightbit selects the form of a Payload.
+    """
+    if isinstance(msg, bytes):
+        return len(msg)
+    if isinstance(msg, list):
+        return sum(map(len, msg))
+    if hasattr(msg, "size"):
+        return msg.size(eightbit)
+    return None
+
+
+def _abort(session, code):
+    """End a failed transaction: drop the session on 421, else RSET."""
+    if code == 421:
+        session.close()
+        return
+    try:
+        session.rset()
+    except SMTPServerDisconnected:
+        pass
+
+
+"""
+Functions below this header run mail transactions over an open session.
+"""
+
+
+def sendmail(session, from_addr, to_addrs, msg, mail_options=()):
+    """
+    Send msg like smtplib.SMTP.sendmail() and return the refused recipients.
+
+    msg may be a str, bytes or an iterable of bytes chunks with CRLF line
+    endings (i.e. messages._mime.Payload) which is streamed into the DATA
+    command without ever being joined in memory.
+
+    When the server advertises ESMTP PIPELINING (RFC 2920) the MAIL FROM and
+    every RCPT TO command are written in one batch and their replies read
+    afterwards, so a transaction costs two round trips no matter how many
+    recipients it has.
+
+    When the server advertises a SIZE limit (RFC 1870) that the message
+    exceeds, SMTPSenderRefused (552) is raised before anything is sent.
+
+    When the server advertises 8BITMIME (RFC 6152) and msg is a Payload, its
+    text parts are sent in 8bit rather than quoted-printable or base64.  The
+    form is chosen for this session only, so one Payload may be sent to
+    servers with and without 8BITMIME, even concurrently.
+
+    An LMTP session (RFC 2033) reports a DATA reply per recipient, failed
+    ones are returned as refused.  A SendmailCommand pipes msg to the local
+    sendmail binary instead.
+    """
+    if isinstance(session, SendmailCommand):
+        return session.sendmail(from_addr, to_addrs, msg)
+    session.ehlo_or_helo_if_needed()
+    if isinstance(msg, str):
+        msg = re.sub(r"(?:\r\n|\n|\r(?!\n))", CRLF, msg).encode("ascii")
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+
+    options = list(mail_options)
+    eightbit = None
+    if hasattr(msg, "chunks"):
+        eightbit = msg.eightbit or session.has_extn("8bitmime")
+        if msg.is_8bit(eightbit):
+            options.append("body=8BITMIME")
+    if session.has_extn("size"):
+        size = message_size(msg, eightbit)
+        limit = max_size(session)
+        if size is not None and limit and size > limit:
+            raise SMTPSenderRefused(
+                552,
+                "Message size of {} bytes exceeds the server limit of {} "
+                "bytes".format(size, limit).encode("ascii"),
+                from_addr,
+            )
+        if size is not None:
+            options.append("size=%d" % size)
+
+    if session.has_extn("pipelining"):
+        commands = ["mail FROM:" + " ".join([quoteaddr(from_addr)] + options)]
+        commands += ["rcpt TO:" + quoteaddr(addr) for addr in to_addrs]
+        session.send("".join(cmd + CRLF for cmd in commands))
+        code, resp = session.getreply()
+        replies = [session.getreply() for _ in to_addrs]
+    else:
+        code, resp = session.mail(from_addr, options)
+        replies = []
+        for addr in to_addrs if code == 250 else ():
+            replies.append(session.rcpt(addr))
+            if replies[-1][0] == 421:
+                break
+
+    refused = {}
+    for addr, (rcpt_code, rcpt_resp) in zip(to_addrs, replies):
+        if rcpt_code not in (250, 251):
+            refused[addr] = (rcpt_code, rcpt_resp)
+
+    if code != 250:
+        _abort(session, code)
+        raise SMTPSenderRefused(code, resp, from_addr)
+    closing = any(c == 421 for c, _ in refused.values())
+    if closing or len(refused) == len(to_addrs):
+        _abort(session, 421 if closing else 0)
+        raise SMTPRecipientsRefused(refused)
+
+    code, resp = senddata(session, msg if eightbit is None else msg.chunks(eightbit))
+    if isinstance(session, smtplib.LMTP):
+        accepted = [addr for addr in to_addrs if addr not in refused]
+        replies = [(code, resp)] + [session.getreply() for _ in accepted[1:]]
+        for addr, (code, resp) in zip(accepted, replies):
+            if code != 250:
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            raise SMTPRecipientsRefused(refused)
+        return refused
+    if code != 250:
+        _abort(session, code)
+        raise SMTPDataError(code, resp)
+    return refused
+
+
+def senddata(session, msg):
+    """
+    Send the DATA command and msg (bytes or an iterable of bytes chunks)
+    and return the server reply.  Chunks are dot-stuffed and written to the
+    socket as they are produced.
+    """
+    if isinstance(msg, bytes):
+        return session.data(msg)
+
+    session.putcmd("data")
+    code, resp = session.getreply()
+    if code != 354:
+        raise SMTPDataError(code, resp)
+    line_start = True
+    try:
+        for chunk in msg:
+            if not chunk:
+                continue
+            stuffed = _DOT_LINE.sub(b"..", chunk)
+            if not line_start and chunk[:1] == b".":
+                stuffed = stuffed[1:]
+            session.send(stuffed)
+            line_start = chunk.endswith(b"\n")
+    except BaseException:
+        # the server is waiting for the rest of the message, which can
+        # neither be finished nor cancelled, so drop the connection
+        session.close()
+        raise
+    session.send((b"." if line_start else _BCRLF + b".") + _BCRLF)
+    return session.getreply()
+
+
+def _chunks(recipients, limit):
+    """Yield lists of at most limit (if any) recipients, at least one list."""
+    recipients = iter(recipients)
+    chunk = list(itertools.islice(recipients, limit or None))
+    yield chunk
+    while chunk:
+        chunk = list(itertools.islice(recipients, limit or None))
+        if chunk:
+            yield chunk
+
+
+def send_chunked(deliver, recipients, limit=RCPT_LIMIT, workers=1):
+    """
+    Deliver one message to recipients in transactions of at most limit
+    recipients by calling deliver(chunk), which returns the refused dict of
+    its transaction, e.g. a sendmail() call.  With workers > 1 the chunks
+    are delivered from that many threads, each with its own session.
+
+    recipients may be any iterable, i.e. a generator: it is read one chunk
+    at a time (a few per worker), so it is never held in memory as a whole.
+
+    Returns the refused recipients of every transaction merged, and raises
+    SMTPRecipientsRefused only if every recipient was refused.
+    """
+
+    def attempt(chunk):
+        try:
+            return chunk, deliver(chunk)
+        except SMTPRecipientsRefused as e:
+            return chunk, e.recipients
+
+    def results():
+        if workers <= 1:
+            yield from map(attempt, _chunks(recipients, limit))
+            return
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque()
+            for chunk in _chunks(recipients, limit):
+                pending.append(executor.submit(attempt, chunk))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    refused, delivered = {}, False
+    for chunk, result in results():
+        refused.update(result or {})
+        if not set(result or {}) >= set(chunk):
+            delivered = True
+    if refused and not delivered:
+        raise SMTPRecipientsRefused(refused)
+    return refused
+
+
+async def send_chunked_async(deliver, recipients, limit=RCPT_LIMIT):
+    """
+    Like send_chunked(), awaiting deliver(chunk), i.e. the sendmail() of an
+    aiosmtplib client, once per transaction of at most limit recipients.
+
+    Returns the refused recipients of every transaction merged, as
+    {address: (code, message)}, and raises SMTPRecipientsRefused only if
+    every recipient was refused.
+    """
+    refused, delivered = {}, False
+    for chunk in _chunks(recipients, limit):
+        try:
+            errors, _ = await deliver(chunk)
+            result = {addr: (r.code, r.message) for addr, r in errors.items()}
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            result = {r.recipient: (r.code, r.message) for r in e.recipients}
+        refused.update(result)
+        if not set(result) >= set(chunk):
+            delivered = True
+    if refused and not delivered:
+        raise SMTPRecipientsRefused(refused)
+    return refused
+
+
+def send_mx(deliver, recipients, resolver=None, limit=RCPT_LIMIT, workers=8,
+            per_domain=2):
+    """
+    Deliver one message straight to the mail exchangers of its recipients'
+    domains instead of through a relay.  Recipients are grouped by domain,
+    and each group is sent in transactions of at most limit recipients by
+    calling deliver(host, chunk), which returns the refused dict of its
+    transaction, trying the MX hosts of the domain in order of preference
+    until one answers.  Domains are delivered to from workers threads, with
+    at most per_domain transactions in flight per domain.
+
+    Recipients of a domain that does not resolve are refused with 550, of
+    one whose exchangers all failed with the last error (or 451).
+
+    Returns the refused recipients of every transaction merged, and raises
+    SMTPRecipientsRefused only if every recipient was refused.
+    """
+    resolver = resolver or MX_RESOLVER
+    domains = {}
+    for addr in recipients:
+        domains.setdefault(addr.rpartition("@")[2].lower(), []).append(addr)
+    gates = {domain: threading.BoundedSemaphore(per_domain) for domain in domains}
+    jobs = [
+        (domain, chunk)
+        for domain, addrs in domains.items()
+        for chunk in _chunks(addrs, limit)
+    ]
+
+    def attempt(job):
+        domain, chunk = job
+        try:
+            hosts = resolver.hosts(domain)
+        except LookupError as e:
+            return chunk, {r: (550, str(e).encode("utf-8")) for r in chunk}
+        except OSError as e:
+            return chunk, {r: (451, str(e).encode("utf-8")) for r in chunk}
+
+        code, resp = 451, b"No mail exchanger of " + domain.encode() + b" answered"
+        with gates[domain]:
+            for host in hosts:
+                try:
+                    return chunk, deliver(host, chunk)
+                except SMTPRecipientsRefused as e:
+                    return chunk, e.recipients
+                except SMTPResponseException as e:
+                    code, resp = e.smtp_code, e.smtp_error
+                    if code >= 500:
+                        break
+                except OSError as e:
+                    resp = str(e).encode("utf-8")
+        return chunk, {r: (code, resp) for r in chunk}
+
+    if workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(min(workers, len(jobs))) as executor:
+            results = list(executor.map(attempt, jobs))
+    else:
+        results = [attempt(job) for job in jobs]
+
+    refused = {}
+    for _, result in results:
+        refused.update(result or {})
+    if refused and all(set(result or {}) >= set(chunk) for chunk, result in results):
+        raise SMTPRecipientsRefused(refused)
+    return refused
+
+
+def resolve_mx(domain):
+    """
+    Default MXResolver lookup: return ([(preference, host), ...], ttl) for
+    the MX records of domain, or its implicit MX (the domain itself, RFC
+    5321) if it has none, using the optional dnspython package.
+    Raises LookupError if the domain does not exist, OSError if DNS fails.
+    """
+    try:
+        import dns.exception
+        import dns.resolver
+    except ImportError:
+        raise ImportError(
+            "MX delivery requires dnspython: pip install messages[mx]"
+        ) from None
+
+    resolve = getattr(dns.resolver, "resolve", None) or dns.resolver.query
+    try:
+        answer = resolve(domain, "MX")
+    except dns.resolver.NXDOMAIN:
+        raise LookupError("Domain does not exist: " + domain) from None
+    except dns.resolver.NoAnswer:
+        return [(0, domain)], 300
+    except dns.exception.DNSException as e:
+        raise OSError("MX lookup of {} failed: {}".format(domain, e)) from None
+    records = [(r.preference, r.exchange.to_text().rstrip(".")) for r in answer]
+    return records, answer.rrset.ttl
+
+
+class MXResolver:
+    """
+    Cache of the mail exchangers of recipient domains, kept for the TTL of
+    their MX records (failed lookups for negative_ttl seconds).
+
+    Args:
+        :resolver: (callable) resolver(domain) returns ([(preference, host),
+            ...], ttl), or raises LookupError for a domain without mail;
+            resolve_mx() (dnspython) by default
+        :negative_ttl: (int) seconds a domain that does not resolve is cached
+
+    Usage:
+        Used by send_mx() through the module-level MX_RESOLVER, i.e. tests
+        can deliver to a local server with
+        MX_RESOLVER.configure(resolver=lambda domain: ([(10, '127.0.0.1')], 60))
+    """
+
+    def __init__(self, resolver=None, negative_ttl=300):
+        self.resolver = resolver or resolve_mx
+        self.negative_ttl = negative_ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """Update the settings: resolver, negative_ttl; empties the cache."""
+        for name, value in settings.items():
+            if name not in ("resolver", "negative_ttl"):
+                raise TypeError("Unknown resolver setting: " + name)
+            if name == "resolver":
+                value = value or resolve_mx
+            setattr(self, name, value)
+        self.clear()
+
+    def hosts(self, domain):
+        """Return the MX hosts of domain, most preferred first."""
+        domain = domain.lower()
+        now = time.monotonic()
+        with self._lock:
+            expires, hosts = self._cache.get(domain, (0, None))
+        if expires > now:
+            if isinstance(hosts, LookupError):
+                raise hosts
+            return hosts
+
+        try:
+            records, ttl = self.resolver(domain)
+            hosts = [host for _, host in sorted(records)]
+            if not hosts or hosts == [""] or hosts == ["."]:
+                raise LookupError("Domain does not accept mail: " + domain)
+        except LookupError as e:
+            with self._lock:
+                self._cache[domain] = (now + self.negative_ttl, e)
+            raise
+        with self._lock:
+            self._cache[domain] = (now + ttl, hosts)
+        return hosts
+
+    def clear(self):
+        """Forget every cached domain."""
+        with self._lock:
+            self._cache = {}
+
+
+MX_RESOLVER = MXResolver()
+
+
+"""
+Classes below this header manage long-lived SMTP sessions.
+"""
+
+
+class TransportSettings:
+    """
+    Where Email delivers messages unless one is chosen per message.
+
+    Args:
+        :default: (str) 'smtp' (the server of the message, with TLS and
+            login), 'local' (plain SMTP to a local MTA), 'lmtp' (LMTP,
+            i.e. over a Unix domain socket), 'sendmail' (pipe to the
+            sendmail binary) or 'mx' (straight to the mail exchangers of
+            the recipient domains, see send_mx())
+        :local: (tuple) (host, port) of the local MTA
+        :lmtp: (str) path of the LMTP Unix socket, or host name
+        :lmtp_port: (int) LMTP port when lmtp is a host name
+        :sendmail: (list) sendmail command, the envelope sender and
+            recipients are appended
+        :mx_port: (int) port of the mail exchangers
+        :mx_workers: (int) domains delivered to in parallel
+        :mx_per_domain: (int) most transactions in flight per domain
+
+    Usage:
+        Used by Email through the module-level TRANSPORTS, i.e.
+        TRANSPORTS.configure(default='local') hands every message to the
+        local queue.
+    """
+
+    NAMES = ("smtp", "local", "lmtp", "sendmail", "mx")
+    SETTINGS = (
+        "default",
+        "local",
+        "lmtp",
+        "lmtp_port",
+        "sendmail",
+        "mx_port",
+        "mx_workers",
+        "mx_per_domain",
+    )
+
+    def __init__(
+        self,
+        default="smtp",
+        local=("localhost", 25),
+        lmtp="/var/run/dovecot/lmtp",
+        lmtp_port=24,
+        sendmail=("/usr/sbin/sendmail", "-i"),
+        mx_port=25,
+        mx_workers=8,
+        mx_per_domain=2,
+    ):
+        self.default = default
+        self.local = local
+        self.lmtp = lmtp
+        self.lmtp_port = lmtp_port
+        self.sendmail = sendmail
+        self.mx_port = mx_port
+        self.mx_workers = mx_workers
+        self.mx_per_domain = mx_per_domain
+
+    def configure(self, **settings):
+        """Update the settings: see SETTINGS."""
+        for name, value in settings.items():
+            if name not in self.SETTINGS:
+                raise TypeError("Unknown transport setting: " + name)
+            if name == "default" and value not in self.NAMES:
+                raise ValueError("Unknown transport: " + str(value))
+            setattr(self, name, value)
+
+
+TRANSPORTS = TransportSettings()
+
+
+class SendmailCommand:
+    """
+    Session-like stand-in that hands each message to the local sendmail
+    binary, so it can be used wherever sendmail() takes an SMTP session.
+
+    Args:
+        :command: (list) sendmail command, i.e. ['/usr/sbin/sendmail', '-i']
+    """
+
+    def __init__(self, command):
+        self.command = list(command)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Pipe msg with LF line endings to sendmail, return {} (no refusals)."""
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        if isinstance(msg, bytes):
+            msg = [msg]
+
+        with tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(
+                self.command + ["-f", from_addr, "--"] + list(to_addrs),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=errors,
+            )
+            try:
+                pending = b""
+                for chunk in msg:
+                    chunk = pending + chunk
+                    pending = b"\r" if chunk.endswith(b"\r") else b""
+                    proc.stdin.write(chunk[: len(chunk) - len(pending)]
+                                     .replace(b"\r\n", b"\n"))
+                proc.stdin.write(pending)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            except BaseException:
+                # never let sendmail queue a truncated message
+                proc.kill()
+                proc.wait()
+                raise
+            code = proc.wait()
+            if code:
+                errors.seek(0)
+                raise SMTPDataError(code, errors.read().strip())
+        return {}
+
+    def noop(self):
+        return 250, b"OK"
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _PoolSettings:
+    """Settings shared by the sync and async session pools."""
+
+    def __init__(self, size, idle_timeout, max_messages):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self._reset()
+
+    def _reset(self):
+        """Start with a fresh state, used on init and after a fork."""
+
+    def configure(self, **settings):
+        """Update the pool settings: size, idle_timeout, max_messages."""
+        for name, value in settings.items():
+            if name not in ("size", "idle_timeout", "max_messages"):
+                raise TypeError("Unknown pool setting: " + name)
+            setattr(self, name, value)
+
+
+class SMTPSessionPool(_PoolSettings):
+    """
+    Process-wide pool of logged-in SMTP sessions.
+
+    Sessions are keyed by (server, port, from_) so every message sent from
+    the same account through the same server can reuse an authenticated
+    connection instead of repeating the TLS handshake and login.
+
+    Args:
+        :size: (int) max number of idle sessions kept per key
+        :idle_timeout: (int or float) seconds an idle session may wait in
+            the pool before it is closed instead of reused
+        :max_messages: (int) messages sent over one session before it is
+            retired, 0 for no limit
+
+    Usage:
+        Call self.run(key, connect, func) where connect() returns a new
+        logged-in session and func(session) does the sending.  The pool
+        health-checks idle sessions with NOOP before reuse and transparently
+        reconnects once if the server drops the connection (or replies 421).
+        Settings can be changed at any time with self.configure().
+
+    Note:
+        Sessions inherited across os.fork() are dropped (never QUIT) by the
+        child, so parent and child never share a socket.
+    """
+
+    def __init__(self, size=2, idle_timeout=60, max_messages=100):
+        super().__init__(size, idle_timeout, max_messages)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._sent = {}
+
+    def _check_pid(self):
+        """Forget every session inherited from a parent process."""
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _pop_idle(self, key):
+        """Return the most recently used idle session for key, or None."""
+        expired = []
+        session = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    session = candidate
+                    break
+            for s in expired:
+                self._sent.pop(s, None)
+        for s in expired:
+            close_session(s)
+        return session
+
+    @staticmethod
+    def _healthy(session):
+        """Check an idle session is still alive before handing it out."""
+        try:
+            return session.noop()[0] == 250
+        except (SMTPException, OSError):
+            return False
+
+    def acquire(self, key, connect):
+        """Return a healthy pooled session for key, connecting if needed."""
+        self._check_pid()
+        while True:
+            session = self._pop_idle(key)
+            if session is None:
+                session = connect()
+                with self._lock:
+                    self._sent[session] = 0
+                return session
+            if self._healthy(session):
+                return session
+            self.discard(session)
+
+    def release(self, key, session, sent=1):
+        """
+        Give a session back to the pool after sending sent messages over it.
+        The session is closed instead if it reached max_messages or the pool
+        for key is already full.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            count = self._sent.get(session, 0) + sent
+            idle = self._idle.setdefault(key, [])
+            keep = len(idle) < self.size and (
+                not self.max_messages or count < self.max_messages
+            )
+            if keep:
+                self._sent[session] = count
+                idle.append((session, time.monotonic()))
+            else:
+                self._sent.pop(session, None)
+        if not keep:
+            close_session(session)
+
+    def discard(self, session):
+        """Close a session that must not be reused."""
+        with self._lock:
+            self._sent.pop(session, None)
+        try:
+            session.close()
+        except (SMTPException, OSError):
+            pass
+
+    def run(self, key, connect, func, sent=1):
+        """
+        Call func(session) with a pooled session and return its result.
+        If the session turns out to be disconnected, it is discarded and
+        func is retried once on a fresh session.
+        """
+        session = self.acquire(key, connect)
+        try:
+            for attempt in (1, 2):
+                if session is None:
+                    session = connect()
+                try:
+                    return func(session)
+                except OSError as e:
+                    if attempt == 2 or not is_disconnect(e):
+                        raise
+                    self.discard(session)
+                    session = None
+        finally:
+            if session is not None:
+                self.release(key, session, sent)
+
+    def close(self):
+        """QUIT and forget every idle session."""
+        self._check_pid()
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s, _ in idle]
+            self._idle = {}
+            self._sent = {}
+        for session in sessions:
+            close_session(session)
+
+
+SMTP_POOL = SMTPSessionPool()
+atexit.register(SMTP_POOL.close)
+
+
+class AsyncSMTPPool(_PoolSettings):
+    """
+    Pool of long-lived, logged-in aiosmtplib.SMTP clients.
+
+    Each (server, port, from_) key gets at most size connections per event
+    loop.  Concurrent senders queue for the next free connection, so any
+    number of send_async() calls multiplex over a handful of authenticated
+    sessions instead of opening one each.
+
+    Args:
+        :size: (int) max number of connections per key and event loop
+        :idle_timeout: (int or float) seconds a connection may sit unused
+            before it is closed instead of reused
+        :max_messages: (int) messages sent over one connection before it is
+            retired, 0 for no limit
+
+    Usage:
+        Call await self.run(key, connect, func) where await connect()
+        returns a new logged-in client and await func(client) does the
+        sending.  A connection that was dropped (or answered 421) is
+        replaced and func retried once.
+
+    Note:
+        Connections belong to the event loop that opened them; a pool used
+        from another loop (or a forked child) starts over with new ones.
+    """
+
+    def __init__(self, size=4, idle_timeout=60, max_messages=100):
+        super().__init__(size, idle_timeout, max_messages)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _slots(self, key):
+        """
+        Return the stack of connection slots for key on the running loop.
+        A slot is either an idle (client, last_used, sent) tuple or None,
+        meaning a connection may be opened; the stack starts with size Nones
+        and is last in, first out so warm connections are reused first.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        pools = self._loops.setdefault(asyncio.get_running_loop(), {})
+        if key not in pools:
+            pools[key] = asyncio.LifoQueue()
+            for _ in range(self.size):
+                pools[key].put_nowait(None)
+        return pools[key]
+
+    async def _checkout(self, slot, connect):
+        """Turn a slot into a usable client and its sent count."""
+        if slot is not None:
+            client, last_used, sent = slot
+            expired = time.monotonic() - last_used > self.idle_timeout
+            if client.is_connected and not expired:
+                return client, sent
+            await self._close(client)
+        return await connect(), 0
+
+    @staticmethod
+    async def _close(client):
+        """Politely end a client connection, falling back to closing it."""
+        await close_client(client)
+
+    async def run(self, key, connect, func):
+        """Await func(client) with a pooled client and return its result."""
+        slots = self._slots(key)
+        slot = await slots.get()
+        client = None
+        try:
+            client, sent = await self._checkout(slot, connect)
+            for attempt in (1, 2):
+                if client is None:
+                    client = await connect()
+                try:
+                    result = await func(client)
+                    break
+                except (aiosmtplib.SMTPException, OSError) as e:
+                    if attempt == 2 or not is_async_disconnect(e):
+                        raise
+                    client.close()
+                    client, sent = None, 0
+            sent += 1
+            if self.max_messages and sent >= self.max_messages:
+                await self._close(client)
+                client = None
+            return result
+        finally:
+            if client is None:
+                slots.put_nowait(None)
+            else:
+                slots.put_nowait((client, time.monotonic(), sent))
+
+    async def close(self):
+        """QUIT every idle connection opened on the running loop."""
+        pools = self._loops.pop(asyncio.get_running_loop(), {})
+        for slots in pools.values():
+            while not slots.empty():
+                slot = slots.get_nowait()
+                if slot is not None:
+                    await self._close(slot[0])
+
+
+ASYNC_SMTP_POOL = AsyncSMTPPool()
+
+
+"""
+Classes below this header share TLS state between SMTP connections.
+"""
+
+
+class _ResumableSSLSocket(ssl.SSLSocket):
+    """SSLSocket that hands its TLS session back to its context on close."""
+
+    def close(self):
+        if not self._closed:
+            try:
+                self.context.remember(self.server_hostname, self.session)
+            except (OSError, ValueError):
+                pass
+        super().close()
+
+
+class TLSContext(ssl.SSLContext):
+    """
+    Client SSLContext that resumes TLS sessions.
+
+    The session of every connection closed through this context is kept
+    per server hostname and offered on the next handshake with that host,
+    so reconnecting (pooled or not) skips the full TLS handshake when the
+    server supports session tickets.
+
+    Args:
+        :verify: (bool) verify the server certificate and hostname
+        :cafile: (str) file of CA certificates to trust instead of the
+            system defaults
+        :capath: (str) directory of CA certificates to trust instead of
+            the system defaults
+
+    Note:
+        asyncio connections are offered the stored sessions as well, but only
+        sessions of smtplib connections are stored.
+    """
+
+    sslsocket_class = _ResumableSSLSocket
+
+    def __new__(cls, verify=True, cafile=None, capath=None):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, verify=True, cafile=None, capath=None):
+        super().__init__()
+        if verify:
+            if cafile or capath:
+                self.load_verify_locations(cafile, capath)
+            else:
+                self.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        else:
+            self.check_hostname = False
+            self.verify_mode = ssl.CERT_NONE
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def remember(self, hostname, session):
+        """Keep session to resume the next connection to hostname."""
+        if hostname and session is not None:
+            with self._lock:
+                self._sessions[hostname] = session
+
+    def session_for(self, hostname):
+        """Return the stored session for hostname, or None."""
+        with self._lock:
+            return self._sessions.get(hostname)
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = self.session_for(server_hostname)
+        return super().wrap_socket(
+            sock, *args, server_hostname=server_hostname, session=session, **kwargs
+        )
+
+    def wrap_bio(self, incoming, outgoing, *args, server_hostname=None,
+                 session=None, **kwargs):
+        if session is None:
+            session = self.session_for(server_hostname)
+        return super().wrap_bio(
+            incoming, outgoing, *args, server_hostname=server_hostname,
+            session=session, **kwargs
+        )
+
+
+class TLSContextCache:
+    """
+    Process-wide cache of TLSContexts keyed by server and verification
+    settings, so the CA bundle is parsed once rather than on every send and
+    TLS sessions can be resumed across connections.
+
+    Usage:
+        TLS_CONTEXTS.get(server, verify=True, cafile=None, capath=None)
+        returns the shared TLSContext for those settings.
+    """
+
+    def __init__(self):
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def get(self, server, verify=True, cafile=None, capath=None):
+        """Return the TLSContext for server with the given settings."""
+        key = (server, verify, cafile, capath)
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is None:
+                context = self._contexts[key] = TLSContext(verify, cafile, capath)
+            return context
+
+    def clear(self):
+        """Drop every cached context and the TLS sessions they hold."""
+        with self._lock:
+            self._contexts = {}
+
+
+TLS_CONTEXTS = TLSContextCache()
+
+
+"""
+Classes below this header discover and remember what SMTP servers support.
+"""
+
+
+class ServerProfileCache:
+    """
+    Cache of ServerProfiles, so the ports of a server are probed once and
+    not on every send.  Profiles are kept in memory and in a JSON file,
+    both expiring after ttl seconds; the file is read at most once per ttl,
+    so lookups of unknown servers do not touch the disk.
+
+    Args:
+        :ttl: (int) seconds a profile stays valid
+        :path: (str) JSON file the profiles are saved to, None to keep
+            them in memory only
+
+    Usage:
+        Used by Email through the module-level SERVER_PROFILES, which can be
+        tuned with SERVER_PROFILES.configure().
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, path=None):
+        self.ttl = ttl
+        self.path = path
+        self._profiles = {}
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """Update the cache settings: ttl, path."""
+        for name, value in settings.items():
+            if name not in ("ttl", "path"):
+                raise TypeError("Unknown cache setting: " + name)
+            setattr(self, name, value)
+        self._loaded = None
+
+    def _fresh(self, profile):
+        return profile is not None and time.time() - profile.checked < self.ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as fp:
+                return {k: ServerProfile(**v) for k, v in json.load(fp).items()}
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def _merge_file(self):
+        """Add the fresh profiles of the JSON file, once per ttl."""
+        if self._loaded is not None and time.time() - self._loaded < self.ttl:
+            return
+        self._loaded = time.time()
+        for server, profile in self._load().items():
+            if self._fresh(profile) and not self._fresh(self._profiles.get(server)):
+                self._profiles[server] = profile
+
+    def get(self, server, port=None, disk=True):
+        """
+        Return the fresh profile of server (on port, if given), or None.
+        With disk=False only the profiles already in memory are looked at.
+        """
+        with self._lock:
+            profile = self._profiles.get(server)
+            if not self._fresh(profile) and self.path and disk:
+                self._merge_file()
+                profile = self._profiles.get(server)
+        if not self._fresh(profile):
+            return None
+        if port is not None and int(port) != profile.port:
+            return None
+        return profile
+
+    def put(self, profile):
+        """Remember profile, in memory and in the JSON file."""
+        with self._lock:
+            self._profiles[profile.server] = profile
+            if not self.path:
+                return
+            profiles = {
+                k: v for k, v in self._load().items() if self._fresh(v)
+            }
+            profiles[profile.server] = profile
+            try:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, "w") as fp:
+                    json.dump({k: v._asdict() for k, v in profiles.items()}, fp)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Forget every profile, including the JSON file."""
+        with self._lock:
+            self._profiles, self._loaded = {}, None
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def discover(self, server, ports=PROBE_PORTS, context=None, timeout=10):
+        """
+        Return the profile of server on the first of ports offering TLS,
+        probing them in order unless a fresh profile for one is cached.
+        Ports answering without TLS (or whose STARTTLS was stripped) are
+        skipped and never cached, since logging in there would send the
+        password in cleartext.  Returns None if no port qualifies.
+        """
+        profile = self.get(server)
+        if (
+            profile is not None
+            and profile.transport != "plain"
+            and profile.port in [int(p) for p in ports]
+        ):
+            return profile
+        for port in ports:
+            profile = probe(server, int(port), context, timeout)
+            if profile is not None and profile.transport != "plain":
+                self.put(profile)
+                return profile
+        return None
+
+
+def probe(server, port, context=None, timeout=10):
+    """
+    Connect to server:port, read its EHLO capabilities (upgrading with
+    STARTTLS when offered) and return its ServerProfile, or None if it
+    cannot be reached.  Port 465 is connected with implicit TLS.
+    """
+    try:
+        if port == 465:
+            session = smtplib.SMTP_SSL(server, port, timeout=timeout, context=context)
+            transport = "ssl"
+        else:
+            session = smtplib.SMTP(server, port, timeout=timeout)
+            transport = "plain"
+        try:
+            session.ehlo()
+            if transport == "plain" and session.has_extn("starttls"):
+                session.starttls(context=context)
+                session.ehlo()
+                transport = "starttls"
+            return ServerProfile(
+                server,
+                port,
+                transport,
+                session.esmtp_features.get("auth", "").split(),
+                session.has_extn("pipelining"),
+                max_size(session),
+                session.has_extn("8bitmime"),
+                time.time(),
+            )
+        finally:
+            close_session(session)
+    except OSError:
+        return None
+
+
+SERVER_PROFILES = ServerProfileCache(
+    path=os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "messages",
+        "smtp_profiles.json",
+    )
+)
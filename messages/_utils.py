@@ -1,6 +1,10 @@
 """Utility Module - functions useful to other modules."""
 
 import datetime
+import sys
+import types
+from collections import deque
+from collections.abc import Iterator
 from collections.abc import MutableSequence
 
 import validus
@@ -36,7 +40,8 @@ def validate_property(attr):
     """
     A property factory that will dispatch the to a specific validator function
     that will validate the user's input to ensure critical parameters are of a
-    specific type.
+    specific type.  Assignments are recorded in the instance's _dirty set, if
+    it has one, so messages can rebuild only what changed.
     """
 
     def getter(instance):
@@ -45,6 +50,9 @@ def validate_property(attr):
     def setter(instance, value):
         validate_input(instance.__class__.__name__, attr, value)
         instance.__dict__[attr] = value
+        dirty = instance.__dict__.get("_dirty")
+        if dirty is not None:
+            dirty.add(attr)
 
     return property(fget=getter, fset=setter)
 
@@ -54,6 +62,7 @@ def validate_input(msg_type, attr, value):
     try:
         valid = {
             "Email": validate_email,
+            "EmailTemplate": validate_email,
             "Twilio": validate_twilio,
             "SlackWebhook": validate_slackwebhook,
             "SlackPost": validate_slackpost,
@@ -70,21 +79,47 @@ def check_valid(msg_type, attr, value, func, exec_info):
     """
     Checker function all validate_* functions below will call.
     Raises InvalidMessageInputError if input is not valid as per
-    given func.
+    given func.  Iterators are not consumed here, their items are
+    validated as they are read, see iter_valid().
     """
     if value is not None:
         if isinstance(value, MutableSequence):
             for v in value:
                 if not func(v):
                     raise InvalidMessageInputError(msg_type, attr, value, exec_info)
+        elif isinstance(value, Iterator):
+            return
         else:
             if not func(value):
                 raise InvalidMessageInputError(msg_type, attr, value, exec_info)
 
 
+def iter_valid(msg_type, attr, values, func, exec_info, rejected=None):
+    """
+    Yield the items of values, an iterator too large to validate up front,
+    raising InvalidMessageInputError at the first item not valid as per func,
+    or, if rejected is a list, skipping such items and appending them to it.
+    """
+    for v in values:
+        if not func(v):
+            if rejected is None:
+                raise InvalidMessageInputError(msg_type, attr, v, exec_info)
+            rejected.append(v)
+            continue
+        yield v
+
+
 def validate_email(attr, value):
     """Email input validator function."""
-    check_valid("Email", attr, value, validus.isemail, "email address")
+    if attr not in ("subject", "body", "attachments"):
+        check_valid("Email", attr, value, validus.isemail, "email address")
+
+
+def iter_valid_emails(attr, values, rejected=None):
+    """Yield the addresses of iterator values, validating each one."""
+    return iter_valid(
+        "Email", attr, values, validus.isemail, "email address", rejected
+    )
 
 
 def validate_twilio(attr, value):
@@ -138,3 +173,39 @@ Functions below this hearder are general utility functions.
 def timestamp():
     """Get current date and time."""
     return "{:%Y-%b-%d %H:%M:%S}".format(datetime.datetime.now())
+
+
+_SHARED = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+           types.MethodType)
+
+
+def deep_sizeof(obj):
+    """
+    Return the bytes obj retains: its own size plus that of every object
+    reachable through its containers, attributes and slots, each counted
+    once.  Classes, modules and functions are shared, so are not counted.
+    """
+    seen, size, stack = set(), 0, [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED):
+            continue
+        seen.add(id(obj))
+        if isinstance(type(obj).__sizeof__, types.FunctionType):
+            # a deep __sizeof__ (i.e. Message's) would count its attributes twice
+            size += object.__sizeof__(obj)
+        else:
+            size += sys.getsizeof(obj)
+        if isinstance(getattr(obj, "__dict__", None), dict):
+            stack.append(obj.__dict__)
+        if isinstance(obj, dict):
+            stack += obj.keys()
+            stack += obj.values()
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack += obj
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__", ())
+            for slot in (slots,) if isinstance(slots, str) else slots:
+                if slot not in ("__dict__", "__weakref__") and hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
@@ -4,24 +4,71 @@ Module designed to make creating and sending emails easy.
 1.  Email
     - Uses the Python 3 standard library email.message.EmailMessage
       class to construct the email.
+
+2.  EmailTemplate
+    - Mail-merge template that renders and sends one personalized Email
+      per recipient, serializing the parts they share only once.
+
+3.  SenderPool
+    - Sends many Emails through several accounts in parallel, keeping
+      each under its daily quota and routing around throttled ones.
 """
 
+import asyncio
+import itertools
+import os
+import queue
+import re
 import reprlib
 import smtplib
-import ssl
+import string
+import threading
+import time
+from smtplib import SMTPException
 from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+from collections import deque
+from collections import namedtuple
+from collections.abc import Iterator
 from collections.abc import MutableSequence
+from concurrent.futures import ProcessPoolExecutor
 from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 
 import aiosmtplib
 
 from ._exceptions import MessageSendError
 from ._interface import Message
+from ._mime import ATTACHMENT_CACHE
+from ._mime import COMPRESS_THRESHOLD
+from ._mime import FileAttachment
+from ._mime import MemoryAttachment
+from ._mime import Payload
+from ._mime import TextBody
+from ._mime import TextStream
+from ._mime import compress_attachments
+from ._mime import ensure_boundary
+from ._mime import header_bytes
+from ._mime import iter_bytes
+from ._smtp import ASYNC_SMTP_POOL
+from ._smtp import SERVER_PROFILES
+from ._smtp import SMTP_POOL
+from ._smtp import TLS_CONTEXTS
+from ._smtp import TRANSPORTS
+from ._smtp import SendmailCommand
+from ._smtp import RCPT_LIMIT
+from ._smtp import close_client
+from ._smtp import close_session
+from ._smtp import is_disconnect
+from ._smtp import send_chunked
+from ._smtp import send_chunked_async
+from ._smtp import send_mx
+from ._smtp import sendmail
+from ._smtp import throttle_state
 from ._utils import credential_property
 from ._utils import validate_property
+from ._utils import validate_email
+from ._utils import iter_valid_emails
 from ._utils import timestamp
 
 
@@ -40,6 +87,218 @@ SMTP_SERVERS = {
 }
 
 
+"""
+Outcome of one message sent by Email.send_many():
+    :email: (Email) the message
+    :refused: (dict) {recipient: (code, response)} for refused recipients
+    :error: (Exception) why the message was not sent, else None
+"""
+SendResult = namedtuple("SendResult", ["email", "refused", "error"])
+
+"""
+Outcome of Email.render_many():
+    :count: (int) messages rendered
+    :bytes: (int) total size of the rendered messages
+    :seconds: (float) wall time spent
+    :rate: (float) messages rendered per second
+"""
+RenderStats = namedtuple("RenderStats", ["count", "bytes", "seconds", "rate"])
+
+"""
+Sending state of one SenderPool account:
+    :from_: (str) address of the account
+    :sent: (int) messages sent in the current 24 hour window
+    :limit: (int) messages allowed per window, None if unlimited
+    :blocked_until: (float) time.time() until which the account is skipped
+        because it was throttled or used up its quota, 0 if it is not
+"""
+AccountUsage = namedtuple("AccountUsage", ["from_", "sent", "limit", "blocked_until"])
+
+HEADER_ATTRS = ("from_", "to", "cc", "subject")
+COMPRESS_ATTRS = ("compress", "compress_threshold", "bundle")
+WRITE_BUFFER = 1 << 20  # bytes buffered per rendered file
+_MBOX_FROM = re.compile(rb"(?m)^(>*From )")
+INVALID_ADDRESS = (553, b"5.1.3 Invalid address")  # refused lazy bcc entries
+
+
+def _flatten(*recipients):
+    """
+    Flatten str, list or iterator recipients into one list of addresses, or
+    into one iterator, read lazily, if any of them is an iterator.
+    """
+    if any(isinstance(i, Iterator) for i in recipients):
+        return itertools.chain.from_iterable(
+            [i] if isinstance(i, str) else i or () for i in recipients
+        )
+    flat = []
+    for i in recipients:
+        if i:
+            if isinstance(i, MutableSequence):
+                flat += i
+            else:
+                flat.append(i)
+    return flat
+
+
+def _send_batch(key, owner, jobs):
+    """
+    Send a batch of messages for one session key (see Email._session_key)
+    over a single (re)used session, connecting and logging in through owner,
+    an Email or EmailTemplate.  Each job is an (item, prepare) tuple, where
+    prepare() returns the (recipients, payload) of the message to send.
+    Returns a list of SendResult(item, refused, error), one per job.
+    """
+
+    def connect():
+        if owner.pooled:
+            return SMTP_POOL.acquire(key, owner._get_session)
+        return owner._get_session()
+
+    def discard(session):
+        if owner.pooled:
+            SMTP_POOL.discard(session)
+        else:
+            session.close()
+
+    results, session, sent = [], None, 0
+    for i, (item, prepare) in enumerate(jobs):
+        try:
+            recipients, payload = prepare()
+            if key[0] == "mx":
+                refused = _send_mx(owner.from_, recipients, payload, owner.pooled)
+                results.append(SendResult(item, refused, None))
+                continue
+            for attempt in (1, 2):
+                if session is None:
+                    session = connect()
+                try:
+                    refused = sendmail(session, owner.from_, recipients, payload)
+                    break
+                except OSError as exc:
+                    if attempt == 2 or not is_disconnect(exc):
+                        raise
+                    discard(session)
+                    session = None
+        except SMTPRecipientsRefused as exc:
+            results.append(SendResult(item, exc.recipients, exc))
+        except MessageSendError as exc:
+            results += [SendResult(job[0], {}, exc) for job in jobs[i:]]
+            break
+        except (KeyError, ValueError, OSError) as exc:
+            results.append(SendResult(item, {}, exc))
+        else:
+            sent += 1
+            results.append(SendResult(item, refused, None))
+
+    if session is not None:
+        if owner.pooled:
+            SMTP_POOL.release(key, session, sent)
+        else:
+            close_session(session)
+    return results
+
+
+def _get_mx(host):
+    """
+    Get an SMTP session with the mail exchanger host, upgraded to TLS if it
+    offers STARTTLS.  MX hosts rarely have certificates matching their
+    names, so the TLS is opportunistic and unverified, like between MTAs.
+    """
+    session = smtplib.SMTP(host, TRANSPORTS.mx_port)
+    session.ehlo()
+    if session.has_extn("starttls"):
+        session.starttls(context=TLS_CONTEXTS.get(host, verify=False))
+        session.ehlo()
+    return session
+
+
+def _send_mx(from_, recipients, payload, pooled=False, limit=RCPT_LIMIT):
+    """
+    Deliver payload straight to the mail exchangers of the recipients'
+    domains (see messages._smtp.send_mx), with a session per MX host that
+    is pooled in SMTP_POOL if pooled.  Returns the refused recipients.
+    """
+
+    def deliver(host, chunk):
+        if pooled:
+            return SMTP_POOL.run(
+                ("mx", host, TRANSPORTS.mx_port),
+                lambda: _get_mx(host),
+                lambda session: sendmail(session, from_, chunk, payload),
+            )
+        session = _get_mx(host)
+        try:
+            return sendmail(session, from_, chunk, payload)
+        finally:
+            close_session(session)
+
+    return send_mx(
+        deliver,
+        recipients,
+        limit=limit,
+        workers=TRANSPORTS.mx_workers,
+        per_domain=TRANSPORTS.mx_per_domain,
+    )
+
+
+def _in_memory(attachment):
+    """Return True if attachment is a (filename, data) in-memory attachment."""
+    return (
+        isinstance(attachment, tuple)
+        and len(attachment) == 2
+        and isinstance(attachment[0], str)
+        and not isinstance(attachment[1], str)
+    )
+
+
+def _render(spec, path=None):
+    """
+    Build spec, an Email or a dict of Email arguments, and write its wire
+    format to the .eml file at path, or return it as an mbox entry (LF line
+    endings, mboxrd quoting) when path is None.  Runs in worker processes
+    of Email.render_many(), so it must stay a module-level function.
+    Returns (size, entry), entry being None when written to path.
+    """
+    e = spec if isinstance(spec, Email) else Email(**spec)
+    e._construct_message()
+    ensure_boundary(e.message)
+    if path is not None:
+        size = 0
+        with open(path, "wb", buffering=WRITE_BUFFER) as f:
+            for chunk in e._payload:
+                size += f.write(chunk)
+        return size, None
+
+    data = bytes(e._payload)
+    body = _MBOX_FROM.sub(rb">\1", data.replace(b"\r\n", b"\n"))
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    entry = "From {} {}\n".format(e.from_ or "MAILER-DAEMON", time.asctime())
+    return len(data), entry.encode("utf-8") + body + b"\n"
+
+
+def _imap(func, jobs, processes):
+    """
+    Yield func(*job) for each job in order, from a pool of processes
+    (in this process if processes is 1).  At most a few jobs per process
+    are in flight, so jobs may be a lazy stream of any length.
+    """
+    if processes == 1:
+        for job in jobs:
+            yield func(*job)
+        return
+
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(func, *job))
+            if len(pending) >= 4 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+
 class Email(Message):
     """
     Create and send emails using the built-in email package.
@@ -47,7 +306,7 @@ class Email(Message):
     Args:
         :from_: (str) originating email address
             i.e. 'me@here.com'
-        :to: (str or list) primary message recipients
+        :to: (str, list or iterator) primary message recipients
              i.e. 'you@there.com' or
                   ['her@there.com', 'him@there.com']
         :server: (str) url of smtp server
@@ -55,23 +314,75 @@ class Email(Message):
         :port: (int) smtp server port
             i.e. 465 or 587
         :auth: (str) password for email account
-        :cc: (str or list) carbon-copy recipients
-        :bcc: (str or list) blind carbon-copy recipients
+        :cc: (str, list or iterator) carbon-copy recipients
+        :bcc: (str, list or iterator) blind carbon-copy recipients, never
+            written to the headers; an iterator (i.e. a generator of 100k
+            addresses) is read lazily by send(), rcpt_limit addresses at a
+            time, and is consumed by the send; invalid addresses in it are
+            skipped and reported in refused with 553.  send_many(),
+            send_async() and SenderPool read it whole (validating it before
+            anything is sent), so use send() for very long lists
         :subject: (str) email message subject line
-        :body: (str) body text of the message to send
-        :attachments: (str or list) files to attach
+        :body: (str, pathlib.Path, file object or iterable) body text of
+            the message to send; anything but a str (i.e. the path of a
+            report, an open file or a generator of str or bytes chunks) is
+            streamed into the message while it is sent
+        :attachments: (str, tuple or list) files to attach, given by path or
+            as (filename, data) tuples of in-memory contents, data being
+            bytes, a memoryview or a binary file object
             i.e. './file1', or
                 ['/home/you/file1.txt', '/home/you/file2.pdf']
+            encoded attachments are cached (ATTACHMENT_CACHE) and reused by
+            every message attaching the same, unmodified file
+        :pooled: (bool) keep the logged-in SMTP session open in the shared
+            session pools (messages._smtp.SMTP_POOL for send() and
+            ASYNC_SMTP_POOL for send_async()) so later sends from the same
+            account reuse it instead of reconnecting
+        :ssl_verify: (bool) verify the server certificate, default True
+        :ssl_cafile: (str) CA bundle to verify the server with instead of
+            the system defaults
+            TLS contexts are shared per server and settings
+            (messages._smtp.TLS_CONTEXTS), so the CA bundle is loaded once
+            and TLS sessions are resumed on reconnect
+        :rcpt_limit: (int) most recipients per SMTP transaction, larger
+            recipient lists are sent in several transactions, default 100
+        :connections: (int) with pooled=True, how many pooled connections
+            may deliver the transactions of one message in parallel
+        :transport: (str) 'smtp' to send through server (the default),
+            'local' for plain SMTP to the local MTA, 'lmtp' for LMTP over
+            a Unix socket, 'sendmail' to pipe to the sendmail binary or
+            'mx' to deliver straight to the mail exchangers of each
+            recipient domain, in parallel (needs dnspython, the mx extra);
+            None uses messages._smtp.TRANSPORTS.default, which also holds
+            the local addresses and command, and the MX port and limits
+        :compress: (str) 'zip' or 'gzip' to compress attachments of at
+            least compress_threshold bytes before they are encoded, each
+            into its own archive; None (the default) sends them as they are
+        :compress_threshold: (int) smallest attachment compressed, in bytes
+        :bundle: (str) filename of one zip archive, i.e. 'reports.zip',
+            bundling all the attachments compress would compress
+        :lean: (bool) release the built message after every send instead of
+            keeping it to be reused, for long-lived objects where memory
+            matters more than rebuilding; sys.getsizeof() reports the bytes
+            a message retains
 
     Attributes:
         :message: (MIMEMultipart) current form of the message to be constructed
+        :refused: (dict) recipients refused by the server on the last send,
+            as {address: (code, response)}
+        :bytes_saved: (int) bytes the transfer encodings chosen on the last
+            send saved, compared to base64 encoding every part
 
     Managed Attributes (Properties):
         :auth: auth will set as a private attribute (_auth) and obscured when requested
         :from_: user input will validate a proper email address
         :to: user input will be validated for a proper email address
         :cc: user input will be validated for a proper email address
-        :bcc: user input will be validated for a proper email address
+        :bcc: user input will be validated for a proper email address,
+            as it is read for an iterator
+        :subject, body, attachments: changes are tracked like the above, so
+            sending again only rebuilds the headers and parts that changed
+            (in-place changes to lists are detected too)
 
     Usage:
         Create an email object with required Args above.
@@ -88,6 +399,16 @@ class Email(Message):
     to = validate_property("to")
     cc = validate_property("cc")
     bcc = validate_property("bcc")
+    subject = validate_property("subject")
+    body = validate_property("body")
+    attachments = validate_property("attachments")
+    _built_attrs = {
+        "message": type(None),
+        "_payload": type(None),
+        "_body_part": type(None),
+        "_attachment_parts": list,
+        "_built": dict,
+    }
 
     def __init__(
         self,
@@ -102,17 +423,49 @@ class Email(Message):
         body="",
         attachments=None,
         verbose=False,
+        pooled=False,
+        ssl_verify=True,
+        ssl_cafile=None,
+        rcpt_limit=RCPT_LIMIT,
+        connections=1,
+        transport=None,
+        compress=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        bundle=None,
+        lean=False,
     ):
 
         self.from_, self.to, self.cc, self.bcc = from_, to, cc, bcc
-        self.server = server or self.get_server(from_)[0]
-        self.port = port or self.get_server(from_)[1]
+        guess = (None, None) if server and port else self.get_server(from_)
+        self.server = server or guess[0]
+        self.port = port or guess[1]
+        # a port guessed for an unknown server is discovered on connect
+        self._discover = not port and (self.server, self.port) not in set(
+            SMTP_SERVERS.values()
+        )
         self.auth = auth
         self.subject = subject
         self.body = body
         self.attachments = attachments or []
         self.verbose = verbose
+        self.pooled = pooled
+        self.ssl_verify = ssl_verify
+        self.ssl_cafile = ssl_cafile
+        self.rcpt_limit = rcpt_limit
+        self.connections = connections
+        self.transport = transport
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.bundle = bundle
+        self.lean = lean
         self.message = None
+        self.refused = {}
+        self.bytes_saved = 0
+        self._dirty = set()
+        self._built = {}
+        self._body_part = None
+        self._attachment_parts = []
+        self._payload = None
 
     def __str__(self, indentation="\n"):
         """print(Email(**args)) method.
@@ -149,13 +502,20 @@ class Email(Message):
 
     @staticmethod
     def get_server(address=None):
-        """Return an SMTP servername guess from outgoing email address."""
+        """
+        Return an SMTP servername guess from outgoing email address, with
+        the port found by an earlier discovery (SERVER_PROFILES) if any.
+        Only profiles already in memory are looked at, so constructing an
+        Email never reads the disk; a guessed port is discovered on connect.
+        """
         if address:
             domain = address.split("@")[1]
             try:
                 return SMTP_SERVERS[domain]
             except KeyError:
-                return ("smtp." + domain, 465)
+                server = "smtp." + domain
+                profile = SERVER_PROFILES.get(server, disk=False)
+                return (server, profile.port if profile else 465)
         return (None, None)
 
     @staticmethod
@@ -172,12 +532,99 @@ class Email(Message):
                 return ", ".join(recipient)
             return recipient
 
+    def _get_recipients(self, rejected=None):
+        """
+        Flatten to, cc and bcc into the envelope recipients: a list, or an
+        iterator validating the addresses as they are read if bcc is one.
+        Invalid addresses raise InvalidMessageInputError, or, if rejected is
+        a list, are skipped and appended to it.
+        """
+        bcc = self.bcc
+        if isinstance(bcc, Iterator):
+            bcc = iter_valid_emails("bcc", bcc, rejected)
+        return _flatten(self.to, self.cc, bcc)
+
+    def _prepare(self):
+        """
+        Construct the message, return its recipients and wire payload.
+        In lean mode the message is only kept alive by the payload.
+        A bcc iterator is read whole here, so an invalid address raises
+        before anything is sent.
+        """
+        self._construct_message()
+        recipients, payload = list(self._get_recipients()), self._payload
+        if self.lean:
+            self.release()
+        return recipients, payload
+
+    def _changed(self):
+        """Return the attributes changed since the message was last built."""
+        changed = set(self._dirty)
+        for attr, value in self._built.items():
+            if getattr(self, attr) != value:
+                changed.add("attachments" if attr in COMPRESS_ATTRS else attr)
+        for doc in self._attachment_parts:
+            if doc.path is None:
+                continue
+            try:
+                st = os.stat(doc.path)
+            except OSError:
+                st = None
+            if st is None or (st.st_size, st.st_mtime_ns) != doc.key[1:]:
+                changed.add("attachments")
+        return changed
+
     def _construct_message(self):
-        """Put the parts of the email together."""
-        self.message = MIMEMultipart()
-        self._add_header()
-        self._add_body()
-        self._add_attachments()
+        """
+        Put the parts of the email together.  Once built, only the headers
+        and parts affected by changed attributes are rebuilt, and the
+        rendered payload is reused while nothing changes.
+        If a part cannot be built (i.e. a missing attachment), the message
+        is dropped and built from scratch on the next send.
+        """
+        for attr in ("to", "cc"):
+            if isinstance(getattr(self, attr), Iterator):
+                # listed in the headers anyway, so read (and validated) once
+                setattr(self, attr, list(getattr(self, attr)))
+
+        try:
+            if self.message is None or self._payload is None:
+                self.message = MIMEMultipart()
+                self._add_header()
+                self._add_body()
+                self._add_attachments()
+            else:
+                changed = self._changed()
+                if not changed:
+                    return
+                if changed.intersection(HEADER_ATTRS):
+                    for name in ("From", "Subject", "To", "Cc"):
+                        del self.message[name]
+                    self._add_header()
+                if changed.intersection(("body", "attachments")):
+                    self.message.set_payload(None)
+                    if "body" in changed:
+                        self._add_body()
+                    elif self._body_part is not None:
+                        self.message.attach(self._body_part)
+                    if "attachments" in changed:
+                        self._add_attachments()
+                    else:
+                        for doc in self._attachment_parts:
+                            self.message.attach(doc)
+        except BaseException:
+            # never keep a half-built message, the next send starts over
+            self.release()
+            raise
+
+        self._dirty.clear()
+        self._built = {
+            attr: list(getattr(self, attr))
+            for attr in ("to", "cc", "attachments")
+            if isinstance(getattr(self, attr), MutableSequence)
+        }
+        self._built.update((attr, getattr(self, attr)) for attr in COMPRESS_ATTRS)
+        self._payload = Payload(self.message)
 
     def _add_header(self):
         """Add email header info."""
@@ -187,35 +634,106 @@ class Email(Message):
             self.message["To"] = self.list_to_string(self.to)
         if self.cc:
             self.message["Cc"] = self.list_to_string(self.cc)
-        if self.bcc:
-            self.message["Bcc"] = self.list_to_string(self.bcc)
 
     def _add_body(self):
         """Add body content of email."""
-        if self.body:
-            b = MIMEText("text", "plain")
-            b.set_payload(self.body)
-            self.message.attach(b)
+        if not self.body:
+            self._body_part = None
+        elif isinstance(self.body, str):
+            self._body_part = TextBody(self.body)
+        else:
+            self._body_part = TextStream(self.body)
+        if self._body_part is not None:
+            self.message.attach(self._body_part)
 
     def _add_attachments(self):
-        """Add required attachments."""
+        """Add required attachments, compressed if self.compress or self.bundle."""
         num_attached = 0
+        self._attachment_parts = []
         if self.attachments:
-            if isinstance(self.attachments, str):
+            if isinstance(self.attachments, str) or _in_memory(self.attachments):
                 self.attachments = [self.attachments]
 
+            parts = []
             for item in self.attachments:
-                doc = MIMEApplication(open(item, "rb").read())
-                doc.add_header("Content-Disposition", "attachment", filename=item)
+                if _in_memory(item):
+                    doc = MemoryAttachment(*item)
+                    parts.append((doc.filename, doc))
+                else:
+                    parts.append((item, FileAttachment(item)))
+            if self.compress or self.bundle:
+                parts = compress_attachments(
+                    parts,
+                    self.compress or "zip",
+                    self.compress_threshold,
+                    self.bundle,
+                )
+
+            for filename, doc in parts:
+                doc.add_header("Content-Disposition", "attachment", filename=filename)
                 self.message.attach(doc)
+                self._attachment_parts.append(doc)
                 num_attached += 1
         return num_attached
 
+    def _get_transport(self):
+        """Return the transport messages are delivered with."""
+        return self.transport or TRANSPORTS.default
+
+    def _session_key(self):
+        """
+        Return the key sessions of this message are shared under, which
+        always includes from_: messages batched under one key are sent with
+        the same envelope sender.
+        """
+        transport = self._get_transport()
+        if transport == "smtp":
+            return (self.server, self.port, self.from_)
+        return (transport, self.from_)
+
+    def _get_security(self):
+        """
+        Return how to connect to the server: 'ssl' or 'starttls'.
+        Ports 465 and 587 are known; a guessed or other port is looked up in
+        SERVER_PROFILES, probing the server the first time.  A server without
+        TLS is refused, so the password is never sent in cleartext.
+        """
+        if self._discover:
+            profile = SERVER_PROFILES.discover(
+                self.server, context=self._get_ssl_context()
+            )
+        elif self.port in (465, "465"):
+            return "ssl"
+        elif self.port in (587, "587"):
+            return "starttls"
+        else:
+            profile = SERVER_PROFILES.discover(
+                self.server, ports=(self.port,), context=self._get_ssl_context()
+            )
+
+        if profile is None or profile.transport not in ("ssl", "starttls"):
+            raise MessageSendError(
+                "No SMTP server offering TLS found at {}:{}".format(
+                    self.server, self.port
+                )
+            )
+        self.port, self._discover = profile.port, False
+        return profile.transport
+
     def _get_session(self):
         """Start session with email server."""
-        if self.port in (465, "465"):
+        transport = self._get_transport()
+        if transport == "local":
+            return self._get_local()
+        if transport == "lmtp":
+            return self._get_lmtp()
+        if transport == "sendmail":
+            return SendmailCommand(TRANSPORTS.sendmail)
+
+        security = self._get_security()
+        if security == "ssl":
             session = self._get_ssl()
-        elif self.port in (587, "587"):
+        else:
             session = self._get_tls()
 
         try:
@@ -225,17 +743,35 @@ class Email(Message):
 
         return session
 
+    def _get_ssl_context(self):
+        """Return the shared TLS context for this server and settings."""
+        return TLS_CONTEXTS.get(
+            self.server, verify=self.ssl_verify, cafile=self.ssl_cafile
+        )
+
     def _get_ssl(self):
         """Get an SMTP session with SSL."""
         return smtplib.SMTP_SSL(
-            self.server, self.port, context=ssl.create_default_context()
+            self.server, self.port, context=self._get_ssl_context()
         )
 
+    def _get_local(self):
+        """Get an SMTP session with the local MTA, without TLS or login."""
+        session = smtplib.SMTP(*TRANSPORTS.local)
+        session.ehlo()
+        return session
+
+    def _get_lmtp(self):
+        """Get an LMTP session, over a Unix socket if TRANSPORTS.lmtp is a path."""
+        session = smtplib.LMTP(TRANSPORTS.lmtp, TRANSPORTS.lmtp_port)
+        session.ehlo()
+        return session
+
     def _get_tls(self):
         """Get an SMTP session with TLS."""
         session = smtplib.SMTP(self.server, self.port)
         session.ehlo()
-        session.starttls(context=ssl.create_default_context())
+        session.starttls(context=self._get_ssl_context())
         session.ehlo()
         return session
 
@@ -245,6 +781,9 @@ class Email(Message):
         First, a message is constructed, then a session with the email
         servers is created, finally the message is sent and the session
         is stopped.
+        Recipient lists longer than self.rcpt_limit are sent in several
+        transactions; recipients the server refuses are kept in
+        self.refused, SMTPRecipientsRefused is only raised if all are.
         """
         self._construct_message()
 
@@ -255,23 +794,437 @@ class Email(Message):
                 "\n{} Message created.".format(timestamp())
             )
 
-        recipients = []
-        for i in (self.to, self.cc, self.bcc):
-            if i:
-                if isinstance(i, MutableSequence):
-                    recipients += i
-                else:
-                    recipients.append(i)
+        self._deliver()
 
-        session = self._get_session()
         if self.verbose:
-            print(timestamp(), "Login successful.")
+            print(
+                timestamp(),
+                "Transfer encodings saved {} bytes.".format(self.bytes_saved),
+            )
+            print(
+                timestamp(),
+                type(self).__name__ + " info:",
+                self.__str__(indentation="\n * "),
+            )
 
-        session.sendmail(self.from_, recipients, self.message.as_string())
-        session.quit()
+        print("Message sent.")
+        if self.refused:
+            print("{} recipients refused.".format(len(self.refused)))
 
-        if self.verbose:
-            print(timestamp(), "Logged out.")
+    def _deliver(self):
+        """
+        Deliver the constructed message with its transport.  Invalid
+        addresses of a bcc iterator are refused with 553 rather than
+        aborting a send that may have delivered to earlier ones.
+        """
+        rejected = []
+        recipients = self._get_recipients(rejected)
+        payload = self._payload
+        ensure_boundary(self.message)
+        if self.lean:
+            self.release()
+
+        try:
+            if self._get_transport() == "mx":
+                refused = _send_mx(
+                    self.from_, recipients, payload, self.pooled, self.rcpt_limit
+                )
+            elif self.pooled:
+                refused = send_chunked(
+                    lambda chunk: SMTP_POOL.run(
+                        self._session_key(),
+                        self._get_session,
+                        lambda session: sendmail(session, self.from_, chunk, payload),
+                    ),
+                    recipients,
+                    self.rcpt_limit,
+                    self.connections,
+                )
+                if self.verbose:
+                    print(timestamp(), "Session returned to pool.")
+            else:
+                session = self._get_session()
+                if self.verbose:
+                    print(timestamp(), "Login successful.")
+                try:
+                    refused = send_chunked(
+                        lambda chunk: sendmail(session, self.from_, chunk, payload),
+                        recipients,
+                        self.rcpt_limit,
+                    )
+                finally:
+                    close_session(session)
+
+                if self.verbose:
+                    print(timestamp(), "Logged out.")
+        except SMTPRecipientsRefused as e:
+            e.recipients.update((addr, INVALID_ADDRESS) for addr in rejected)
+            self.refused = e.recipients
+            raise
+        refused.update((addr, INVALID_ADDRESS) for addr in rejected)
+        self.refused = refused
+
+        self.bytes_saved = payload.bytes_saved()
+
+    @staticmethod
+    def send_many(emails):
+        """
+        Send many messages, logging in once per (server, port, from_).
+        Messages sharing an account are sent back to back over one session,
+        pipelining MAIL FROM/RCPT TO when the server supports it.  A failed
+        message does not abort the rest of the batch.
+
+        Returns a list of SendResult(email, refused, error), one per message,
+        in the order given.
+        """
+        emails = list(emails)
+        batches = {}
+        for e in emails:
+            batches.setdefault(e._session_key(), []).append(e)
+
+        results = {}
+        for key, batch in batches.items():
+            jobs = [(e, e._prepare) for e in batch]
+            for result in _send_batch(key, batch[0], jobs):
+                results[id(result.email)] = result
+
+        sent = sum(1 for r in results.values() if r.error is None)
+        print("{} of {} messages sent.".format(sent, len(emails)))
+        return [results[id(e)] for e in emails]
+
+    def render(self, path=None):
+        """
+        Construct the message without sending it.  Returns its wire format
+        (bytes, CRLF line endings), or writes it to the .eml file at path
+        and returns the number of bytes written.
+        """
+        if path is not None:
+            return _render(self, path)[0]
+        self._construct_message()
+        ensure_boundary(self.message)
+        return bytes(self._payload)
+
+    @staticmethod
+    def render_many(emails, directory=None, mbox=None, processes=None):
+        """
+        Render many messages offline, i.e. to pre-generate a campaign or
+        load test a server, in a pool of worker processes so CPU-bound
+        rendering is kept apart from network-bound delivery.
+
+        Args:
+            :emails: (iterable) Email instances or dicts of Email arguments,
+                consumed lazily
+            :directory: (str) write each message to <directory>/<n>.eml,
+                n being its 0-based position in emails
+            :mbox: (str) append every message to this mbox file instead
+            :processes: (int) worker processes, default os.cpu_count();
+                1 renders in this process
+
+        Returns RenderStats(count, bytes, seconds, rate).
+        """
+        if (directory is None) == (mbox is None):
+            raise ValueError("Pass either directory or mbox")
+        processes = processes or os.cpu_count() or 1
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            jobs = (
+                (spec, os.path.join(directory, "{:06d}.eml".format(i)))
+                for i, spec in enumerate(emails)
+            )
+        else:
+            jobs = ((spec,) for spec in emails)
+
+        start = time.perf_counter()
+        count = total = 0
+        out = open(mbox, "ab", buffering=WRITE_BUFFER) if mbox else None
+        try:
+            for size, entry in _imap(_render, jobs, processes):
+                if out is not None:
+                    out.write(entry)
+                count += 1
+                total += size
+        finally:
+            if out is not None:
+                out.close()
+
+        seconds = time.perf_counter() - start
+        rate = count / seconds if seconds else 0.0
+        print(
+            "{} messages rendered in {:.2f}s ({:.1f} messages/sec).".format(
+                count, seconds, rate
+            )
+        )
+        return RenderStats(count, total, seconds, rate)
+
+    async def _get_session_async(self):
+        """Start an asynchronous session with email server."""
+        loop = asyncio.get_running_loop()
+        security = await loop.run_in_executor(None, self._get_security)
+        client = aiosmtplib.SMTP(
+            hostname=self.server,
+            port=self.port,
+            use_tls=security == "ssl",
+            tls_context=self._get_ssl_context(),
+        )
+        await client.connect()
+        if security == "starttls" and not client.get_transport_info("sslcontext"):
+            await client.starttls(tls_context=self._get_ssl_context())
+
+        try:
+            await client.login(self.from_, self._auth)
+        except aiosmtplib.SMTPResponseException as e:
+            client.close()
+            raise MessageSendError(e.message)
+
+        return client
+
+    async def send_async(self):
+        """
+        Send the message asynchronously.
+        Building the message and reading and encoding its attachments are
+        done in a worker thread, so the event loop is never blocked on disk
+        I/O.  The other transports ('local', 'lmtp', 'sendmail' and 'mx')
+        deliver from a worker thread too.  Like send(), recipient lists
+        longer than self.rcpt_limit are sent in several transactions over
+        one connection, and refused recipients are kept in self.refused.
+        """
+        loop = asyncio.get_running_loop()
+        if self._get_transport() != "smtp":
+            await loop.run_in_executor(None, self._construct_message)
+            await loop.run_in_executor(None, self._deliver)
+            return
+        recipients, data = await loop.run_in_executor(None, self._render_async)
+        if self._discover:
+            await loop.run_in_executor(None, self._get_security)
+
+        try:
+            if self.pooled:
+                self.refused = await send_chunked_async(
+                    lambda chunk: ASYNC_SMTP_POOL.run(
+                        (self.server, self.port, self.from_),
+                        self._get_session_async,
+                        lambda client: client.sendmail(self.from_, chunk, data),
+                    ),
+                    recipients,
+                    self.rcpt_limit,
+                )
+            else:
+                client = await self._get_session_async()
+                try:
+                    self.refused = await send_chunked_async(
+                        lambda chunk: client.sendmail(self.from_, chunk, data),
+                        recipients,
+                        self.rcpt_limit,
+                    )
+                finally:
+                    await close_client(client)
+        except SMTPRecipientsRefused as e:
+            self.refused = e.recipients
+            raise
+
+    def _render_async(self):
+        """
+        Construct the message, return its recipients and wire format as
+        bytes for aiosmtplib.  Called from a worker thread by send_async().
+        """
+        recipients, payload = self._prepare()
+        ensure_boundary(payload.message)
+        return recipients, bytes(payload)
+
+
+class EmailTemplate(Message):
+    """
+    Create and send personalized copies of one email (mail merge).
+
+    The parts every copy shares (attachments, MIME boundaries and static
+    headers) are built and serialized once.  Rendering a recipient only
+    substitutes the $placeholders of the subject and body and splices them
+    between the pre-serialized parts, which is much faster than building
+    an Email per recipient.
+
+    Args:
+        :from_: (str) originating email address
+        :server: (str) url of smtp server
+        :port: (int) smtp server port
+        :auth: (str) password for email account
+        :cc: (str or list) carbon-copy recipients of every copy
+        :bcc: (str or list) blind carbon-copy recipients of every copy
+        :subject: (str) subject line, may contain string.Template
+            placeholders, i.e. 'Hello $name'
+        :body: (str) body text, may contain placeholders
+        :attachments: (str, tuple or list) files to attach to every copy,
+            see Email
+        :pooled: (bool) see Email
+        :ssl_verify: (bool) see Email
+        :ssl_cafile: (str) see Email
+        :transport: (str) see Email
+        :compress: (str) see Email
+        :compress_threshold: (int) see Email
+        :bundle: (str) see Email
+
+    Managed Attributes (Properties):
+        :auth: auth will set as a private attribute (_auth) and obscured when requested
+        :from_: user input will validate a proper email address
+        :cc: user input will be validated for a proper email address
+        :bcc: user input will be validated for a proper email address
+
+    Usage:
+        Create an EmailTemplate with the Args above.
+        self.render(to, **fields) returns the wire bytes of one copy, and
+        self.send(rows) sends one copy per row, a dict holding the 'to'
+        recipient(s) and the placeholder values,
+            i.e. {'to': 'you@there.com', 'name': 'You'}
+        The 'to' value may also be used as the $to placeholder.
+    """
+
+    auth = credential_property("auth")
+    from_ = validate_property("from_")
+    cc = validate_property("cc")
+    bcc = validate_property("bcc")
+
+    def __init__(
+        self,
+        from_=None,
+        server=None,
+        port=None,
+        auth=None,
+        cc=None,
+        bcc=None,
+        subject="",
+        body="",
+        attachments=None,
+        verbose=False,
+        pooled=False,
+        ssl_verify=True,
+        ssl_cafile=None,
+        transport=None,
+        compress=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        bundle=None,
+    ):
+
+        self.from_, self.cc, self.bcc = from_, cc, bcc
+        guess = (None, None) if server and port else Email.get_server(from_)
+        self.server = server or guess[0]
+        self.port = port or guess[1]
+        self.auth = auth
+        self.subject = subject
+        self.body = body
+        self.attachments = attachments or []
+        self.verbose = verbose
+        self.pooled = pooled
+        self.ssl_verify = ssl_verify
+        self.ssl_cafile = ssl_cafile
+        self.transport = transport
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.bundle = bundle
+        self._compiled = None
+
+    def _email(self, **kwargs):
+        """Return an Email sharing this template's account and parts."""
+        return Email(
+            from_=self.from_,
+            server=self.server,
+            port=self.port,
+            auth=self._auth,
+            cc=self.cc,
+            bcc=self.bcc,
+            attachments=self.attachments,
+            verbose=self.verbose,
+            pooled=self.pooled,
+            ssl_verify=self.ssl_verify,
+            ssl_cafile=self.ssl_cafile,
+            transport=self.transport,
+            compress=self.compress,
+            compress_threshold=self.compress_threshold,
+            bundle=self.bundle,
+            **kwargs
+        )
+
+    def _get_session(self):
+        """Start session with email server."""
+        return self._email()._get_session()
+
+    def _session_key(self):
+        """Return the key sessions of this template are shared under."""
+        return self._email()._session_key()
+
+    def _compile(self):
+        """Serialize the parts shared by every copy, once per template state."""
+        attachments = self.attachments
+        if isinstance(attachments, MutableSequence):
+            attachments = tuple(attachments)
+        state = (self.from_, self.cc, self.bcc, self.subject, self.body,
+                 attachments) + tuple(getattr(self, a) for a in COMPRESS_ATTRS)
+        if self._compiled and self._compiled[0] == state:
+            return self._compiled
+
+        email = self._email()
+        email._construct_message()
+        msg = email.message
+        policy = msg.policy.clone(linesep="\r\n")
+        delimiter = b"--" + ensure_boundary(msg).encode("ascii")
+        names = [name for name, _ in msg.raw_items()]
+        split = names.index("Subject")
+        heads = [header_bytes(n, v, policy) for n, v in msg.raw_items()]
+
+        self._compiled = (
+            state,
+            policy,
+            b"".join(heads[:split]),
+            b"".join(heads[split + 1 :]) + b"\r\n",
+            delimiter,
+            [b"".join(iter_bytes(part, policy)) for part in msg.get_payload()],
+            string.Template(self.subject),
+            string.Template(self.body),
+        )
+        return self._compiled
+
+    def _chunks(self, to, fields):
+        """Return the wire format of the copy for to as a list of chunks."""
+        _, policy, head, tail, delimiter, parts, subject, body = self._compile()
+        fields = dict(fields, to=to)
+        text = body.substitute(fields)
+        if text:
+            parts = [TextBody(text).wire(policy)] + parts
+
+        chunks = [
+            head,
+            header_bytes("Subject", subject.substitute(fields), policy),
+            header_bytes("To", Email.list_to_string(to), policy),
+            tail,
+            delimiter + b"\r\n",
+        ]
+        for i, part in enumerate(parts):
+            if i:
+                chunks.append(b"\r\n" + delimiter + b"\r\n")
+            chunks.append(part)
+        chunks.append(b"\r\n" + delimiter + b"--\r\n")
+        return chunks
+
+    def render(self, to, **fields):
+        """Return the wire bytes of the copy sent to to, filled with fields."""
+        validate_email("to", to)
+        return b"".join(self._chunks(to, fields))
+
+    def _prepare(self, row):
+        """Return the recipients and wire payload of the copy for row."""
+        validate_email("to", row["to"])
+        return (
+            _flatten(row["to"], self.cc, self.bcc),
+            self._chunks(row["to"], row),
+        )
+
+    def send(self, rows):
+        """
+        Send one copy per row over a single login.  A failed copy does not
+        abort the rest.  Returns a list of SendResult(row, refused, error),
+        one per row, in the order given.
+        """
+        rows = list(rows)
+        jobs = [(row, lambda row=row: self._prepare(row)) for row in rows]
+        results = _send_batch(self._session_key(), self, jobs)
 
         if self.verbose:
             print(
@@ -280,29 +1233,223 @@ class Email(Message):
                 self.__str__(indentation="\n * "),
             )
 
-        print("Message sent.")
+        sent = sum(1 for r in results if r.error is None)
+        print("{} of {} messages sent.".format(sent, len(rows)))
+        return results
+
+    def __str__(self, indentation="\n"):
+        """print(EmailTemplate(**args)) method.
+           Indentation value can be overridden in the function call.
+           The default is new line"""
+        return (
+            "{}Server: {}:{}"
+            "{}From: {}"
+            "{}Cc: {}"
+            "{}Bcc: {}"
+            "{}Subject: {}"
+            "{}Body: {}"
+            "{}Attachments: {}".format(
+                indentation,
+                self.server,
+                self.port,
+                indentation,
+                self.from_,
+                indentation,
+                self.cc,
+                indentation,
+                self.bcc,
+                indentation,
+                self.subject,
+                indentation,
+                reprlib.repr(self.body),
+                indentation,
+                self.attachments,
+            )
+        )
 
 
-    async def send_async(self):
-        """Send the message asynchronously."""
-        self._construct_message()
+class _Account:
+    """Sender Email, quota window and block of one SenderPool account."""
 
-        if self.port in (465, "465"):
-            await aiosmtplib.send(
-                message=self.message,
-                hostname=self.server,
-                port=self.port,
-                username=self.from_,
-                password=self._auth,
-                use_tls=True,
-                )
-        elif self.port in (587, "587"):
-            await aiosmtplib.send(
-                message=self.message,
-                hostname=self.server,
-                port=self.port,
-                username=self.from_,
-                password=self._auth,
-                start_tls=True,
-                )
+    DAY = 24 * 60 * 60
+
+    def __init__(self, sender, limit):
+        self.sender = sender
+        self.limit = limit
+        self.sent = 0
+        self.window = time.time()
+        self.blocked_until = 0
 
+    def available(self):
+        """Return True if the account may send now."""
+        now = time.time()
+        if now - self.window >= self.DAY:
+            self.window, self.sent = now, 0
+        if now < self.blocked_until:
+            return False
+        return self.limit is None or self.sent < self.limit
+
+    def block(self, state, cooldown):
+        """Skip the account for cooldown seconds, or the day if exhausted."""
+        if state == "exhausted":
+            self.blocked_until = self.window + self.DAY
+        else:
+            self.blocked_until = time.time() + cooldown
+
+    def usage(self):
+        return AccountUsage(
+            self.sender.from_, self.sent, self.limit, self.blocked_until
+        )
+
+
+class SenderPool:
+    """
+    Send many Emails through several accounts, i.e. a few gmail.com
+    addresses, so throughput grows with the number of accounts.
+
+    Each account sends from its own thread and session, pulling messages
+    from a shared queue.  It counts the messages it sent against its daily
+    quota, and is skipped for cooldown seconds when throttled (421, or a
+    4xx reply about rates or limits) or for the rest of its 24 hour window
+    when its quota is used up (i.e. '550 5.4.5').  A message an account
+    could not send because of that is handed to the other accounts.
+
+    Args:
+        :accounts: (list) dicts of the from_ and auth, and optionally the
+            server, port and daily_limit, of each account
+        :daily_limit: (int) messages per account per 24 hours, unless set
+            per account; None (the default) for no limit
+        :cooldown: (int) seconds a throttled account is skipped
+        :messages_per_session: (int) messages sent over one connection
+            before reconnecting, as providers throttle long sessions
+
+    Usage:
+        >>> pool = SenderPool([{'from_': 'a@gmail.com', 'auth': 'pw1'},
+        ...                    {'from_': 'b@gmail.com', 'auth': 'pw2'}],
+        ...                   daily_limit=500)
+        >>> results = pool.send(emails)
+
+    Note:
+        Messages are sent from the address of the account that sends them,
+        their own from_, server and auth are ignored (and left unchanged).
+        The counts are kept in memory, for the life of the pool.
+    """
+
+    def __init__(self, accounts, daily_limit=None, cooldown=300,
+                 messages_per_session=100):
+        self.cooldown = cooldown
+        self.messages_per_session = messages_per_session
+        self._accounts = []
+        for account in accounts:
+            account = dict(account)
+            limit = account.pop("daily_limit", daily_limit)
+            self._accounts.append(_Account(Email(**account), limit))
+
+    def usage(self):
+        """Return an AccountUsage per account."""
+        return [account.usage() for account in self._accounts]
+
+    def send(self, emails):
+        """
+        Send emails spread over the available accounts.  A failed message
+        does not abort the rest.  Returns a list of SendResult(email,
+        refused, error), one per message, in the order given; messages left
+        when every account is throttled or over quota fail with
+        MessageSendError.
+        """
+        emails = list(emails)
+        results = [None] * len(emails)
+        jobs = queue.Queue()
+        for i, e in enumerate(emails):
+            jobs.put((i, e, 1))
+
+        while not jobs.empty():
+            accounts = [a for a in self._accounts if a.available()]
+            if not accounts:
+                break
+            threads = [
+                threading.Thread(target=self._work, args=(a, jobs, results))
+                for a in accounts
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        while not jobs.empty():
+            i, e, _ = jobs.get()
+            error = MessageSendError(
+                "No account available: all are throttled or over quota"
+            )
+            results[i] = SendResult(e, {}, error)
+
+        sent = sum(1 for r in results if r.error is None)
+        print("{} of {} messages sent.".format(sent, len(emails)))
+        return results
+
+    def _work(self, account, jobs, results):
+        """Send queued messages through account while it is available."""
+        session, count = None, 0
+        try:
+            while account.available():
+                try:
+                    i, e, tries = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                # errors of the message itself (i.e. a missing attachment)
+                # are its own result, not a failure of the account
+                from_, e.from_ = e.from_, account.sender.from_
+                try:
+                    recipients, payload = e._prepare()
+                except Exception as exc:
+                    results[i] = SendResult(e, {}, exc)
+                    continue
+                finally:
+                    e.from_ = from_
+                try:
+                    if session is None:
+                        session, count = account.sender._get_session(), 0
+                    refused = send_chunked(
+                        lambda chunk: sendmail(
+                            session, account.sender.from_, chunk, payload
+                        ),
+                        recipients,
+                        e.rcpt_limit,
+                    )
+                except (MessageSendError, SMTPException, OSError) as exc:
+                    state = throttle_state(exc)
+                    if (
+                        state is None
+                        and isinstance(exc, SMTPException)
+                        and not is_disconnect(exc)
+                    ):
+                        if isinstance(exc, SMTPRecipientsRefused):
+                            results[i] = SendResult(e, exc.recipients, exc)
+                        else:
+                            results[i] = SendResult(e, {}, exc)
+                        continue
+                    # throttled, over quota, or unable to connect or log in
+                    account.block(state, self.cooldown)
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if tries < len(self._accounts):
+                        jobs.put((i, e, tries + 1))
+                    else:
+                        results[i] = SendResult(e, {}, exc)
+                except Exception as exc:
+                    # i.e. a body that fails while streamed, mid-DATA
+                    results[i] = SendResult(e, {}, exc)
+                    if session is not None:
+                        session.close()
+                        session = None
+                else:
+                    account.sent += 1
+                    results[i] = SendResult(e, refused, None)
+                    count += 1
+                    if count >= self.messages_per_session:
+                        close_session(session)
+                        session = None
+        finally:
+            if session is not None:
+                close_session(session)
@@ -22,6 +22,7 @@ import reprlib
 import httpx
 
 from ._exceptions import MessageSendError
+from ._http import HTTP_CLIENTS
 from ._interface import Message
 from ._utils import credential_property
 from ._utils import validate_property
@@ -65,10 +66,15 @@ class Slack(Message):
                 "\n{} Message created.".format(timestamp())
             )
 
-        if encoding == "json":
-            resp = httpx.post(self.url, json=self.message)
-        elif encoding == "url":
-            resp = httpx.post(self.url, data=self.message)
+        try:
+            client = HTTP_CLIENTS.get(self.url)
+            if encoding == "json":
+                resp = client.post(self.url, json=self.message)
+            elif encoding == "url":
+                resp = client.post(self.url, data=self.message)
+        finally:
+            if self.lean:
+                self.release()
 
         try:
             resp.raise_for_status()
@@ -97,12 +103,16 @@ class Slack(Message):
         self._construct_message()
 
         try:
-            async with httpx.AsyncClient() as client:
-                if encoding == "json":
-                    resp = await client.post(self.url, json=self.message)
-                elif encoding == "url":
-                    resp = await client.post(self.url, data=self.message)
+            client = HTTP_CLIENTS.get_async(self.url)
+            if encoding == "json":
+                resp = await client.post(self.url, json=self.message)
+            elif encoding == "url":
+                resp = await client.post(self.url, data=self.message)
+        finally:
+            if self.lean:
+                self.release()
 
+        try:
             resp.raise_for_status()
             if resp.status_code >= 300:
                 raise MessageSendError("HTTP Redirect: Possibly Invalid authentication")
@@ -126,6 +136,7 @@ class SlackWebhook(Slack):
         :params: (dict) additional attributes to add to each attachment,
             i.e. author_name, title, text, etc., see API for information
             on which attributes are possible.
+        :lean: (bool) drop the built message after every send
 
     Attributes:
         :message: (dict) current form of the message to be constructed
@@ -155,6 +166,7 @@ class SlackWebhook(Slack):
         attachments=None,
         params=None,
         verbose=False,
+        lean=False,
     ):
 
         self.from_ = from_
@@ -164,6 +176,7 @@ class SlackWebhook(Slack):
         self.attachments = attachments or []
         self.params = params
         self.verbose = verbose
+        self.lean = lean
         self.message = {}
         self.url = self._auth
 
@@ -205,6 +218,7 @@ class SlackPost(Slack):
         :params: (dict) additional attributes to add to each attachment,
             i.e. author_name, title, text, etc., see API for information
             on which attributes are possible.
+        :lean: (bool) drop the built message after every send
 
     Attributes:
         :message: (dict) current form of the message to be constructed
@@ -237,6 +251,7 @@ class SlackPost(Slack):
         attachments=None,
         params=None,
         verbose=False,
+        lean=False,
     ):
 
         self.from_ = from_
@@ -247,6 +262,7 @@ class SlackPost(Slack):
         self.attachments = attachments or []
         self.params = params
         self.verbose = verbose
+        self.lean = lean
         self.url = "https://slack.com/api/chat.postMessage"
 
     def __str__(self, indentation="\n"):
@@ -11,6 +11,7 @@ import reprlib
 import httpx
 
 from ._exceptions import MessageSendError
+from ._http import HTTP_CLIENTS
 from ._interface import Message
 from ._utils import credential_property
 from ._utils import validate_property
@@ -37,6 +38,7 @@ class TelegramBot(Message):
         :params: (dict) additional attributes to add to message,
             i.e. parse_mode (HTML or Markdown, see API for information
             on which attributes are possible.
+        :lean: (bool) drop the built message after every send
 
     Attributes:
         :message: (dict) current form of the message to be constructed
@@ -68,6 +70,7 @@ class TelegramBot(Message):
         attachments=None,
         params=None,
         verbose=False,
+        lean=False,
     ):
 
         self.from_ = from_
@@ -79,6 +82,7 @@ class TelegramBot(Message):
         self.attachments = attachments or []
         self.params = params or {}
         self.verbose = verbose
+        self.lean = lean
         self.message = {}
         self.base_url = "https://api.telegram.org/bot" + self._auth
 
@@ -111,7 +115,8 @@ class TelegramBot(Message):
     def get_chat_id(self, username):
         """Lookup chat_id of username if chat_id is unknown via API call."""
         if username is not None:
-            chats = httpx.get(self.base_url + "/getUpdates").json()
+            url = self.base_url + "/getUpdates"
+            chats = HTTP_CLIENTS.get(url).get(url).json()
             user = username.split("@")[-1]
             for chat in chats["result"]:
                 if chat["message"]["from"]["username"] == user:
@@ -134,7 +139,7 @@ class TelegramBot(Message):
         url = self.base_url + method
 
         try:
-            resp = httpx.post(url, json=self.message)
+            resp = HTTP_CLIENTS.get(url).post(url, json=self.message)
             resp.raise_for_status()
         except httpx.HTTPStatusError as e:
             exc = "{}".format(e)
@@ -158,14 +163,18 @@ class TelegramBot(Message):
                 "\n{} Message created.".format(timestamp())
             )
 
-        self._send_content("/sendMessage")
-
-        if self.attachments:
-            if isinstance(self.attachments, str):
-                self.attachments = [self.attachments]
-            for a in self.attachments:
-                self.message["document"] = a
-                self._send_content(method="/sendDocument")
+        try:
+            self._send_content("/sendMessage")
+
+            if self.attachments:
+                if isinstance(self.attachments, str):
+                    self.attachments = [self.attachments]
+                for a in self.attachments:
+                    self.message["document"] = a
+                    self._send_content(method="/sendDocument")
+        finally:
+            if self.lean:
+                self.release()
 
         if self.verbose:
             print(
@@ -181,8 +190,8 @@ class TelegramBot(Message):
         url = self.base_url + method
 
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(url, json=self.message)
+            client = HTTP_CLIENTS.get_async(url)
+            resp = await client.post(url, json=self.message)
             resp.raise_for_status()
         except httpx.HTTPStatusError as e:
             exc = "{}".format(e)
@@ -192,11 +201,15 @@ class TelegramBot(Message):
         """Start sending the message and attachments."""
         self._construct_message()
 
-        await self._send_content_async("/sendMessage")
-
-        if self.attachments:
-            if isinstance(self.attachments, str):
-                self.attachments = [self.attachments]
-            for a in self.attachments:
-                self.message["document"] = a
-                await self._send_content_async(method="/sendDocument")
+        try:
+            await self._send_content_async("/sendMessage")
+
+            if self.attachments:
+                if isinstance(self.attachments, str):
+                    self.attachments = [self.attachments]
+                for a in self.attachments:
+                    self.message["document"] = a
+                    await self._send_content_async(method="/sendDocument")
+        finally:
+            if self.lean:
+                self.release()
@@ -13,6 +13,7 @@ import reprlib
 import httpx
 
 from ._exceptions import MessageSendError
+from ._http import HTTP_CLIENTS
 from ._interface import Message
 from ._utils import credential_property
 from ._utils import validate_property
@@ -125,7 +126,9 @@ class Twilio(Message):
         """
         self._construct_message()
         try:
-            resp = httpx.post(self.url, data=self.data, auth=(self._auth[0], self._auth[1]))
+            resp = HTTP_CLIENTS.get(self.url).post(
+                self.url, data=self.data, auth=(self._auth[0], self._auth[1])
+            )
             resp.raise_for_status()
         except httpx.HTTPStatusError as e:
             exc = "{}".format(e)
@@ -154,8 +157,13 @@ class Twilio(Message):
         """
         self._construct_message()
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                resp = await client.post(self.url, data=self.data, auth=(self._auth[0], self._auth[1]))
+            client = HTTP_CLIENTS.get_async(self.url)
+            resp = await client.post(
+                self.url,
+                data=self.data,
+                auth=(self._auth[0], self._auth[1]),
+                timeout=None,
+            )
             resp.raise_for_status()
         except httpx.HTTPStatusError as e:
             exc = "{}".format(e)
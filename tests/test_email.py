@@ -1,16 +1,32 @@
 """messages.email_ tests."""
 
 import asyncio
+import itertools
 import pathlib
 import smtplib
+import sys
+import threading
+import time
 from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPSenderRefused
 from email.mime.multipart import MIMEMultipart
 
+import aiosmtplib
 import pytest
 
 import messages
 from messages.email_ import Email
+from messages.email_ import EmailTemplate
+from messages.email_ import SenderPool
+from messages._exceptions import InvalidMessageInputError
 from messages._exceptions import MessageSendError
+from messages._mime import Payload
+from messages._mime import ensure_boundary
+from messages._smtp import AsyncSMTPPool
+from messages._smtp import SMTPSessionPool
+from messages._smtp import ServerProfile
+from messages._smtp import ServerProfileCache
 
 from conftest import AsyncMock
 from conftest import skip_if_on_travisCI
@@ -125,6 +141,34 @@ def test_get_server_noAddress(get_email):
     assert server == (None, None)
 
 
+def test_get_server_discovered(mocker):
+    """
+    GIVEN a server profile found by an earlier discovery
+    WHEN get_server() is called for that domain
+    THEN assert the discovered port is returned
+    """
+    cache = ServerProfileCache()
+    mocker.patch.object(messages.email_, 'SERVER_PROFILES', cache)
+    cache.put(ServerProfile('smtp.test.com', 587, 'starttls', [], True, 0,
+                            True, time.time()))
+    assert Email.get_server('me@test.com') == ('smtp.test.com', 587)
+
+
+def test_init_no_disk_reads(tmp_path, mocker):
+    """
+    GIVEN a server profile cache saved to disk
+    WHEN many Emails are constructed for a domain it does not know
+    THEN assert the constructor never reads the file
+    """
+    cache = ServerProfileCache(path=str(tmp_path.joinpath('profiles.json')))
+    mocker.patch.object(messages.email_, 'SERVER_PROFILES', cache)
+    load_spy = mocker.spy(cache, '_load')
+    for _ in range(1000):
+        e = Email(from_='me@test.com', to='you@there.com', auth='p')
+    assert (e.server, e.port) == ('smtp.test.com', 465)
+    assert load_spy.call_count == 0
+
+
 ##############################################################################
 # TESTS: Email.list_to_string
 ##############################################################################
@@ -161,6 +205,95 @@ def test_construct_message(get_email, mocker):
     assert attach_mock.call_count == 1
 
 
+def test_construct_message_unchanged(get_email, mocker):
+    """
+    GIVEN an Email whose message has been constructed
+    WHEN Email._construct_message() is called again without changes
+    THEN assert nothing is rebuilt and the rendered payload is reused
+    """
+    e = get_email
+    e.attachments = [str(TESTDIR.joinpath('file1.txt'))]
+    e._construct_message()
+    payload = e._payload
+    header_mock = mocker.patch.object(Email, '_add_header')
+    body_mock = mocker.patch.object(Email, '_add_body')
+    attach_mock = mocker.patch.object(Email, '_add_attachments')
+    e._construct_message()
+    assert e._payload is payload
+    assert header_mock.call_count + body_mock.call_count + attach_mock.call_count == 0
+
+
+def test_construct_message_incremental(get_email, mocker):
+    """
+    GIVEN an Email whose message has been constructed
+    WHEN the subject is set and a recipient appended in place
+    THEN assert only the headers are rebuilt and the output matches a fresh
+        build
+    """
+    e = get_email
+    e.attachments = [str(TESTDIR.joinpath('file1.txt'))]
+    e._construct_message()
+    body_part = e._body_part
+    attach_mock = mocker.spy(Email, '_add_attachments')
+    e.subject = 'new subject'
+    e.to = ['you@there.com']
+    e._construct_message()
+    e.to.append('her@there.com')
+    e._construct_message()
+    assert attach_mock.call_count == 0
+    assert e.message.get_payload()[0] is body_part
+
+    fresh = Email(from_='me@here.com', to=['you@there.com', 'her@there.com'],
+                  server='smtp.gmail.com', port=465, auth='password',
+                  cc='someone@there.com', bcc=['them@there.com'],
+                  subject='new subject', body='message',
+                  attachments=[str(TESTDIR.joinpath('file1.txt'))])
+    fresh._construct_message()
+    fresh.message.set_boundary(ensure_boundary(e.message))
+    assert bytes(e._payload) == bytes(fresh._payload)
+
+
+def test_construct_message_body_and_file(get_email, tmp_path):
+    """
+    GIVEN an Email whose message has been constructed
+    WHEN the body is set and an attached file modified
+    THEN assert both parts are rebuilt
+    """
+    path = tmp_path.joinpath('notes.txt')
+    path.write_text('first version')
+    e = get_email
+    e.attachments = [str(path)]
+    e._construct_message()
+    e.body = 'new message'
+    path.write_text('second, longer version')
+    e._construct_message()
+    body, doc = e.message.get_payload()
+    assert body.get_payload() == 'new message'
+    assert doc.get_payload(decode=True) == b'second, longer version'
+    assert doc.size == len(b'second, longer version')
+
+
+def test_construct_message_failure(get_email, tmp_path):
+    """
+    GIVEN an Email whose attachment is missing on the first build
+    WHEN the file appears and the subject changes before the next build
+    THEN assert no half-built message is kept and the retry attaches it
+    """
+    path = tmp_path.joinpath('notes.txt')
+    e = get_email
+    e.attachments = [str(path)]
+    with pytest.raises(FileNotFoundError):
+        e._construct_message()
+    assert e.message is None
+    path.write_text('notes')
+    e.subject = 'retry'
+    e._construct_message()
+    body, doc = e.message.get_payload()
+    assert e.message['Subject'] == 'retry'
+    assert doc.get_payload(decode=True) == b'notes'
+    assert b'notes' in bytes(e._payload)
+
+
 ##############################################################################
 # TESTS: Email._add_header
 ##############################################################################
@@ -179,6 +312,41 @@ def test_add_header(get_email, mocker):
     assert e.message['Subject'] == 'subject'
 
 
+def test_add_header_no_bcc(get_email):
+    """
+    GIVEN a valid Email object with bcc recipients
+    WHEN the message is constructed
+    THEN assert they are envelope recipients only, never in the headers
+    """
+    e = get_email
+    e.attachments = None
+    recipients, payload = e._prepare()
+    assert 'them@there.com' in recipients
+    assert e.message['Bcc'] is None
+    assert b'them@there.com' not in bytes(payload)
+
+
+def test_recipients_iterators(get_email):
+    """
+    GIVEN an Email whose to and bcc are generators
+    WHEN the message is constructed and its recipients read
+    THEN assert to is listed for the headers and bcc read lazily, validated
+    """
+    e = get_email
+    e.attachments = None
+    e.to = (a for a in ['you@there.com', 'her@there.com'])
+    e.bcc = (a for a in ['them@there.com', 'not an address'])
+    e._construct_message()
+    assert e.to == ['you@there.com', 'her@there.com']
+    assert e.message['To'] == 'you@there.com, her@there.com'
+    recipients = e._get_recipients()
+    assert not isinstance(recipients, list)
+    assert [next(recipients) for _ in range(4)] == [
+        'you@there.com', 'her@there.com', 'someone@there.com', 'them@there.com']
+    with pytest.raises(InvalidMessageInputError):
+        next(recipients)
+
+
 ##############################################################################
 # TESTS: Email._add_body
 ##############################################################################
@@ -197,6 +365,23 @@ def test_add_body(get_email, mocker):
     assert mime_attach_mock.call_count == 1
 
 
+def test_add_body_stream(get_email, tmp_path):
+    """
+    GIVEN an Email whose body is a path
+    WHEN the message is constructed
+    THEN assert the body is a TextStream of the file
+    """
+    path = tmp_path.joinpath('report.txt')
+    path.write_text('report\n')
+    e = get_email
+    e.attachments = None
+    e.body = path
+    e._construct_message()
+    part = e.message.get_payload()[0]
+    assert isinstance(part, messages._mime.TextStream)
+    assert part.get_payload(decode=True) == b'report\n'
+
+
 ##############################################################################
 # TESTS: Email._add_attachments
 ##############################################################################
@@ -273,6 +458,52 @@ def test_add_attachments_str_travis(get_email, mocker):
     assert mime_attach_mock.call_count == 1
 
 
+def test_add_attachments_in_memory(get_email, tmp_path):
+    """
+    GIVEN an Email with a (filename, bytes) attachment and a file path
+    WHEN Email._add_attachments() is called
+    THEN assert the in-memory data is attached under its filename
+    """
+    e = get_email
+    e.attachments = [('report.csv', b'a,b\n1,2\n'),
+                     str(TESTDIR.joinpath('file1.txt'))]
+    e.message = MIMEMultipart()
+    assert e._add_attachments() == 2
+    report, text = e.message.get_payload()
+    assert report.get_filename() == 'report.csv'
+    assert report.get_payload(decode=True) == b'a,b\n1,2\n'
+    assert text.get_filename().endswith('file1.txt')
+
+
+def test_add_attachments_single_tuple(get_email):
+    """
+    GIVEN an Email whose attachments is a single (filename, data) tuple
+    WHEN Email._add_attachments() is called
+    THEN assert it is wrapped in a list like a single path
+    """
+    e = get_email
+    e.attachments = ('report.csv', memoryview(b'a,b\n'))
+    e.message = MIMEMultipart()
+    assert e._add_attachments() == 1
+    assert e.attachments == [('report.csv', e.attachments[0][1])]
+
+
+def test_add_attachments_compress(get_email):
+    """
+    GIVEN an Email with a large attachment and compress='zip'
+    WHEN the message is constructed, and again after compress is unset
+    THEN assert the attachment is zipped, then rebuilt uncompressed
+    """
+    e = get_email
+    e.attachments = [('report.csv', b'a,b\n' * 50000)]
+    e.compress = 'zip'
+    e._construct_message()
+    assert e.message.get_payload()[1].get_filename() == 'report.csv.zip'
+    e.compress = None
+    e._construct_message()
+    assert e.message.get_payload()[1].get_filename() == 'report.csv'
+
+
 ##############################################################################
 # TESTS: Email._get_session
 ##############################################################################
@@ -329,6 +560,164 @@ def test_get_session_tls_raisesMessSendErr(get_email, mocker):
         e._get_session()
 
 
+def test_get_session_discovers_port(mocker):
+    """
+    GIVEN an Email for an unknown domain and no port
+    WHEN Email._get_session() is called
+    THEN assert the server is probed and the session opened on the found port
+    """
+    cache = ServerProfileCache()
+    mocker.patch.object(messages.email_, 'SERVER_PROFILES', cache)
+    profile = ServerProfile('smtp.test.com', 25, 'starttls', [], False, 0,
+                            False, time.time())
+    probe_mock = mocker.patch.object(messages._smtp, 'probe',
+                                     side_effect=[None, None, profile])
+    tls_mock = mocker.patch.object(Email, '_get_tls')
+    e = Email(from_='me@test.com', to='you@there.com', auth='password')
+    assert e.port == 465
+    e._get_session()
+    assert e.port == 25
+    assert tls_mock.call_count == 1
+    assert probe_mock.call_count == 3
+    e._get_session()
+    assert probe_mock.call_count == 3
+
+
+def test_get_session_refuses_plain(mocker):
+    """
+    GIVEN an unknown server that only answers without TLS (i.e. port 25
+        with STARTTLS missing or stripped)
+    WHEN Email._get_session() is called
+    THEN assert MessageSendError is raised without logging in, and the
+        plain profile is not cached
+    """
+    cache = ServerProfileCache()
+    mocker.patch.object(messages.email_, 'SERVER_PROFILES', cache)
+    profile = ServerProfile('smtp.test.com', 25, 'plain', [], False, 0, False,
+                            time.time())
+    mocker.patch.object(messages._smtp, 'probe',
+                        side_effect=lambda server, port, *a: profile
+                        if port == 25 else None)
+    smtp_mock = mocker.patch('smtplib.SMTP')
+    e = Email(from_='me@test.com', to='you@there.com', auth='password')
+    with pytest.raises(MessageSendError):
+        e._get_session()
+    assert smtp_mock.return_value.login.call_count == 0
+    assert cache.get('smtp.test.com') is None
+
+    cache.put(profile)
+    e = Email(from_='me@test.com', to='you@there.com', auth='password',
+              port=25)
+    with pytest.raises(MessageSendError):
+        e._get_session()
+    assert smtp_mock.return_value.login.call_count == 0
+
+
+def test_get_session_no_server(mocker):
+    """
+    GIVEN an Email with a port nothing answers on
+    WHEN Email._get_session() is called
+    THEN assert MessageSendError is raised
+    """
+    mocker.patch.object(messages.email_, 'SERVER_PROFILES', ServerProfileCache())
+    mocker.patch.object(messages._smtp, 'probe', return_value=None)
+    e = Email(from_='me@test.com', to='you@there.com', auth='password',
+              port=2525)
+    with pytest.raises(MessageSendError):
+        e._get_session()
+
+
+def test_get_session_local(mocker):
+    """
+    GIVEN an Email with transport='local'
+    WHEN Email._get_session() is called
+    THEN assert the local MTA is used without TLS or login
+    """
+    mocker.patch.object(messages._smtp.TRANSPORTS, 'local', ('mta', 2525))
+    smtp_mock = mocker.patch('smtplib.SMTP')
+    e = Email(from_='me@here.com', to='you@there.com', auth='password',
+              transport='local')
+    session = e._get_session()
+    smtp_mock.assert_called_once_with('mta', 2525)
+    assert session.login.call_count == 0
+    assert session.starttls.call_count == 0
+    assert e._session_key() == ('local', 'me@here.com')
+
+
+def test_get_session_lmtp(mocker):
+    """
+    GIVEN an Email and LMTP as the default transport
+    WHEN Email._get_session() is called
+    THEN assert an LMTP session is opened on the configured socket
+    """
+    mocker.patch.object(messages._smtp.TRANSPORTS, 'default', 'lmtp')
+    lmtp_mock = mocker.patch('smtplib.LMTP')
+    e = Email(from_='me@here.com', to='you@there.com', auth='password')
+    e._get_session()
+    lmtp_mock.assert_called_once_with('/var/run/dovecot/lmtp', 24)
+    assert lmtp_mock.return_value.login.call_count == 0
+
+
+def test_get_session_sendmail(get_email):
+    """
+    GIVEN an Email with transport='sendmail'
+    WHEN Email._get_session() is called
+    THEN assert a SendmailCommand is returned
+    """
+    e = get_email
+    e.transport = 'sendmail'
+    session = e._get_session()
+    assert isinstance(session, messages._smtp.SendmailCommand)
+    assert session.command == ['/usr/sbin/sendmail', '-i']
+
+
+def test_send_mx(get_email, mocker):
+    """
+    GIVEN an Email with transport='mx' and recipients at two domains
+    WHEN Email.send() is called
+    THEN assert each domain's mail exchanger gets its recipients directly,
+        over opportunistic TLS and without login
+    """
+    mocker.patch.object(messages._smtp, 'MX_RESOLVER', messages._smtp.MXResolver(
+        lambda domain: ([(10, 'mx.' + domain)], 60)))
+    smtp_mock = mocker.patch('smtplib.SMTP')
+    send_mock = mocker.patch('messages.email_.sendmail', return_value={})
+    e = get_email
+    e.transport = 'mx'
+    e.to, e.cc, e.bcc = 'you@there.com', 'him@else.org', 'her@there.com'
+    e.attachments = None
+    e.send()
+    hosts = sorted(c[0] for c in smtp_mock.call_args_list)
+    assert hosts == [('mx.else.org', 25), ('mx.there.com', 25)]
+    envelopes = sorted(c[0][2] for c in send_mock.call_args_list)
+    assert envelopes == [['him@else.org'], ['you@there.com', 'her@there.com']]
+    assert smtp_mock.return_value.starttls.call_count == 2
+    assert smtp_mock.return_value.login.call_count == 0
+    assert e._session_key() == ('mx', 'me@here.com')
+
+
+def test_send_lean(get_email, mocker):
+    """
+    GIVEN an Email with lean=True
+    WHEN Email.send() is called
+    THEN assert the built message is released once it is sent, and built
+        again on the next send
+    """
+    mocker.patch.object(Email, '_get_session')
+    send_mock = mocker.patch('messages.email_.sendmail', return_value={})
+    e = get_email
+    e.attachments = None
+    e.lean = True
+    built = sys.getsizeof(e)
+    e.send()
+    assert e.message is None and e._payload is None
+    assert e._attachment_parts == [] and e._built == {}
+    assert sys.getsizeof(e) <= built
+    e.send()
+    assert send_mock.call_count == 2
+    assert b''.join(send_mock.call_args[0][3]).endswith(b'--\r\n')
+
+
 ##############################################################################
 # TESTS: Email._get_ssl
 ##############################################################################
@@ -402,6 +791,7 @@ def test_send(get_email, capsys, mocker):
     body_mock = mocker.patch.object(Email, '_add_body')
     attach_mock = mocker.patch.object(Email, '_add_attachments')
     session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail')
     e = get_email
     e.send()
     out, err = capsys.readouterr()
@@ -421,6 +811,7 @@ def test_send_verbose_true(get_email, capsys, mocker):
     body_mock = mocker.patch.object(Email, '_add_body')
     attach_mock = mocker.patch.object(Email, '_add_attachments')
     session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail')
     e = get_email
     e.verbose = True
     e.send()
@@ -453,6 +844,7 @@ def test_send_verbose_false(get_email, capsys, mocker):
     body_mock = mocker.patch.object(Email, '_add_body')
     attach_mock = mocker.patch.object(Email, '_add_attachments')
     session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail')
     e = get_email
     e.verbose = False
     e.send()
@@ -468,31 +860,484 @@ def test_send_verbose_false(get_email, capsys, mocker):
     assert err == ''
 
 
+def test_send_pooled(get_email, capsys, mocker):
+    """
+    GIVEN a valid Email object with pooled=True
+    WHEN Email.send() is called twice
+    THEN assert the session is logged in once, reused and never QUIT
+    """
+    header_mock = mocker.patch.object(Email, '_add_header')
+    body_mock = mocker.patch.object(Email, '_add_body')
+    attach_mock = mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    session_mock.return_value.noop.return_value = (250, b'OK')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail')
+    pool = SMTPSessionPool()
+    mocker.patch.object(messages.email_, 'SMTP_POOL', pool)
+    e = get_email
+    e.pooled = True
+    e.send()
+    e.send()
+    out, err = capsys.readouterr()
+    assert out == 'Message sent.\nMessage sent.\n'
+    assert session_mock.call_count == 1
+    assert sendmail_mock.call_count == 2
+    assert session_mock.return_value.quit.call_count == 0
+
+
+def test_send_rcpt_limit(get_email, capsys, mocker):
+    """
+    GIVEN a valid Email object with more recipients than rcpt_limit
+    WHEN Email.send() is called and some recipients are refused
+    THEN assert one transaction per chunk and the refusals are reported
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    refused = {'user3@there.com': (550, b'no such user')}
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail',
+                                        side_effect=[{}, refused, {}])
+    e = get_email
+    e.to = ['user{}@there.com'.format(i) for i in range(10)]
+    e.rcpt_limit = 5
+    e.send()
+    out, err = capsys.readouterr()
+    assert [len(c[0][2]) for c in sendmail_mock.call_args_list] == [5, 5, 2]
+    assert session_mock.call_count == 1
+    assert e.refused == refused
+    assert out == 'Message sent.\n1 recipients refused.\n'
+
+
+def test_send_bcc_iterator_invalid(get_email, capsys, mocker):
+    """
+    GIVEN an Email whose bcc generator has an invalid address past the
+        first rcpt_limit chunk
+    WHEN Email.send() is called
+    THEN assert every valid address is sent to and the invalid one is
+        refused with 553 instead of aborting the send
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail',
+                                        return_value={})
+    e = get_email
+    e.rcpt_limit = 5
+    e.bcc = itertools.chain(
+        ('user{}@there.com'.format(i) for i in range(8)), ['not an address'])
+    e.send()
+    out, err = capsys.readouterr()
+    sent = [r for c in sendmail_mock.call_args_list for r in c[0][2]]
+    assert len(sent) == 10
+    assert 'not an address' not in sent
+    assert e.refused == {'not an address': messages.email_.INVALID_ADDRESS}
+    assert session_mock.return_value.quit.call_count == 1
+    assert out == 'Message sent.\n1 recipients refused.\n'
+
+
+def test_send_closes_session_on_error(get_email, mocker):
+    """
+    GIVEN a valid Email object
+    WHEN Email.send() is called and the transaction fails
+    THEN assert the session is still closed
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    mocker.patch.object(messages.email_, 'sendmail',
+                        side_effect=smtplib.SMTPDataError(554, b'rejected'))
+    e = get_email
+    with pytest.raises(smtplib.SMTPDataError):
+        e.send()
+    assert session_mock.return_value.quit.call_count == 1
+
+
+def test_send_pooled_verbose_true(get_email, capsys, mocker):
+    """
+    GIVEN a valid Email object with pooled=True
+    WHEN Email.send() is called with the verbose flag set to True
+    THEN assert the session is reported as returned to the pool
+    """
+    header_mock = mocker.patch.object(Email, '_add_header')
+    body_mock = mocker.patch.object(Email, '_add_body')
+    attach_mock = mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail')
+    mocker.patch.object(messages.email_, 'SMTP_POOL', SMTPSessionPool())
+    e = get_email
+    e.pooled = True
+    e.verbose = True
+    e.send()
+    out, err = capsys.readouterr()
+    assert 'Session returned to pool.' in out
+    assert 'Logged out.' not in out
+    assert 'Message sent.' in out
+
+
+##############################################################################
+# TESTS: Email.send_many
+##############################################################################
+
+def test_send_many(get_email, capsys, mocker):
+    """
+    GIVEN several valid Email objects, two sharing an account
+    WHEN Email.send_many() is called
+    THEN assert one session is used per account and results keep input order
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail',
+                                        return_value={})
+    e1 = get_email
+    e2 = Email(from_='other@here.com', to='you@there.com', server='smtp.gmail.com',
+               port=465, auth='password', body='message')
+    e3 = Email(from_='me@here.com', to='her@there.com', server='smtp.gmail.com',
+               port=465, auth='password', body='message')
+    results = Email.send_many([e1, e2, e3])
+    out, err = capsys.readouterr()
+    assert [r.email for r in results] == [e1, e2, e3]
+    assert all(r.error is None and r.refused == {} for r in results)
+    assert session_mock.call_count == 2
+    assert sendmail_mock.call_count == 3
+    assert session_mock.return_value.quit.call_count == 2
+    assert out == '3 of 3 messages sent.\n'
+
+
+@pytest.mark.parametrize('transport', ['local', 'mx'])
+def test_send_many_keeps_senders(transport, capsys, mocker):
+    """
+    GIVEN Emails from different senders over a transport without login
+    WHEN Email.send_many() is called
+    THEN assert each message is sent with its own envelope sender
+    """
+    mocker.patch.object(Email, '_get_session')
+    mocker.patch.object(messages._smtp, 'MX_RESOLVER', messages._smtp.MXResolver(
+        lambda domain: ([(10, 'mx.' + domain)], 60)))
+    mocker.patch('smtplib.SMTP')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail',
+                                        return_value={})
+    emails = [Email(from_=sender, to='you@there.com', body='message',
+                    transport=transport)
+              for sender in ('a@x.com', 'b@x.com')]
+    Email.send_many(emails)
+    assert [c[0][1] for c in sendmail_mock.call_args_list] == ['a@x.com', 'b@x.com']
+
+
+def test_send_many_partial_failure(get_email, capsys, mocker):
+    """
+    GIVEN several valid Email objects sharing an account
+    WHEN one message has every recipient refused
+    THEN assert the batch continues and the failure is reported per message
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    refused = {'you@there.com': (550, b'no such user')}
+    sendmail_mock = mocker.patch.object(
+        messages.email_, 'sendmail',
+        side_effect=[SMTPRecipientsRefused(refused), {}])
+    e1 = get_email
+    e2 = Email(from_='me@here.com', to='her@there.com', server='smtp.gmail.com',
+               port=465, auth='password', body='message')
+    results = Email.send_many([e1, e2])
+    out, err = capsys.readouterr()
+    assert results[0].refused == refused
+    assert isinstance(results[0].error, SMTPRecipientsRefused)
+    assert results[1].error is None
+    assert session_mock.call_count == 1
+    assert out == '1 of 2 messages sent.\n'
+
+
+def test_send_many_reconnects(get_email, capsys, mocker):
+    """
+    GIVEN several valid Email objects sharing an account
+    WHEN the server drops the connection
+    THEN assert the session is replaced and the message retried once
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(
+        messages.email_, 'sendmail',
+        side_effect=[smtplib.SMTPServerDisconnected(), {}])
+    results = Email.send_many([get_email])
+    assert results[0].error is None
+    assert session_mock.call_count == 2
+    assert sendmail_mock.call_count == 2
+
+
+def test_send_many_login_failure(get_email, capsys, mocker):
+    """
+    GIVEN several valid Email objects sharing an account
+    WHEN login fails
+    THEN assert every message of that account reports the error
+    """
+    mocker.patch.object(Email, '_add_attachments')
+    session_mock = mocker.patch.object(Email, '_get_session',
+                                       side_effect=MessageSendError('bad auth'))
+    e2 = Email(from_='me@here.com', to='her@there.com', server='smtp.gmail.com',
+               port=465, auth='password', body='message')
+    results = Email.send_many([get_email, e2])
+    assert all(isinstance(r.error, MessageSendError) for r in results)
+    assert session_mock.call_count == 1
+
+
+##############################################################################
+# TESTS: Email.render & Email.render_many
+##############################################################################
+
+def test_render(tmp_path):
+    """
+    GIVEN an Email
+    WHEN Email.render() is called with and without a path
+    THEN assert the same wire bytes are returned and written to the file
+    """
+    e = Email(from_='me@here.com', to='you@there.com', subject='subject',
+              body='message')
+    data = e.render()
+    assert data.startswith(b'Content-Type: multipart/mixed')
+    assert e.render(str(tmp_path.joinpath('e.eml'))) == len(data)
+    assert tmp_path.joinpath('e.eml').read_bytes() == data
+
+
+def test_render_many_directory(tmp_path, capsys):
+    """
+    GIVEN a stream of Email arguments
+    WHEN Email.render_many() is called with a directory
+    THEN assert one .eml file is written per message and the rate reported
+    """
+    specs = ({'from_': 'me@here.com', 'to': 'you%d@there.com' % i,
+              'body': 'message'} for i in range(3))
+    stats = Email.render_many(specs, directory=str(tmp_path), processes=1)
+    assert stats.count == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        '000000.eml', '000001.eml', '000002.eml']
+    assert b'To: you2@there.com' in tmp_path.joinpath('000002.eml').read_bytes()
+    assert stats.bytes == sum(p.stat().st_size for p in tmp_path.iterdir())
+    assert '3 messages rendered' in capsys.readouterr().out
+
+
+def test_render_many_mbox(tmp_path):
+    """
+    GIVEN Emails whose body has a line starting with 'From '
+    WHEN Email.render_many() is called with an mbox path
+    THEN assert every message is appended with LF endings and quoted From lines
+    """
+    path = tmp_path.joinpath('box')
+    emails = [Email(from_='me@here.com', to='you@there.com',
+                    body='From here\n') for _ in range(2)]
+    Email.render_many(emails, mbox=str(path), processes=1)
+    data = path.read_bytes()
+    assert data.count(b'\nFrom me@here.com ') == 1
+    assert data.startswith(b'From me@here.com ')
+    assert b'\r' not in data
+    assert b'\n>From here\n' in data
+
+
+def test_render_many_raises():
+    """
+    GIVEN neither or both of directory and mbox
+    WHEN Email.render_many() is called
+    THEN assert ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        Email.render_many([])
+    with pytest.raises(ValueError):
+        Email.render_many([], directory='out', mbox='box')
+
+
+##############################################################################
+# TESTS: SenderPool
+##############################################################################
+
+def new_pool(**kwargs):
+    """Return a SenderPool of the accounts a@here.com and b@here.com."""
+    return SenderPool([{'from_': a + '@here.com', 'auth': 'password',
+                        'server': 'smtp.here.com', 'port': 465}
+                       for a in 'ab'], **kwargs)
+
+
+def new_emails(n):
+    """Return n Emails to send through a SenderPool."""
+    return [Email(to='you%d@there.com' % i, body='message') for i in range(n)]
+
+
+def test_sender_pool_quota(capsys, mocker):
+    """
+    GIVEN a SenderPool of two accounts with a daily limit of 3
+    WHEN 8 messages are sent
+    THEN assert 6 are sent, 3 per account, and the rest fail
+    """
+    mocker.patch.object(Email, '_get_session')
+    senders = []
+    mocker.patch.object(messages.email_, 'sendmail',
+                        side_effect=lambda s, f, r, p: senders.append(f) or {})
+    pool = new_pool(daily_limit=3)
+    results = pool.send(new_emails(8))
+    assert sorted(senders) == ['a@here.com'] * 3 + ['b@here.com'] * 3
+    assert [type(r.error) for r in results].count(MessageSendError) == 2
+    assert [u.sent for u in pool.usage()] == [3, 3]
+    assert capsys.readouterr().out == '6 of 8 messages sent.\n'
+
+
+def test_sender_pool_routes_around_throttling(capsys, mocker):
+    """
+    GIVEN a SenderPool whose first account is over quota
+    WHEN messages are sent
+    THEN assert that account is blocked for the day and the other sends all
+    """
+    mocker.patch.object(Email, '_get_session')
+    senders = []
+
+    def sendmail(session, from_, recipients, payload):
+        if from_ == 'a@here.com':
+            raise SMTPSenderRefused(550, b'5.4.5 Daily sending quota exceeded',
+                                    from_)
+        senders.append(from_)
+        return {}
+
+    mocker.patch.object(messages.email_, 'sendmail', side_effect=sendmail)
+    pool = new_pool(cooldown=60)
+    results = pool.send(new_emails(4))
+    assert all(r.error is None for r in results)
+    assert senders == ['b@here.com'] * 4
+    a, b = pool.usage()
+    assert a.blocked_until > time.time() + 3600
+    assert b.blocked_until == 0
+
+
+def test_sender_pool_bad_messages(capsys, mocker, tmp_path):
+    """
+    GIVEN a SenderPool and messages that cannot be built
+    WHEN they are sent with good ones
+    THEN assert each fails on its own without blocking an account, and the
+        from_ of the messages is left unchanged
+    """
+    mocker.patch.object(Email, '_get_session')
+    senders = []
+
+    def sendmail(session, from_, recipients, payload):
+        bytes(payload)
+        senders.append(from_)
+        return {}
+
+    mocker.patch.object(messages.email_, 'sendmail', side_effect=sendmail)
+    emails = new_emails(2)
+    missing = Email(from_='me@there.com', to='you@there.com', body='message',
+                    attachments=str(tmp_path.joinpath('missing.txt')))
+    wrong = Email(to='you@there.com', body='message')
+    wrong.__dict__['body'] = 123
+    pool = new_pool(cooldown=60)
+    results = pool.send(emails + [missing, wrong])
+    assert [r.error is None for r in results] == [True, True, False, False]
+    assert isinstance(results[2].error, FileNotFoundError)
+    assert isinstance(results[3].error, TypeError)
+    assert len(senders) == 2
+    assert [u.blocked_until for u in pool.usage()] == [0, 0]
+    assert missing.from_ == 'me@there.com'
+    assert capsys.readouterr().out == '2 of 4 messages sent.\n'
+
+
+##############################################################################
+# TESTS: EmailTemplate
+##############################################################################
+
+@pytest.fixture()
+def get_template():
+    """Return a valid EmailTemplate object."""
+    return EmailTemplate(from_='me@here.com', server='smtp.gmail.com',
+                         port=465, auth='password', cc='someone@there.com',
+                         subject='Hello $name', body='Dear $name,\nhi $to',
+                         attachments=[str(TESTDIR.joinpath('file1.txt'))])
+
+
+def test_template_render_matches_email(get_template):
+    """
+    GIVEN a valid EmailTemplate object
+    WHEN EmailTemplate.render() is called
+    THEN assert the bytes equal those of the equivalent Email
+    """
+    t = get_template
+    rendered = t.render('you@there.com', name='You')
+    e = Email(from_='me@here.com', to='you@there.com', server='smtp.gmail.com',
+              port=465, auth='password', cc='someone@there.com',
+              subject='Hello You', body='Dear You,\nhi you@there.com',
+              attachments=t.attachments)
+    e._construct_message()
+    e.message.set_boundary(t._compile()[4][2:].decode('ascii'))
+    assert rendered == bytes(Payload(e.message))
+
+
+def test_template_compiles_once(get_template, mocker):
+    """
+    GIVEN a valid EmailTemplate object
+    WHEN it is rendered for several recipients
+    THEN assert the shared parts are built once, and again when changed
+    """
+    t = get_template
+    construct_mock = mocker.spy(Email, '_construct_message')
+    t.render('you@there.com', name='You')
+    t.render('her@there.com', name='Her')
+    assert construct_mock.call_count == 1
+    t.subject = 'Bye $name'
+    assert b'Subject: Bye Her' in t.render('her@there.com', name='Her')
+    assert construct_mock.call_count == 2
+
+
+def test_template_send(get_template, capsys, mocker):
+    """
+    GIVEN a valid EmailTemplate object
+    WHEN EmailTemplate.send() is called with rows of fields
+    THEN assert one session is used and a row missing a field is reported
+    """
+    t = get_template
+    session_mock = mocker.patch.object(Email, '_get_session')
+    sendmail_mock = mocker.patch.object(messages.email_, 'sendmail',
+                                        return_value={})
+    rows = [{'to': 'you@there.com', 'name': 'You'}, {'to': 'her@there.com'}]
+    results = t.send(rows)
+    out, err = capsys.readouterr()
+    assert results[0].error is None
+    assert isinstance(results[1].error, KeyError)
+    assert session_mock.call_count == 1
+    assert sendmail_mock.call_count == 1
+    recipients = sendmail_mock.call_args[0][2]
+    assert recipients == ['you@there.com', 'someone@there.com']
+    assert b'Subject: Hello You' in b''.join(sendmail_mock.call_args[0][3])
+    assert out == '1 of 2 messages sent.\n'
+
+
 ##############################################################################
 # TESTS: Email.send_async
 ##############################################################################
 
+def new_async_client(mocker):
+    """Patch aiosmtplib.SMTP, return the mock client it creates."""
+    smtp_mock = mocker.patch("aiosmtplib.SMTP")
+    client = smtp_mock.return_value = AsyncMock()
+    client.is_connected = True
+    client.get_transport_info = mocker.MagicMock(return_value=None)
+    client.close = mocker.MagicMock()
+    client.sendmail.return_value = ({}, 'OK')
+    return smtp_mock, client
+
+
 @pytest.mark.asyncio
 async def test_send_async_ssl(get_email, mocker):
     """
     GIVEN a valid Email object with port=465
     WHEN Email.send_async() is called
-    THEN assert calls aiosmtplib.send with ssl
+    THEN assert the message is sent with ssl, and the client QUIT
 
     AsyncMock found in conftest.py
     """
-    async_mock = mocker.patch("aiosmtplib.send", new_callable=AsyncMock)
+    smtp_mock, client = new_async_client(mocker)
     e = get_email
     e.attachments = None
     await e.send_async()
-    async_mock.assert_called_with(
-            message=e.message,
-            hostname=e.server,
-            port=e.port,
-            username=e.from_,
-            password=e._auth,
-            use_tls=True,
-        )
+    assert smtp_mock.call_args[1]['use_tls'] is True
+    assert client.starttls.call_count == 0
+    client.login.assert_called_once_with('me@here.com', 'password')
+    client.sendmail.assert_called_once_with(
+        e.from_, ['you@there.com', 'someone@there.com', 'them@there.com'],
+        bytes(e._payload))
+    assert client.quit.call_count == 1
+    assert e.refused == {}
 
 
 @pytest.mark.asyncio
@@ -500,20 +1345,112 @@ async def test_send_async_tls(get_email, mocker):
     """
     GIVEN a valid Email object with port=587
     WHEN Email.send_async() is called
-    THEN assert calls aiosmtplib.send with TLS
+    THEN assert the message is sent after STARTTLS
+
+    AsyncMock found in conftest.py
+    """
+    smtp_mock, client = new_async_client(mocker)
+    e = get_email
+    e.attachments = None
+    e.port = 587
+    await e.send_async()
+    assert smtp_mock.call_args[1]['use_tls'] is False
+    assert client.starttls.call_count == 1
+    assert client.sendmail.call_args[0][2] == bytes(e._payload)
+
+
+@pytest.mark.asyncio
+async def test_send_async_rcpt_limit(get_email, mocker):
+    """
+    GIVEN a valid Email object with more recipients than rcpt_limit
+    WHEN Email.send_async() is called and some recipients are refused
+    THEN assert one transaction per chunk over one client, refusals merged
+    """
+    smtp_mock, client = new_async_client(mocker)
+    client.sendmail.side_effect = [
+        ({}, 'OK'),
+        ({'user3@there.com': aiosmtplib.SMTPResponse(550, 'no such user')},
+         'OK'),
+        aiosmtplib.SMTPRecipientsRefused(
+            [aiosmtplib.SMTPRecipientRefused(550, 'no', 'someone@there.com')]),
+    ]
+    e = get_email
+    e.attachments = None
+    e.bcc = None
+    e.to = ['user{}@there.com'.format(i) for i in range(10)]
+    e.rcpt_limit = 5
+    await e.send_async()
+    assert [len(c[0][1]) for c in client.sendmail.call_args_list] == [5, 5, 1]
+    assert smtp_mock.call_count == 1
+    assert e.refused == {'user3@there.com': (550, 'no such user'),
+                         'someone@there.com': (550, 'no')}
+
+
+@pytest.mark.asyncio
+async def test_send_async_pooled(get_email, mocker):
+    """
+    GIVEN a valid Email object with pooled=True
+    WHEN Email.send_async() is called twice
+    THEN assert one pooled client logs in once and sends both messages
 
     AsyncMock found in conftest.py
     """
-    async_mock = mocker.patch("aiosmtplib.send", new_callable=AsyncMock)
+    send_mock = mocker.patch("aiosmtplib.send", new_callable=AsyncMock)
+    smtp_mock = mocker.patch("aiosmtplib.SMTP")
+    client = smtp_mock.return_value = AsyncMock()
+    client.is_connected = True
+    client.get_transport_info = mocker.MagicMock(return_value=None)
+    client.sendmail.return_value = ({}, 'OK')
+    mocker.patch.object(messages.email_, 'ASYNC_SMTP_POOL', AsyncSMTPPool())
     e = get_email
     e.attachments = None
+    e.pooled = True
     e.port = 587
     await e.send_async()
-    async_mock.assert_called_with(
-            message=e.message,
-            hostname=e.server,
-            port=e.port,
-            username=e.from_,
-            password=e._auth,
-            start_tls=True,
-        )
+    await e.send_async()
+    assert smtp_mock.call_count == 1
+    assert client.starttls.call_count == 1
+    client.login.assert_called_once_with('me@here.com', 'password')
+    assert client.sendmail.call_count == 2
+    assert client.sendmail.call_args[0][2] == bytes(e._payload)
+    assert send_mock.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_send_async_off_loop(get_email, mocker):
+    """
+    GIVEN a valid Email object with an attachment
+    WHEN Email.send_async() is called
+    THEN assert the message is built and serialized outside the event loop
+    """
+    new_async_client(mocker)
+    threads = []
+    render = Email._render_async
+
+    def spy(self):
+        threads.append(threading.get_ident())
+        return render(self)
+
+    mocker.patch.object(Email, '_render_async', spy)
+    e = get_email
+    e.attachments = str(TESTDIR.joinpath('file1.txt'))
+    await e.send_async()
+    assert threads and threads[0] != threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_get_session_async_raisesMessSendErr(get_email, mocker):
+    """
+    GIVEN an incorrect password in a valid Email object
+    WHEN Email._get_session_async() is called
+    THEN assert MessageSendError is raised
+    """
+    smtp_mock = mocker.patch("aiosmtplib.SMTP")
+    smtp_mock.return_value = AsyncMock()
+    smtp_mock.return_value.get_transport_info = mocker.MagicMock()
+    smtp_mock.return_value.close = mocker.MagicMock()
+    smtp_mock.return_value.login.side_effect = aiosmtplib.SMTPAuthenticationError(
+        535, 'bad credentials')
+    e = get_email
+    with pytest.raises(MessageSendError):
+        await e._get_session_async()
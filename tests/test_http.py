@@ -0,0 +1,182 @@
+"""messages._http tests."""
+
+import asyncio
+import sys
+
+import httpx
+import pytest
+
+import messages.slack
+from messages._http import HTTPClientRegistry
+from messages._http import base_url
+from messages.slack import SlackWebhook
+
+
+##############################################################################
+# FIXTURES
+##############################################################################
+
+@pytest.fixture()
+def registry():
+    """Return an empty HTTPClientRegistry, closed afterwards."""
+    clients = HTTPClientRegistry()
+    yield clients
+    clients.close()
+
+
+##############################################################################
+# TESTS: base_url
+##############################################################################
+
+@pytest.mark.parametrize('url, base', [
+    ('https://slack.com/api/chat.postMessage', 'https://slack.com'),
+    ('https://API.Telegram.org/bot123/sendMessage', 'https://api.telegram.org'),
+    ('http://localhost:8080/hook?x=1', 'http://localhost:8080'),
+])
+def test_base_url(url, base):
+    """
+    GIVEN the url of an API method
+    WHEN base_url() is called
+    THEN assert the scheme and host it is keyed by are returned
+    """
+    assert base_url(url) == base
+
+
+##############################################################################
+# TESTS: HTTPClientRegistry
+##############################################################################
+
+def test_registry_get(registry, mocker):
+    """
+    GIVEN an HTTPClientRegistry
+    WHEN get() is called for several urls
+    THEN assert one client is shared per host, with the configured limits
+    """
+    limits = httpx.Limits(max_connections=3)
+    registry.configure(limits=limits)
+    client_spy = mocker.spy(httpx, 'Client')
+    client = registry.get('https://slack.com/api/chat.postMessage')
+    assert registry.get('https://slack.com/other') is client
+    assert registry.get('https://api.twilio.com/2010-04-01') is not client
+    assert client_spy.call_count == 2
+    assert client_spy.call_args[1]['limits'] is limits
+    with pytest.raises(TypeError):
+        registry.configure(retries=3)
+
+
+def test_registry_http2(registry, mocker):
+    """
+    GIVEN an HTTPClientRegistry configured with http2=True
+    WHEN get() is called
+    THEN assert clients are created with HTTP/2 enabled
+    """
+    mocker.patch.dict(sys.modules, {'h2': mocker.MagicMock()})
+    client_mock = mocker.patch('httpx.Client')
+    registry.configure(http2=True)
+    registry.get('https://api.telegram.org/bot123/sendMessage')
+    assert client_mock.call_args[1]['http2'] is True
+
+
+def test_registry_http2_missing(registry, mocker):
+    """
+    GIVEN the h2 package is not installed
+    WHEN configure(http2=True) is called
+    THEN assert ImportError is raised and HTTP/1.1 is kept
+    """
+    mocker.patch.dict(sys.modules, {'h2': None})
+    with pytest.raises(ImportError):
+        registry.configure(http2=True)
+    assert registry.http2 is False
+
+
+def test_registry_close(registry):
+    """
+    GIVEN an HTTPClientRegistry with clients
+    WHEN close() is called
+    THEN assert they are closed, and replaced by new ones on the next get()
+    """
+    client = registry.get('https://slack.com')
+    registry.close()
+    assert client.is_closed
+    assert registry.get('https://slack.com') is not client
+
+
+def test_registry_fork(registry):
+    """
+    GIVEN an HTTPClientRegistry inherited from a parent process
+    WHEN get() is called in the child
+    THEN assert the parent's clients are dropped without being closed
+    """
+    client = registry.get('https://slack.com')
+    registry._pid = -1
+    assert registry.get('https://slack.com') is not client
+    assert not client.is_closed
+    client.close()
+
+
+def test_registry_get_async(registry):
+    """
+    GIVEN an HTTPClientRegistry
+    WHEN get_async() is called from two event loops
+    THEN assert each loop shares its own client per host
+    """
+    async def get():
+        client = registry.get_async('https://slack.com/a')
+        assert registry.get_async('https://slack.com/b') is client
+        await asyncio.sleep(0)
+        return client
+
+    first = asyncio.run(get())
+    second = asyncio.run(get())
+    assert isinstance(first, httpx.AsyncClient)
+    assert first is not second
+    assert len(registry._loops) <= 1
+
+
+def test_registry_aclose(registry):
+    """
+    GIVEN async clients opened on the running loop
+    WHEN aclose() is called
+    THEN assert they are closed
+    """
+    async def run():
+        client = registry.get_async('https://slack.com')
+        await registry.aclose()
+        return client
+
+    assert asyncio.run(run()).is_closed
+
+
+def test_registry_inject(registry):
+    """
+    GIVEN clients of our own injected for one host and for every host
+    WHEN messages are sent
+    THEN assert the injected clients are used, and never closed
+    """
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, text='ok')
+
+    own = httpx.Client(transport=httpx.MockTransport(handler))
+    fallback = httpx.Client()
+    registry.inject(own, 'https://hooks.slack.com')
+    registry.inject(fallback)
+    assert registry.get('https://hooks.slack.com/services/x') is own
+    assert registry.get('https://api.twilio.com') is fallback
+
+    messages.slack.HTTP_CLIENTS.inject(own, 'https://hooks.slack.com')
+    try:
+        SlackWebhook(auth='https://hooks.slack.com/services/x',
+                     body='message').send()
+    finally:
+        messages.slack.HTTP_CLIENTS.inject(None, 'https://hooks.slack.com')
+    assert requests[0].url == 'https://hooks.slack.com/services/x'
+
+    registry.close()
+    assert not own.is_closed
+    registry.inject(None)
+    assert registry.get('https://api.twilio.com') is not fallback
+    own.close()
+    fallback.close()
@@ -1,5 +1,7 @@
 """messages._interface tests."""
 
+import sys
+
 import pytest
 
 import messages._interface
@@ -85,3 +87,32 @@ def test_iter():
     msg = MsgGood(1, 2)
     s = set(msg)
     assert s == {'x', 'y'}
+
+
+##############################################################################
+# TESTS: __sizeof__ & release
+##############################################################################
+
+def test_sizeof():
+    """
+    GIVEN a message class that inherits from 'Message'
+    WHEN sys.getsizeof(msg) is called
+    THEN assert the bytes retained by its attributes are included
+    """
+    msg = MsgGood(1, 2)
+    small = sys.getsizeof(msg)
+    msg.message = {'text': 'A' * 10000}
+    assert sys.getsizeof(msg) > small + 10000
+
+
+def test_release():
+    """
+    GIVEN a message that built a message
+    WHEN release() is called
+    THEN assert the built message is dropped and the arguments are kept
+    """
+    msg = MsgGood(1, 2)
+    msg.message = {'text': 'A' * 10000}
+    msg.release()
+    assert msg.message == {}
+    assert (msg.x, msg.y) == (1, 2)
@@ -0,0 +1,597 @@
+"""messages._mime tests."""
+
+import base64
+import email
+import gzip
+import io
+import os
+import zipfile
+import pathlib
+import threading
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+import messages._mime
+from messages._mime import AttachmentCache
+from messages._mime import FileAttachment
+from messages._mime import MemoryAttachment
+from messages._mime import Payload
+from messages._mime import TextBody
+from messages._mime import TextStream
+from messages._mime import base64_size
+from messages._mime import compress_attachments
+from messages._mime import encode_base64
+from messages._mime import encode_qp
+from messages._mime import iter_base64
+from messages._mime import iter_bytes
+from messages._mime import iter_qp
+from messages._mime import iter_text_qp
+
+
+TESTDIR = pathlib.Path(__file__).absolute().parent.joinpath('data')
+
+
+##############################################################################
+# FIXTURES
+##############################################################################
+
+@pytest.fixture(autouse=True)
+def get_cache(mocker):
+    """Give every test an empty ATTACHMENT_CACHE."""
+    cache = AttachmentCache()
+    mocker.patch.object(messages._mime, 'ATTACHMENT_CACHE', cache)
+    return cache
+
+
+@pytest.fixture()
+def get_message():
+    """Return a multipart message with a text body and two attachments."""
+    msg = MIMEMultipart()
+    msg['From'] = 'me@here.com'
+    msg['To'] = 'you@there.com'
+    msg['Subject'] = 'subject'
+    body = MIMEText('text', 'plain')
+    body.set_payload('line one\n.line two')
+    msg.attach(body)
+    for name in ('file1.txt', 'file2.png'):
+        doc = FileAttachment(str(TESTDIR.joinpath(name)))
+        doc.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(doc)
+    return msg
+
+
+class ShortReader(io.BytesIO):
+    """File object returning fewer bytes than asked for."""
+    def read(self, size=-1):
+        return super().read(min(size, 100))
+
+
+##############################################################################
+# TESTS: encode_base64 & iter_base64
+##############################################################################
+
+def test_encode_base64():
+    """
+    GIVEN raw bytes
+    WHEN encode_base64() is called
+    THEN assert standard 76 character CRLF-terminated lines are returned
+    """
+    data = bytes(range(256)) * 3
+    encoded = encode_base64(data)
+    assert encoded == base64.encodebytes(data).replace(b'\n', b'\r\n')
+    assert encode_base64(b'') == b''
+
+
+def test_base64_size():
+    """
+    GIVEN raw data sizes
+    WHEN base64_size() is called
+    THEN assert it matches the length of the encoded data
+    """
+    for size in (0, 1, 2, 3, 56, 57, 58, 114, 1000):
+        assert base64_size(size) == len(encode_base64(b'x' * size))
+
+
+def test_iter_base64_short_reads(mocker):
+    """
+    GIVEN a file object that returns short reads
+    WHEN iter_base64() is called
+    THEN assert the joined chunks are still a valid base64 encoding
+    """
+    mocker.patch.object(messages._mime, 'CHUNK_LINES', 2)
+    data = bytes(range(256)) * 5
+    encoded = b''.join(iter_base64(ShortReader(data)))
+    assert encoded == encode_base64(data)
+
+
+def test_iter_qp_lossless():
+    """
+    GIVEN a file larger than one chunk with line breaks, trailing spaces,
+        '=' signs and binary bytes
+    WHEN it is encoded with iter_qp() and decoded by the email parser
+    THEN assert the original bytes come back and every line is short
+    """
+    data = b'col one,col two =  \r\nvalue,\x00\xff\tend \n' * 3000
+    encoded = b''.join(iter_qp(io.BytesIO(data)))
+    assert max(map(len, encoded.split(b'\r\n'))) <= 76
+    msg = email.message_from_bytes(
+        b'Content-Transfer-Encoding: quoted-printable\r\n\r\n' + encoded)
+    assert msg.get_payload(decode=True) == data
+    assert encode_qp(b'a\nb') == b'a=0Ab=\r\n'
+
+
+def test_iter_text_qp_chunks():
+    """
+    GIVEN UTF-8 text split into str and bytes chunks inside lines and
+        characters, with a last line without a line break
+    WHEN it is encoded with iter_text_qp()
+    THEN assert it decodes back to the text
+    """
+    text = 'caf\xe9 = cr\xe8me  \nline two\r\n' * 2000 + 'x' * 70000
+    head = text[:1000].encode('utf-8')
+    chunks = [head[:4], head[4:], text[1000:-70000], 'x' * 35000, 'x' * 35000]
+    encoded = b''.join(iter_text_qp(chunks))
+    assert max(map(len, encoded.split(b'\r\n'))) <= 77
+    assert encoded.endswith(b'x=\r\n')
+    msg = email.message_from_bytes(
+        b'Content-Transfer-Encoding: quoted-printable\r\n\r\n' + encoded)
+    decoded = msg.get_payload(decode=True).replace(b'\r\n', b'\n')
+    assert decoded == text.replace('\r\n', '\n').encode('utf-8')
+
+
+##############################################################################
+# TESTS: FileAttachment
+##############################################################################
+
+def test_file_attachment():
+    """
+    GIVEN a file path
+    WHEN a FileAttachment is created
+    THEN assert it matches MIMEApplication without reading the whole file
+    """
+    path = str(TESTDIR.joinpath('file2.png'))
+    data = pathlib.Path(path).read_bytes()
+    doc = FileAttachment(path)
+    assert doc.size == len(data)
+    assert doc.items() == MIMEApplication(data).items()
+    assert doc.get_payload() == MIMEApplication(data).get_payload()
+    assert doc.get_payload(decode=True) == data
+
+
+def test_file_attachment_missing():
+    """
+    GIVEN a path that does not exist
+    WHEN a FileAttachment is created
+    THEN assert the error is raised up front, not while sending
+    """
+    with pytest.raises(FileNotFoundError):
+        FileAttachment(str(TESTDIR.joinpath('missing.txt')))
+
+
+def test_file_attachment_text_encoding():
+    """
+    GIVEN a mostly printable file and a binary file
+    WHEN FileAttachments are created
+    THEN assert the text file is quoted-printable and the binary base64
+    """
+    text = FileAttachment(str(TESTDIR.joinpath('file1.txt')))
+    binary = FileAttachment(str(TESTDIR.joinpath('file2.png')))
+    assert text['Content-Transfer-Encoding'] == 'quoted-printable'
+    assert binary['Content-Transfer-Encoding'] == 'base64'
+    assert text.encoded_size() < base64_size(text.size)
+
+
+def test_file_attachment_encoded_once(get_cache, mocker):
+    """
+    GIVEN an uncached quoted-printable FileAttachment in a Payload
+    WHEN its size is declared, the payload sent and bytes_saved() reported
+    THEN assert the file is read only to declare the size and to send it
+    """
+    get_cache.configure(max_bytes=0)
+    msg = MIMEMultipart()
+    msg.attach(FileAttachment(str(TESTDIR.joinpath('file1.txt'))))
+    open_spy = mocker.patch.object(messages._mime, 'open', create=True,
+                                   wraps=open)
+    payload = Payload(msg)
+    size = payload.size()
+    assert len(bytes(payload)) == size
+    assert payload.bytes_saved() > 0
+    assert payload.size() == size
+    assert open_spy.call_count == 2
+
+
+##############################################################################
+# TESTS: MemoryAttachment
+##############################################################################
+
+@pytest.mark.parametrize('data', [
+    bytes(range(256)) * 100,
+    memoryview(bytearray(range(256)) * 100),
+    io.BytesIO(bytes(range(256)) * 100),
+])
+def test_memory_attachment(data):
+    """
+    GIVEN bytes, a memoryview or a file object
+    WHEN a MemoryAttachment is created and encoded twice
+    THEN assert both encodings decode to the data and match encoded_size()
+    """
+    doc = MemoryAttachment('data.bin', data)
+    assert doc['Content-Transfer-Encoding'] == 'base64'
+    assert doc.size == 25600
+    encoded = b''.join(doc.iter_encoded())
+    assert b''.join(doc.iter_encoded()) == encoded
+    assert base64.b64decode(encoded) == bytes(range(256)) * 100
+    assert doc.encoded_size() == len(encoded)
+    assert doc.get_payload(decode=True) == bytes(range(256)) * 100
+
+
+def test_memory_attachment_file_position():
+    """
+    GIVEN a mostly printable file object positioned after a prefix
+    WHEN a MemoryAttachment is created
+    THEN assert it is quoted-printable and holds only the rest of the file
+    """
+    fp = io.BytesIO(b'prefix' + b'Generated report line\n' * 100)
+    fp.seek(6)
+    doc = MemoryAttachment('report.txt', fp)
+    assert doc['Content-Transfer-Encoding'] == 'quoted-printable'
+    assert doc.get_payload(decode=True) == b'Generated report line\n' * 100
+
+
+def test_memory_attachment_qp_payload():
+    """
+    GIVEN a quoted-printable MemoryAttachment in a Payload
+    WHEN its size and bytes_saved() are read, before and after sending
+    THEN assert they match the wire format and savings are reported
+    """
+    msg = MIMEMultipart()
+    doc = MemoryAttachment('r.txt', b'abcdefgh ' * 1000)
+    msg.attach(doc)
+    payload = Payload(msg)
+    assert doc['Content-Transfer-Encoding'] == 'quoted-printable'
+    size = payload.size()
+    assert len(bytes(payload)) == size
+    assert doc.encoded_size() == len(b''.join(doc.iter_encoded()))
+    assert payload.bytes_saved() > 0
+
+
+def test_bytes_saved_unknown_size(mocker):
+    """
+    GIVEN an attachment whose encoded length is unknown after the send
+    WHEN bytes_saved() is called
+    THEN assert it is left out instead of raising
+    """
+    msg = MIMEMultipart()
+    doc = FileAttachment(str(TESTDIR.joinpath('file1.txt')))
+    msg.attach(doc)
+    mocker.patch.object(doc, 'encoded_size', return_value=None)
+    assert Payload(msg).bytes_saved() == 0
+
+
+##############################################################################
+# TESTS: compress_attachments
+##############################################################################
+
+def new_parts():
+    """Return a compressible, an incompressible and a small attachment."""
+    return [(name, MemoryAttachment(name, data)) for name, data in (
+        ('log.csv', b'1,2,3\n' * 20000),
+        ('noise.bin', os.urandom(100000)),
+        ('small.txt', b'x'),
+    )]
+
+
+def test_compress_attachments_gzip():
+    """
+    GIVEN large compressible and incompressible attachments and a small one
+    WHEN compress_attachments() is called with gzip
+    THEN assert only the compressible one is replaced by a .gz part
+    """
+    parts = new_parts()
+    result = compress_attachments(parts, 'gzip', threshold=1024)
+    assert [name for name, _ in result] == ['log.csv.gz', 'noise.bin',
+                                            'small.txt']
+    assert result[1:] == parts[1:]
+    assert result[0][1].get_content_type() == 'application/gzip'
+    data = result[0][1].get_payload(decode=True)
+    assert gzip.decompress(data) == b'1,2,3\n' * 20000
+
+
+def test_compress_attachments_bundle():
+    """
+    GIVEN attachments above and below the threshold
+    WHEN compress_attachments() is called with a bundle name
+    THEN assert the large ones are replaced by one zip archive in place
+    """
+    parts = new_parts()
+    result = compress_attachments(parts, threshold=1024, bundle='all.zip')
+    assert [name for name, _ in result] == ['all.zip', 'small.txt']
+    archive = zipfile.ZipFile(io.BytesIO(result[0][1].get_payload(decode=True)))
+    assert archive.namelist() == ['log.csv', 'noise.bin']
+    assert archive.read('log.csv') == b'1,2,3\n' * 20000
+
+
+def test_compress_attachments_raises():
+    """
+    GIVEN an unknown compression method
+    WHEN compress_attachments() is called
+    THEN assert ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        compress_attachments(new_parts(), 'rar')
+
+
+##############################################################################
+# TESTS: TextBody
+##############################################################################
+
+@pytest.mark.parametrize('text, eightbit, charset, encoding', [
+    ('plain ascii\nline two', False, 'us-ascii', '7bit'),
+    ('plain ascii\nline two', True, 'us-ascii', '7bit'),
+    ('caf\xe9 cr\xe8me', True, 'utf-8', '8bit'),
+    ('Mostly ASCII text with a caf\xe9 in it.\n' * 5, False, 'utf-8',
+     'quoted-printable'),
+    ('\u043f\u0440\u0438\u0432\u0435\u0442 ' * 20, False, 'utf-8', 'base64'),
+    ('x' * 1200, True, 'us-ascii', 'quoted-printable'),
+])
+def test_text_body_encoding(text, eightbit, charset, encoding):
+    """
+    GIVEN a text body
+    WHEN it is serialized with or without 8BITMIME
+    THEN assert the cheapest allowed encoding is used and decodes to the text
+    """
+    part = TextBody(text)
+    assert part.encode(eightbit)[:2] == (charset, encoding)
+    parsed = email.message_from_bytes(b''.join(iter_bytes(part, eightbit=eightbit)))
+    assert parsed['Content-Transfer-Encoding'] == encoding
+    assert parsed.get_content_charset() == charset
+    decoded = parsed.get_payload(decode=True).decode(charset)
+    assert decoded.replace('\r\n', '\n') == text
+
+
+def test_payload_eightbit(get_message):
+    """
+    GIVEN a message with a non-ASCII TextBody
+    WHEN its Payload is serialized with and without 8BITMIME
+    THEN assert 8bit is only used when allowed and saves bytes
+    """
+    get_message.attach(TextBody('na\xefve caf\xe9 ' * 50))
+    payload = Payload(get_message)
+    assert not payload.is_8bit()
+    saved = payload.bytes_saved()
+    assert b'Content-Transfer-Encoding: 8bit' not in bytes(payload)
+    payload.eightbit = True
+    assert payload.is_8bit()
+    assert b'Content-Transfer-Encoding: 8bit' in bytes(payload)
+    assert payload.bytes_saved() > saved > 0
+    assert payload.size() == len(bytes(payload))
+
+
+def test_text_stream_replays(get_message):
+    """
+    GIVEN a TextStream of a generator in a message
+    WHEN its Payload is iterated twice
+    THEN assert the generator is read once and both iterations match
+    """
+    reads = []
+
+    def lines():
+        for i in range(3):
+            reads.append(i)
+            yield 'line %d\n' % i
+
+    get_message.attach(TextStream(lines()))
+    payload = Payload(get_message)
+    assert payload.size() is None
+    first = bytes(payload)
+    assert bytes(payload) == first
+    assert reads == [0, 1, 2]
+    assert b'line 0\r\nline 1\r\nline 2\r\n' in first
+
+
+def test_text_stream_abandoned():
+    """
+    GIVEN a TextStream of a generator read partway, then abandoned
+    WHEN it is read again from the start
+    THEN assert the read is not blocked and returns the whole text
+    """
+    part = TextStream('line %d\n' % i for i in range(3))
+    first = part.iter_encoded()
+    next(first)
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(b''.join(part.iter_encoded())),
+        daemon=True)
+    thread.start()
+    thread.join(5)
+    assert result == [b'line 0\r\nline 1\r\nline 2\r\n']
+
+
+def test_text_stream_path(tmp_path):
+    """
+    GIVEN a TextStream of a path
+    WHEN the file changes between two reads
+    THEN assert the current contents are read each time
+    """
+    path = tmp_path.joinpath('body.txt')
+    path.write_bytes(b'first\n')
+    part = TextStream(path)
+    assert part.get_payload(decode=True) == b'first\n'
+    path.write_bytes(b'second\n')
+    assert part.get_payload() == 'second\n'
+    assert part['Content-Transfer-Encoding'] == 'quoted-printable'
+
+
+##############################################################################
+# TESTS: iter_bytes & Payload
+##############################################################################
+
+def test_iter_bytes_matches_stdlib(get_message):
+    """
+    GIVEN a multipart message with lazy FileAttachments
+    WHEN iter_bytes() is called
+    THEN assert the output is the stdlib serialization with CRLF line endings
+    """
+    msg = get_message
+    streamed = b''.join(iter_bytes(msg))
+    expected = msg.as_bytes().replace(b'\n', b'\r\n')
+    assert streamed == expected
+
+
+def test_iter_bytes_parses(get_message):
+    """
+    GIVEN a multipart message with lazy FileAttachments
+    WHEN the iter_bytes() output is parsed
+    THEN assert the attachments decode to the original files
+    """
+    parsed = email.message_from_bytes(b''.join(iter_bytes(get_message)))
+    body, doc1, doc2 = parsed.get_payload()
+    assert body.get_payload() == 'line one\r\n.line two'
+    assert doc1.get_payload(decode=True) == TESTDIR.joinpath('file1.txt').read_bytes()
+    assert doc2.get_payload(decode=True) == TESTDIR.joinpath('file2.png').read_bytes()
+    assert doc2.get_filename() == 'file2.png'
+
+
+def test_iter_bytes_text_fast_path(get_message, mocker):
+    """
+    GIVEN a multipart message with text parts and long or encoded headers
+    WHEN iter_bytes() is called
+    THEN assert no part goes through the generator and the output is unchanged
+    """
+    msg = get_message
+    msg['Subject'] = 'a very long subject line ' * 8
+    msg['X-Note'] = 'caf\xe9'
+    extra = MIMEText('text', 'html')
+    extra.set_payload('<p>one</p>\r\n<p>two</p>\r<p>three</p>\n')
+    msg.attach(extra)
+    msg.attach(MIMEText('caf\xe9', 'plain', 'utf-8'))
+    expected = msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+    as_bytes_mock = mocker.spy(MIMEText, 'as_bytes')
+    streamed = b''.join(iter_bytes(msg))
+    assert as_bytes_mock.call_count == 0
+    assert streamed == expected
+
+
+def test_iter_bytes_parses_like_stdlib(get_message):
+    """
+    GIVEN a multipart message with text, binary and non-ASCII parts
+    WHEN the iter_bytes() and stdlib outputs are parsed
+    THEN assert both parse to the same headers and decoded parts
+    """
+    msg = get_message
+    msg.attach(MIMEText('caf\xe9\nna\xefve', 'plain', 'utf-8'))
+    msg.attach(MIMEApplication(b'\x00\x01binary'))
+    fast = email.message_from_bytes(b''.join(iter_bytes(msg)))
+    crlf = msg.policy.clone(linesep='\r\n')
+    slow = email.message_from_bytes(msg.as_bytes(policy=crlf))
+    assert fast.items() == slow.items()
+    for f, s in zip(fast.walk(), slow.walk()):
+        assert f.items() == s.items()
+        if not f.is_multipart():
+            assert f.get_payload(decode=True) == s.get_payload(decode=True)
+
+
+def test_payload_reiterable(get_message):
+    """
+    GIVEN a Payload
+    WHEN it is iterated more than once
+    THEN assert each iteration produces the full message
+    """
+    payload = Payload(get_message)
+    assert b''.join(payload) == b''.join(payload) == bytes(payload)
+
+
+def test_payload_size(get_message, mocker):
+    """
+    GIVEN a Payload with FileAttachments
+    WHEN Payload.size() is called
+    THEN assert it is the serialized length, computed without encoding the
+        base64 files
+    """
+    payload = Payload(get_message)
+    encode_mock = mocker.spy(FileAttachment, 'iter_encoded')
+    size = payload.size()
+    encoded = [call[0][0].encoding for call in encode_mock.call_args_list]
+    assert encoded == ['quoted-printable']
+    assert size == len(bytes(payload))
+
+
+##############################################################################
+# TESTS: AttachmentCache
+##############################################################################
+
+def test_cache_reuses_encoding(get_cache, mocker):
+    """
+    GIVEN a file attached to two messages
+    WHEN both attachments are encoded
+    THEN assert the file is read and encoded only once
+    """
+    path = str(TESTDIR.joinpath('file2.png'))
+    first = b''.join(FileAttachment(path).iter_encoded())
+    encode_mock = mocker.patch.object(messages._mime, 'iter_base64')
+    second = b''.join(FileAttachment(path).iter_encoded())
+    assert first == second
+    assert encode_mock.call_count == 0
+    assert len(get_cache._entries) == 1
+
+
+def test_cache_modified_file(get_cache, tmp_path):
+    """
+    GIVEN a cached attachment
+    WHEN the file is modified
+    THEN assert the new contents are encoded
+    """
+    path = tmp_path.joinpath('report.csv')
+    path.write_bytes(b'first,line\n')
+    assert b''.join(FileAttachment(str(path)).iter_encoded()) == b'first,line=0A=\r\n'
+    path.write_bytes(b'second,line\n')
+    assert b''.join(FileAttachment(str(path)).iter_encoded()) == b'second,line=0A=\r\n'
+    assert len(get_cache._entries) == 2
+
+
+def test_cache_lru_budget():
+    """
+    GIVEN an AttachmentCache with a 10 byte budget
+    WHEN entries exceeding the budget are added
+    THEN assert the least recently used entries are evicted
+    """
+    cache = AttachmentCache(max_bytes=10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == cache.get('c') == b'1234'
+    cache.put('d', b'12345678901')
+    assert cache.get('d') is None
+
+
+def test_cache_disabled():
+    """
+    GIVEN an AttachmentCache configured with max_bytes=0
+    WHEN an entry is added
+    THEN assert nothing is cached
+    """
+    cache = AttachmentCache()
+    cache.configure(max_bytes=0)
+    cache.put('a', b'1234')
+    assert cache.get('a') is None
+    with pytest.raises(TypeError):
+        cache.configure(size=1)
+
+
+def test_cache_directory(tmp_path):
+    """
+    GIVEN an AttachmentCache with a directory tier
+    WHEN a new cache is created on the same directory
+    THEN assert previously encoded bodies are found without re-encoding
+    """
+    AttachmentCache(directory=str(tmp_path)).put('a', b'1234')
+    cache = AttachmentCache(directory=str(tmp_path))
+    assert cache.get('a') == b'1234'
+    cache.clear()
+    assert cache.get('a') is None
+    assert list(tmp_path.iterdir()) == []
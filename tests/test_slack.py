@@ -296,6 +296,22 @@ def test_slackWH_send_verbose_false(get_slackWH, capsys, httpx_mock):
     assert err == ''
 
 
+def test_slackWH_send_lean(get_slackWH, httpx_mock):
+    """
+    GIVEN a SlackWebhook object with lean=True
+    WHEN *.send() is called
+    THEN assert the built message is dropped once it is sent
+
+    httpx_mock is a built-in fixture from pytest-httpx
+    """
+    httpx_mock.add_response(status_code=201)
+    s = get_slackWH
+    s.lean = True
+    s.send()
+    assert s.message == {}
+    assert b'message' in httpx_mock.get_requests()[0].content
+
+
 def test_slackWH_send_HTTPError(get_slackWH, httpx_mock):
     """
     GIVEN a valid SlackWebhook object
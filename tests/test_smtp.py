@@ -0,0 +1,1097 @@
+"""messages._smtp tests."""
+
+import asyncio
+import smtplib
+import ssl
+import threading
+import time
+from smtplib import SMTPDataError
+from smtplib import SMTPServerDisconnected
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPRecipientsRefused
+from email.mime.multipart import MIMEMultipart
+from unittest.mock import MagicMock
+
+import aiosmtplib
+import pytest
+
+import messages._smtp
+from messages._mime import Payload
+from messages._mime import TextBody
+from messages._mime import TextStream
+from messages._smtp import AsyncSMTPPool
+from messages._smtp import MXResolver
+from messages._smtp import SMTPSessionPool
+from messages._smtp import SendmailCommand
+from messages._smtp import ServerProfile
+from messages._smtp import ServerProfileCache
+from messages._smtp import TLSContext
+from messages._smtp import TLSContextCache
+from messages._smtp import TransportSettings
+from messages._smtp import is_disconnect
+from messages._smtp import probe
+from messages._smtp import send_chunked
+from messages._smtp import send_mx
+from messages._smtp import sendmail
+from messages._smtp import senddata
+from messages._smtp import throttle_state
+
+from conftest import AsyncMock
+
+
+##############################################################################
+# FIXTURES
+##############################################################################
+
+KEY = ('smtp.gmail.com', 465, 'me@here.com')
+
+
+@pytest.fixture()
+def get_pool():
+    """Return an empty SMTPSessionPool."""
+    return SMTPSessionPool(size=2, idle_timeout=60, max_messages=3)
+
+
+def new_session():
+    """Return a mock SMTP session that passes the NOOP health check."""
+    session = MagicMock()
+    session.noop.return_value = (250, b'OK')
+    return session
+
+
+def new_client():
+    """Return a mock, connected aiosmtplib client."""
+    client = AsyncMock()
+    client.is_connected = True
+    client.close = MagicMock()
+    return client
+
+
+def pipelining_session(*replies):
+    """Return a mock SMTP session advertising PIPELINING and SIZE."""
+    session = new_session()
+    session.has_extn.side_effect = lambda name: name in ('pipelining', 'size')
+    session.esmtp_features = {'pipelining': '', 'size': ''}
+    session.getreply.side_effect = list(replies)
+    session.data.return_value = (250, b'queued')
+    return session
+
+
+##############################################################################
+# TESTS: is_disconnect
+##############################################################################
+
+def test_is_disconnect():
+    """
+    GIVEN SMTP exceptions
+    WHEN is_disconnect() is called
+    THEN assert only dropped connections and 421 replies are reported
+    """
+    assert is_disconnect(SMTPServerDisconnected())
+    assert is_disconnect(SMTPSenderRefused(421, b'closing', 'me@here.com'))
+    assert not is_disconnect(SMTPSenderRefused(550, b'denied', 'me@here.com'))
+    assert not is_disconnect(SMTPRecipientsRefused({}))
+
+
+##############################################################################
+# TESTS: SMTPSessionPool.acquire & release
+##############################################################################
+
+def test_pool_reuses_session(get_pool):
+    """
+    GIVEN an SMTPSessionPool
+    WHEN a session is released and the same key is acquired again
+    THEN assert the session is reused without reconnecting
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session)
+    assert pool.acquire(KEY, connect) is session
+    assert connect.call_count == 1
+    assert session.noop.call_count == 1
+
+
+def test_pool_keys_are_separate(get_pool):
+    """
+    GIVEN an SMTPSessionPool with an idle session
+    WHEN a different key is acquired
+    THEN assert a new session is connected
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session)
+    other = pool.acquire(('smtp.gmail.com', 465, 'you@here.com'), connect)
+    assert other is not session
+    assert connect.call_count == 2
+
+
+def test_pool_unhealthy_session(get_pool):
+    """
+    GIVEN an SMTPSessionPool with an idle session that fails NOOP
+    WHEN the key is acquired
+    THEN assert the session is discarded and a new one connected
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session)
+    session.noop.side_effect = SMTPServerDisconnected()
+    assert pool.acquire(KEY, connect) is not session
+    assert session.close.call_count == 1
+    assert connect.call_count == 2
+
+
+def test_pool_idle_timeout(get_pool, mocker):
+    """
+    GIVEN an SMTPSessionPool with an idle session older than idle_timeout
+    WHEN the key is acquired
+    THEN assert the stale session is closed and a new one connected
+    """
+    pool = get_pool
+    clock = mocker.patch.object(messages._smtp.time, 'monotonic')
+    clock.return_value = 100
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session)
+    clock.return_value = 161
+    assert pool.acquire(KEY, connect) is not session
+    assert session.quit.call_count == 1
+
+
+def test_pool_max_messages(get_pool):
+    """
+    GIVEN an SMTPSessionPool with max_messages=3
+    WHEN a session has sent 3 messages
+    THEN assert it is retired instead of returned to the pool
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session, sent=2)
+    assert pool.acquire(KEY, connect) is session
+    pool.release(KEY, session)
+    assert session.quit.call_count == 1
+    assert pool.acquire(KEY, connect) is not session
+
+
+def test_pool_size(get_pool):
+    """
+    GIVEN an SMTPSessionPool with size=2
+    WHEN 3 sessions are released for the same key
+    THEN assert only 2 are kept idle
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    sessions = [pool.acquire(KEY, connect) for _ in range(3)]
+    for s in sessions:
+        pool.release(KEY, s)
+    assert sessions[2].quit.call_count == 1
+    assert len(pool._idle[KEY]) == 2
+
+
+def test_pool_fork_safety(get_pool, mocker):
+    """
+    GIVEN an SMTPSessionPool with an idle session
+    WHEN acquired from a forked child process
+    THEN assert the inherited session is dropped without sending QUIT
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    session = pool.acquire(KEY, connect)
+    pool.release(KEY, session)
+    mocker.patch.object(messages._smtp.os, 'getpid', return_value=-1)
+    assert pool.acquire(KEY, connect) is not session
+    assert session.quit.call_count == 0
+    assert session.noop.call_count == 0
+
+
+def test_pool_configure(get_pool):
+    """
+    GIVEN an SMTPSessionPool
+    WHEN configure() is called
+    THEN assert valid settings are updated and unknown ones rejected
+    """
+    pool = get_pool
+    pool.configure(size=5, idle_timeout=10, max_messages=0)
+    assert (pool.size, pool.idle_timeout, pool.max_messages) == (5, 10, 0)
+    with pytest.raises(TypeError):
+        pool.configure(timeout=5)
+
+
+def test_pool_close(get_pool):
+    """
+    GIVEN an SMTPSessionPool with idle sessions
+    WHEN close() is called
+    THEN assert every idle session is QUIT
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    sessions = [pool.acquire(KEY, connect) for _ in range(2)]
+    for s in sessions:
+        pool.release(KEY, s)
+    pool.close()
+    assert all(s.quit.call_count == 1 for s in sessions)
+    assert pool._idle == {}
+
+
+##############################################################################
+# TESTS: SMTPSessionPool.run
+##############################################################################
+
+def test_pool_run(get_pool):
+    """
+    GIVEN an SMTPSessionPool
+    WHEN run() is called
+    THEN assert func is called with a session that is then released
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    func = MagicMock(return_value={})
+    assert pool.run(KEY, connect, func) == {}
+    session = func.call_args[0][0]
+    assert pool._idle[KEY][0][0] is session
+
+
+def test_pool_run_reconnects(get_pool):
+    """
+    GIVEN an SMTPSessionPool
+    WHEN func raises a 421 reply on the first session
+    THEN assert the session is discarded and func retried on a new session
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    func = MagicMock(side_effect=[SMTPSenderRefused(421, b'bye', 'me'), {}])
+    assert pool.run(KEY, connect, func) == {}
+    first, second = [c[0][0] for c in func.call_args_list]
+    assert first is not second
+    assert first.close.call_count == 1
+    assert pool._idle[KEY][0][0] is second
+
+
+def test_pool_run_disconnect_mid_stream(get_pool):
+    """
+    GIVEN a Payload with a TextStream body of a generator
+    WHEN the session drops while the body is streamed
+    THEN assert run() retries on a new session and sends the whole body
+    """
+    pool = get_pool
+    msg = MIMEMultipart()
+    msg.attach(TextStream('line %d\n' % i for i in range(3)))
+    payload = Payload(msg)
+    sent = []
+
+    def func(session):
+        chunks = iter(payload)
+        for chunk in chunks:
+            if not sent and b'line 0' in chunk:
+                sent.append(None)
+                raise SMTPServerDisconnected('dropped')
+        sent.append(bytes(payload))
+        return {}
+
+    thread = threading.Thread(
+        target=pool.run, args=(KEY, MagicMock(side_effect=new_session), func),
+        daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert b'line 0\r\nline 1\r\nline 2\r\n' in sent[-1]
+
+
+def test_pool_run_other_errors(get_pool):
+    """
+    GIVEN an SMTPSessionPool
+    WHEN func raises an error that is not a disconnect
+    THEN assert it propagates without retrying and the session is kept
+    """
+    pool = get_pool
+    connect = MagicMock(side_effect=new_session)
+    func = MagicMock(side_effect=SMTPRecipientsRefused({}))
+    with pytest.raises(SMTPRecipientsRefused):
+        pool.run(KEY, connect, func)
+    assert func.call_count == 1
+    assert len(pool._idle[KEY]) == 1
+
+
+@pytest.mark.parametrize('exc, state', [
+    (SMTPSenderRefused(550, b'5.4.5 Daily user sending quota exceeded', 'a'),
+     'exhausted'),
+    (SMTPSenderRefused(421, b'4.7.0 Try again later', 'a'), 'throttled'),
+    (SMTPDataError(451, b'4.7.1 Rate limited, slow down'), 'throttled'),
+    (SMTPRecipientsRefused({'a': (450, b'Too many connections')}), 'throttled'),
+    (SMTPSenderRefused(552, b'Message size exceeds the server limit', 'a'),
+     None),
+    (SMTPDataError(554, b'Rejected as spam'), None),
+    (SMTPServerDisconnected(), None),
+])
+def test_throttle_state(exc, state):
+    """
+    GIVEN an SMTP error
+    WHEN throttle_state() is called
+    THEN assert quota and rate limit replies are recognized
+    """
+    assert throttle_state(exc) == state
+
+
+##############################################################################
+# TESTS: sendmail
+##############################################################################
+
+def test_sendmail_no_pipelining():
+    """
+    GIVEN a session whose server does not advertise PIPELINING
+    WHEN sendmail() is called
+    THEN assert MAIL FROM and each RCPT TO wait for their reply in turn
+    """
+    session = new_session()
+    session.has_extn.return_value = False
+    session.mail.return_value = (250, b'ok')
+    session.rcpt.side_effect = [(250, b'ok'), (550, b'no such user')]
+    session.data.return_value = (250, b'queued')
+    refused = sendmail(session, 'me@here.com', ['a@there.com', 'b@there.com'],
+                       'msg')
+    assert refused == {'b@there.com': (550, b'no such user')}
+    session.mail.assert_called_once_with('me@here.com', [])
+    assert session.rcpt.call_count == 2
+    session.data.assert_called_once_with(b'msg')
+    assert session.send.call_count == 0
+
+
+def test_sendmail_no_pipelining_sender_refused():
+    """
+    GIVEN a session whose server does not advertise PIPELINING
+    WHEN MAIL FROM is refused
+    THEN assert no RCPT TO is sent and SMTPSenderRefused is raised
+    """
+    session = new_session()
+    session.has_extn.return_value = False
+    session.mail.return_value = (550, b'denied')
+    with pytest.raises(SMTPSenderRefused):
+        sendmail(session, 'me@here.com', ['a@there.com'], 'msg')
+    assert session.rcpt.call_count == 0
+    assert session.rset.call_count == 1
+
+
+def test_sendmail_pipelining():
+    """
+    GIVEN a session whose server advertises PIPELINING
+    WHEN sendmail() is called with several recipients
+    THEN assert MAIL FROM and all RCPT TO are written in one batch
+    """
+    session = pipelining_session((250, b'ok'), (250, b'ok'), (251, b'ok'))
+    refused = sendmail(session, 'me@here.com', ['a@there.com', 'b@there.com'],
+                       'line1\nline2')
+    assert refused == {}
+    session.send.assert_called_once_with(
+        'mail FROM:<me@here.com> size=12\r\n'
+        'rcpt TO:<a@there.com>\r\n'
+        'rcpt TO:<b@there.com>\r\n')
+    session.data.assert_called_once_with(b'line1\r\nline2')
+
+
+def test_sendmail_pipelining_refused():
+    """
+    GIVEN a pipelining session where one recipient is refused
+    WHEN sendmail() is called
+    THEN assert the message is sent and the refused recipient reported
+    """
+    session = pipelining_session((250, b'ok'), (550, b'no such user'),
+                                 (250, b'ok'))
+    refused = sendmail(session, 'me@here.com', ['a@there.com', 'b@there.com'],
+                       b'msg')
+    assert refused == {'a@there.com': (550, b'no such user')}
+    assert session.data.call_count == 1
+
+
+def test_sendmail_pipelining_all_refused():
+    """
+    GIVEN a pipelining session where every recipient is refused
+    WHEN sendmail() is called
+    THEN assert SMTPRecipientsRefused is raised without sending DATA
+    """
+    session = pipelining_session((250, b'ok'), (550, b'no'))
+    with pytest.raises(SMTPRecipientsRefused):
+        sendmail(session, 'me@here.com', 'a@there.com', b'msg')
+    assert session.data.call_count == 0
+    assert session.rset.call_count == 1
+
+
+def test_sendmail_pipelining_sender_refused():
+    """
+    GIVEN a pipelining session where MAIL FROM is refused with 421
+    WHEN sendmail() is called
+    THEN assert every reply is read, the session closed and the error raised
+    """
+    session = pipelining_session((421, b'bye'), (503, b'no'))
+    with pytest.raises(SMTPSenderRefused) as e:
+        sendmail(session, 'me@here.com', ['a@there.com'], b'msg')
+    assert is_disconnect(e.value)
+    assert session.getreply.call_count == 2
+    assert session.close.call_count == 1
+
+
+def test_sendmail_pipelining_data_error():
+    """
+    GIVEN a pipelining session where DATA is refused
+    WHEN sendmail() is called
+    THEN assert SMTPDataError is raised and the transaction reset
+    """
+    session = pipelining_session((250, b'ok'), (250, b'ok'))
+    session.data.return_value = (554, b'rejected')
+    with pytest.raises(SMTPDataError):
+        sendmail(session, 'me@here.com', ['a@there.com'], b'msg')
+    assert session.rset.call_count == 1
+
+
+##############################################################################
+# TESTS: AsyncSMTPPool.run
+##############################################################################
+
+@pytest.mark.asyncio
+async def test_async_pool_reuses_client():
+    """
+    GIVEN an AsyncSMTPPool
+    WHEN run() is called twice for the same key
+    THEN assert the same client is reused without reconnecting
+    """
+    pool = AsyncSMTPPool(size=2)
+    connect = AsyncMock(side_effect=new_client)
+    func = AsyncMock(return_value='sent')
+    assert await pool.run(KEY, connect, func) == 'sent'
+    assert await pool.run(KEY, connect, func) == 'sent'
+    first, second = [c[0][0] for c in func.call_args_list]
+    assert first is second
+    assert connect.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_pool_bounded_size():
+    """
+    GIVEN an AsyncSMTPPool with size=2
+    WHEN 10 sends run concurrently
+    THEN assert they multiplex over only 2 connections
+    """
+    pool = AsyncSMTPPool(size=2)
+    connect = AsyncMock(side_effect=new_client)
+    in_flight = {}
+
+    async def func(client):
+        assert id(client) not in in_flight
+        in_flight[id(client)] = client
+        await asyncio.sleep(0)
+        del in_flight[id(client)]
+
+    await asyncio.gather(*[pool.run(KEY, connect, func) for _ in range(10)])
+    assert connect.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_async_pool_reconnects():
+    """
+    GIVEN an AsyncSMTPPool
+    WHEN func raises a disconnect error
+    THEN assert the client is replaced and func retried once
+    """
+    pool = AsyncSMTPPool()
+    connect = AsyncMock(side_effect=new_client)
+    func = AsyncMock(side_effect=[aiosmtplib.SMTPServerDisconnected('bye'), 'sent'])
+    assert await pool.run(KEY, connect, func) == 'sent'
+    first, second = [c[0][0] for c in func.call_args_list]
+    assert first is not second
+    assert first.close.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_pool_dead_client():
+    """
+    GIVEN an AsyncSMTPPool with an idle client that lost its connection
+    WHEN run() is called
+    THEN assert a new client is connected
+    """
+    pool = AsyncSMTPPool()
+    connect = AsyncMock(side_effect=new_client)
+    func = AsyncMock()
+    await pool.run(KEY, connect, func)
+    func.call_args[0][0].is_connected = False
+    await pool.run(KEY, connect, func)
+    assert connect.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_async_pool_max_messages():
+    """
+    GIVEN an AsyncSMTPPool with max_messages=2
+    WHEN three messages are sent
+    THEN assert the first client is retired after two
+    """
+    pool = AsyncSMTPPool(max_messages=2)
+    connect = AsyncMock(side_effect=new_client)
+    func = AsyncMock()
+    for _ in range(3):
+        await pool.run(KEY, connect, func)
+    clients = [c[0][0] for c in func.call_args_list]
+    assert clients[0] is clients[1] is not clients[2]
+    assert clients[0].quit.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_pool_connect_failure():
+    """
+    GIVEN an AsyncSMTPPool with size=1
+    WHEN connecting fails
+    THEN assert the error propagates and the slot is freed for later sends
+    """
+    pool = AsyncSMTPPool(size=1)
+    connect = AsyncMock(side_effect=[OSError('refused'), new_client()])
+    func = AsyncMock()
+    with pytest.raises(OSError):
+        await pool.run(KEY, connect, func)
+    await pool.run(KEY, connect, func)
+    assert func.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_pool_close():
+    """
+    GIVEN an AsyncSMTPPool with idle clients
+    WHEN close() is called
+    THEN assert every idle client is QUIT
+    """
+    pool = AsyncSMTPPool()
+    connect = AsyncMock(side_effect=new_client)
+    func = AsyncMock()
+    await pool.run(KEY, connect, func)
+    await pool.close()
+    assert func.call_args[0][0].quit.call_count == 1
+
+
+def test_sendmail_streams_chunks():
+    """
+    GIVEN a pipelining session
+    WHEN sendmail() is called with an iterable of chunks
+    THEN assert the chunks are streamed through DATA without SIZE
+    """
+    session = pipelining_session((250, b'ok'), (250, b'ok'), (354, b'go'),
+                                 (250, b'queued'))
+    sendmail(session, 'me@here.com', ['a@there.com'], iter([b'a\r\n', b'b\r\n']))
+    session.send.assert_any_call(
+        'mail FROM:<me@here.com>\r\nrcpt TO:<a@there.com>\r\n')
+    session.putcmd.assert_called_once_with('data')
+    assert session.data.call_count == 0
+
+
+def test_sendmail_declares_size():
+    """
+    GIVEN a session advertising SIZE
+    WHEN sendmail() is called with a list of chunks
+    THEN assert their total size is declared in MAIL FROM
+    """
+    session = pipelining_session((250, b'ok'), (250, b'ok'), (354, b'go'),
+                                 (250, b'queued'))
+    session.esmtp_features['size'] = '100'
+    sendmail(session, 'me@here.com', ['a@there.com'], [b'a\r\n', b'b\r\n'])
+    session.send.assert_any_call(
+        'mail FROM:<me@here.com> size=6\r\nrcpt TO:<a@there.com>\r\n')
+
+
+def test_sendmail_size_exceeded():
+    """
+    GIVEN a session advertising a SIZE limit
+    WHEN sendmail() is called with a larger message
+    THEN assert SMTPSenderRefused is raised before anything is sent
+    """
+    session = pipelining_session()
+    session.esmtp_features['size'] = '5'
+    payload = MagicMock()
+    payload.size.return_value = 6
+    with pytest.raises(SMTPSenderRefused) as e:
+        sendmail(session, 'me@here.com', ['a@there.com'], payload)
+    assert e.value.smtp_code == 552
+    assert session.send.call_count == 0
+    assert payload.__iter__.call_count == 0
+
+
+def test_sendmail_8bitmime():
+    """
+    GIVEN one Payload holding non-ASCII text
+    WHEN it is sent to a server advertising 8BITMIME, then to one without
+    THEN assert only the first gets BODY=8BITMIME and 8bit text, and the
+        payload itself is left unchanged
+    """
+    msg = MIMEMultipart()
+    msg.attach(TextBody('na\xefve caf\xe9 ' * 50))
+    payload = Payload(msg)
+    sent = []
+    for extensions in (('pipelining', '8bitmime'), ('pipelining',)):
+        session = pipelining_session((250, b'ok'), (250, b'ok'), (354, b'go'),
+                                     (250, b'queued'))
+        session.has_extn.side_effect = lambda name, e=extensions: name in e
+        sendmail(session, 'me@here.com', ['a@there.com'], payload)
+        sent.append(b''.join(c[0][0] for c in session.send.call_args_list
+                             if isinstance(c[0][0], bytes)))
+        mail = session.send.call_args_list[0][0][0]
+        assert ('body=8BITMIME' in mail) == ('8bitmime' in extensions)
+    assert b'Content-Transfer-Encoding: 8bit' in sent[0]
+    assert b'Content-Transfer-Encoding: 8bit' not in sent[1]
+    assert payload.eightbit is False
+
+
+def test_sendmail_lmtp():
+    """
+    GIVEN an LMTP session
+    WHEN sendmail() is called
+    THEN assert a DATA reply is read per recipient and failures are refused
+    """
+    session = pipelining_session((250, b'ok'), (250, b'ok'), (250, b'ok'),
+                                 (354, b'go'), (250, b'delivered'),
+                                 (552, b'mailbox full'))
+    session.__class__ = smtplib.LMTP
+    refused = sendmail(session, 'me@here.com', ['a@there.com', 'b@there.com'],
+                       iter([b'a\r\n']))
+    assert refused == {'b@there.com': (552, b'mailbox full')}
+    assert session.getreply.call_count == 6
+
+
+##############################################################################
+# TESTS: senddata
+##############################################################################
+
+def test_senddata_bytes():
+    """
+    GIVEN a session
+    WHEN senddata() is called with bytes
+    THEN assert it is handed to session.data()
+    """
+    session = new_session()
+    session.data.return_value = (250, b'queued')
+    assert senddata(session, b'msg') == (250, b'queued')
+
+
+def test_senddata_chunks():
+    """
+    GIVEN a session
+    WHEN senddata() is called with chunks containing lines starting with '.'
+    THEN assert those lines are dot-stuffed and the message terminated
+    """
+    session = new_session()
+    session.getreply.side_effect = [(354, b'go'), (250, b'queued')]
+    assert senddata(session, [b'.a\r\nb', b'.c\r\n.d']) == (250, b'queued')
+    sent = b''.join(c[0][0] for c in session.send.call_args_list)
+    assert sent == b'..a\r\nb.c\r\n..d\r\n.\r\n'
+
+
+def test_senddata_refused():
+    """
+    GIVEN a session
+    WHEN the server refuses the DATA command
+    THEN assert SMTPDataError is raised before any chunk is read
+    """
+    session = new_session()
+    session.getreply.return_value = (554, b'no valid recipients')
+    chunks = MagicMock()
+    with pytest.raises(SMTPDataError):
+        senddata(session, chunks)
+    assert chunks.__iter__.call_count == 0
+
+
+def test_senddata_chunk_error():
+    """
+    GIVEN a session
+    WHEN producing a chunk fails halfway through the message
+    THEN assert the session is closed and the error raised
+    """
+    def chunks():
+        yield b'a\r\n'
+        raise OSError('disk error')
+
+    session = new_session()
+    session.getreply.return_value = (354, b'go')
+    with pytest.raises(OSError):
+        senddata(session, chunks())
+    assert session.close.call_count == 1
+
+
+##############################################################################
+# TESTS: TLSContext & TLSContextCache
+##############################################################################
+
+def test_tls_context_cache():
+    """
+    GIVEN a TLSContextCache
+    WHEN contexts are requested for servers and verification settings
+    THEN assert each combination is built once and then shared
+    """
+    cache = TLSContextCache()
+    context = cache.get('smtp.gmail.com')
+    assert isinstance(context, TLSContext)
+    assert cache.get('smtp.gmail.com') is context
+    assert cache.get('smtp.other.com') is not context
+    unverified = cache.get('smtp.gmail.com', verify=False)
+    assert unverified is not context
+    assert unverified.verify_mode == ssl.CERT_NONE
+    assert context.verify_mode == ssl.CERT_REQUIRED and context.check_hostname
+    cache.clear()
+    assert cache.get('smtp.gmail.com') is not context
+
+
+def test_tls_context_offers_session(mocker):
+    """
+    GIVEN a TLSContext holding the session of a closed connection
+    WHEN a new connection to the same host is wrapped
+    THEN assert the stored session is offered for resumption
+    """
+    wrap_mock = mocker.patch.object(ssl.SSLContext, 'wrap_socket')
+    context = TLSContext()
+    tls_session = MagicMock()
+    context.remember('smtp.gmail.com', tls_session)
+    context.wrap_socket('sock', server_hostname='smtp.gmail.com')
+    assert wrap_mock.call_args[1]['session'] is tls_session
+    context.wrap_socket('sock', server_hostname='smtp.other.com')
+    assert wrap_mock.call_args[1]['session'] is None
+
+
+##############################################################################
+# TESTS: send_chunked
+##############################################################################
+
+RECIPIENTS = ['user{}@there.com'.format(i) for i in range(250)]
+
+
+def test_send_chunked():
+    """
+    GIVEN a recipient list longer than the limit
+    WHEN send_chunked() is called
+    THEN assert one transaction per chunk and the refused dicts are merged
+    """
+    deliver = MagicMock(side_effect=[{}, {'user150@there.com': (550, b'no')}, {}])
+    refused = send_chunked(deliver, RECIPIENTS, limit=100)
+    assert [len(c[0][0]) for c in deliver.call_args_list] == [100, 100, 50]
+    assert refused == {'user150@there.com': (550, b'no')}
+
+
+def test_send_chunked_partial_refusal():
+    """
+    GIVEN a chunk whose recipients are all refused
+    WHEN other chunks are accepted
+    THEN assert the refusals are returned instead of raised
+    """
+    def deliver(chunk):
+        if chunk[0] == 'user0@there.com':
+            raise SMTPRecipientsRefused({r: (550, b'no') for r in chunk})
+        return {}
+
+    refused = send_chunked(deliver, RECIPIENTS, limit=100)
+    assert len(refused) == 100
+
+
+def test_send_chunked_all_refused():
+    """
+    GIVEN every recipient is refused
+    WHEN send_chunked() is called
+    THEN assert SMTPRecipientsRefused is raised with all of them
+    """
+    def deliver(chunk):
+        raise SMTPRecipientsRefused({r: (550, b'no') for r in chunk})
+
+    with pytest.raises(SMTPRecipientsRefused) as e:
+        send_chunked(deliver, RECIPIENTS, limit=100, workers=3)
+    assert len(e.value.recipients) == 250
+
+
+def test_send_chunked_lazy():
+    """
+    GIVEN a generator of recipients
+    WHEN send_chunked() is called
+    THEN assert it is read one chunk at a time, as transactions are sent
+    """
+    read = []
+
+    def recipients():
+        for r in RECIPIENTS:
+            read.append(r)
+            yield r
+
+    def deliver(chunk):
+        assert len(read) == sum(sizes) + len(chunk)
+        sizes.append(len(chunk))
+        return {}
+
+    sizes = []
+    assert send_chunked(deliver, recipients(), limit=100) == {}
+    assert sizes == [100, 100, 50]
+
+
+def test_send_chunked_parallel():
+    """
+    GIVEN several workers
+    WHEN send_chunked() is called
+    THEN assert the chunks are delivered from separate threads
+    """
+    barrier = threading.Barrier(3, timeout=5)
+    threads = set()
+
+    def deliver(chunk):
+        barrier.wait()
+        threads.add(threading.get_ident())
+        return {}
+
+    assert send_chunked(deliver, RECIPIENTS, limit=100, workers=3) == {}
+    assert len(threads) == 3
+
+
+##############################################################################
+# TESTS: MXResolver & send_mx
+##############################################################################
+
+MX_RECORDS = {
+    'there.com': ([(20, 'mx2.there.com'), (10, 'mx1.there.com')], 60),
+    'else.org': ([(10, 'mx.else.org')], 60),
+}
+
+
+def fake_resolver(domain):
+    """Stand-in resolver for tests, without DNS."""
+    if domain not in MX_RECORDS:
+        raise LookupError('Domain does not exist: ' + domain)
+    return MX_RECORDS[domain]
+
+
+def test_mx_resolver_cache(mocker):
+    """
+    GIVEN an MXResolver with a stand-in resolver
+    WHEN hosts() is called repeatedly
+    THEN assert hosts are sorted by preference and cached for their TTL
+    """
+    resolver = MagicMock(side_effect=fake_resolver)
+    mx = MXResolver(resolver)
+    assert mx.hosts('There.com') == ['mx1.there.com', 'mx2.there.com']
+    assert mx.hosts('there.com') == ['mx1.there.com', 'mx2.there.com']
+    assert resolver.call_count == 1
+    mocker.patch('time.monotonic', return_value=time.monotonic() + 61)
+    mx.hosts('there.com')
+    assert resolver.call_count == 2
+
+
+def test_mx_resolver_negative_cache():
+    """
+    GIVEN a domain that does not resolve
+    WHEN hosts() is called repeatedly
+    THEN assert LookupError is raised, and cached for negative_ttl
+    """
+    resolver = MagicMock(side_effect=fake_resolver)
+    mx = MXResolver(resolver, negative_ttl=60)
+    for _ in range(2):
+        with pytest.raises(LookupError):
+            mx.hosts('nowhere.net')
+    assert resolver.call_count == 1
+    with pytest.raises(TypeError):
+        mx.configure(ttl=5)
+
+
+def test_send_mx():
+    """
+    GIVEN recipients at several domains
+    WHEN send_mx() is called
+    THEN assert one transaction per domain chunk to its preferred MX, and
+        recipients of an unknown domain are refused
+    """
+    deliver = MagicMock(return_value={})
+    recipients = ['a@there.com', 'b@else.org', 'c@There.com', 'd@nowhere.net']
+    refused = send_mx(deliver, recipients, MXResolver(fake_resolver), limit=1)
+    calls = sorted(c[0] for c in deliver.call_args_list)
+    assert calls == [('mx.else.org', ['b@else.org']),
+                     ('mx1.there.com', ['a@there.com']),
+                     ('mx1.there.com', ['c@There.com'])]
+    assert list(refused) == ['d@nowhere.net']
+    assert refused['d@nowhere.net'][0] == 550
+
+
+def test_send_mx_fallback():
+    """
+    GIVEN a preferred MX host that cannot be reached
+    WHEN send_mx() is called
+    THEN assert the next host is tried, and if every host fails, the
+        recipients are refused with a temporary error
+    """
+    def deliver(host, chunk):
+        if host != 'mx2.there.com':
+            raise ConnectionRefusedError('refused')
+        return {}
+
+    resolver = MXResolver(fake_resolver)
+    assert send_mx(deliver, ['a@there.com', 'b@else.org'], resolver) == {
+        'b@else.org': (451, b'refused')}
+    with pytest.raises(SMTPRecipientsRefused):
+        send_mx(deliver, ['b@else.org'], resolver)
+
+
+def test_send_mx_per_domain():
+    """
+    GIVEN many chunks for one domain and a per-domain cap
+    WHEN send_mx() is called with more workers than the cap
+    THEN assert no more than per_domain transactions are in flight at once
+    """
+    lock, state = threading.Lock(), {'now': 0, 'max': 0}
+
+    def deliver(host, chunk):
+        with lock:
+            state['now'] += 1
+            state['max'] = max(state['max'], state['now'])
+        time.sleep(0.02)
+        with lock:
+            state['now'] -= 1
+        return {}
+
+    recipients = ['u{}@there.com'.format(i) for i in range(8)]
+    send_mx(deliver, recipients, MXResolver(fake_resolver), limit=1,
+            workers=8, per_domain=2)
+    assert state['max'] == 2
+
+
+##############################################################################
+# TESTS: ServerProfileCache & probe
+##############################################################################
+
+def new_profile(port=587, checked=None):
+    """Return a ServerProfile of smtp.here.com."""
+    return ServerProfile('smtp.here.com', port, 'starttls', ['PLAIN'], True,
+                         1000, True, checked or time.time())
+
+
+def test_profile_cache_disk(tmp_path):
+    """
+    GIVEN a ServerProfileCache with a path
+    WHEN a profile is put
+    THEN assert another cache on the same path reads it back until it expires
+    """
+    path = str(tmp_path.joinpath('profiles.json'))
+    ServerProfileCache(path=path).put(new_profile())
+    cache = ServerProfileCache(path=path)
+    assert cache.get('smtp.here.com') == new_profile()._replace(
+        checked=cache.get('smtp.here.com').checked)
+    assert cache.get('smtp.here.com', 587).port == 587
+    assert cache.get('smtp.here.com', 465) is None
+    cache.configure(ttl=0)
+    assert cache.get('smtp.here.com') is None
+    cache.clear()
+    assert not tmp_path.joinpath('profiles.json').exists()
+
+
+def test_profile_cache_disk_reads(tmp_path, mocker):
+    """
+    GIVEN a ServerProfileCache with a path
+    WHEN unknown servers are looked up many times
+    THEN assert the JSON file is read once per ttl, and never with disk=False
+    """
+    path = str(tmp_path.joinpath('profiles.json'))
+    ServerProfileCache(path=path).put(new_profile())
+    cache = ServerProfileCache(path=path)
+    load_spy = mocker.spy(cache, '_load')
+    assert cache.get('smtp.there.com', disk=False) is None
+    assert load_spy.call_count == 0
+    for _ in range(1000):
+        assert cache.get('smtp.there.com') is None
+    assert cache.get('smtp.here.com').port == 587
+    assert load_spy.call_count == 1
+    cache.configure(path=path)
+    cache.get('smtp.there.com')
+    assert load_spy.call_count == 2
+
+
+def test_profile_cache_discover(mocker):
+    """
+    GIVEN an empty ServerProfileCache
+    WHEN discover() is called twice
+    THEN assert ports are probed in order the first time only
+    """
+    probe_mock = mocker.patch.object(messages._smtp, 'probe',
+                                     side_effect=[None, new_profile()])
+    cache = ServerProfileCache()
+    assert cache.discover('smtp.here.com').port == 587
+    assert cache.discover('smtp.here.com').port == 587
+    assert [c[0][1] for c in probe_mock.call_args_list] == [465, 587]
+
+
+def test_probe_starttls(mocker):
+    """
+    GIVEN a server on port 25 offering STARTTLS
+    WHEN probe() is called
+    THEN assert the session is upgraded and its capabilities recorded
+    """
+    smtp_mock = mocker.patch('smtplib.SMTP')
+    session = smtp_mock.return_value
+    session.has_extn.side_effect = lambda name: name in ('starttls', '8bitmime')
+    session.esmtp_features = {'auth': 'PLAIN LOGIN', 'size': '2048'}
+    profile = probe('smtp.here.com', 25)
+    assert session.starttls.call_count == 1
+    assert profile[:7] == ('smtp.here.com', 25, 'starttls', ['PLAIN', 'LOGIN'],
+                           False, 2048, True)
+    assert session.quit.call_count == 1
+
+
+def test_probe_unreachable(mocker):
+    """
+    GIVEN a port nobody listens on
+    WHEN probe() is called
+    THEN assert None is returned
+    """
+    mocker.patch('smtplib.SMTP_SSL', side_effect=ConnectionRefusedError())
+    assert probe('smtp.here.com', 465) is None
+
+
+##############################################################################
+# TESTS: TransportSettings & SendmailCommand
+##############################################################################
+
+def test_transport_settings_configure():
+    """
+    GIVEN a TransportSettings instance
+    WHEN configure() is called
+    THEN assert known settings are updated and others rejected
+    """
+    settings = TransportSettings()
+    settings.configure(default='local', local=('mta', 2525))
+    assert settings.default == 'local'
+    assert settings.local == ('mta', 2525)
+    with pytest.raises(TypeError):
+        settings.configure(port=25)
+    with pytest.raises(ValueError):
+        settings.configure(default='pigeon')
+    settings.configure(default='mx', mx_per_domain=4)
+    assert settings.mx_per_domain == 4
+
+
+def test_sendmail_command(mocker):
+    """
+    GIVEN a SendmailCommand
+    WHEN sendmail() is called with CRLF chunks split inside a line ending
+    THEN assert the envelope is passed as arguments and LF endings piped
+    """
+    popen_mock = mocker.patch('subprocess.Popen')
+    proc = popen_mock.return_value
+    proc.wait.return_value = 0
+    command = SendmailCommand(['/usr/sbin/sendmail', '-i'])
+    refused = sendmail(command, 'me@here.com', ['a@there.com', 'b@there.com'],
+                       iter([b'a\r', b'\nb\r\n']))
+    assert refused == {}
+    assert popen_mock.call_args[0][0] == [
+        '/usr/sbin/sendmail', '-i', '-f', 'me@here.com', '--',
+        'a@there.com', 'b@there.com']
+    written = b''.join(c[0][0] for c in proc.stdin.write.call_args_list)
+    assert written == b'a\nb\n'
+
+
+def test_sendmail_command_fails(mocker):
+    """
+    GIVEN a sendmail binary that exits with an error
+    WHEN SendmailCommand.sendmail() is called
+    THEN assert SMTPDataError is raised with its exit code
+    """
+    proc = mocker.patch('subprocess.Popen').return_value
+    proc.wait.return_value = 75
+    with pytest.raises(SMTPDataError) as e:
+        SendmailCommand(['sendmail']).sendmail('me@here.com', 'a@there.com',
+                                               b'msg')
+    assert e.value.smtp_code == 75
@@ -240,6 +240,21 @@ def test_tgram_send_attachmentStr(get_tgram, mocker, capsys):
     assert 'Message sent.' in out
 
 
+def test_tgram_send_lean(get_tgram, mocker, capsys):
+    """
+    GIVEN a TelegramBot instance with lean=True
+    WHEN send() is called
+    THEN assert the message and attachments are sent, then the built
+        message is dropped
+    """
+    send_cont_mock = mocker.patch.object(TelegramBot, '_send_content')
+    t = get_tgram
+    t.lean = True
+    t.send()
+    assert send_cont_mock.call_count == 3
+    assert t.message == {}
+
+
 ##############################################################################
 # TESTS: TelegramBot._send_content_async
 ##############################################################################
@@ -2,6 +2,7 @@
 
 import builtins
 import re
+import sys
 
 import pytest
 
@@ -10,6 +11,8 @@ from messages._utils import credential_property
 from messages._utils import validate_property
 from messages._utils import validate_input
 from messages._utils import check_valid
+from messages._utils import deep_sizeof
+from messages._utils import iter_valid
 from messages._utils import validate_email
 from messages._utils import validate_twilio
 from messages._utils import validate_slackwebhook
@@ -226,6 +229,35 @@ def test_check_valid_list_raisesExc(get_test_class):
             check_valid('TestClass', key, value, val_test_func, 'required_type')
 
 
+def test_check_valid_iterator():
+    """
+    GIVEN an iterator of inputs
+    WHEN check_valid is called
+    THEN assert it is not consumed, and iter_valid validates its items lazily
+    """
+    values = iter(['GOOD', 'BAD', 'NEVER READ'])
+    check_valid('TestClass', 'attr', values, val_test_func, 'required type')
+    checked = iter_valid('TestClass', 'attr', values, val_test_func, 'type')
+    assert next(checked) == 'GOOD'
+    with pytest.raises(InvalidMessageInputError):
+        next(checked)
+    assert next(values) == 'NEVER READ'
+
+
+def test_iter_valid_rejected():
+    """
+    GIVEN an iterator of inputs and a rejected list
+    WHEN iter_valid is called
+    THEN assert invalid items are skipped and appended to rejected
+    """
+    rejected = []
+    values = iter(['GOOD', 'BAD', 'GOOD'])
+    checked = iter_valid('TestClass', 'attr', values, val_test_func, 'type',
+                         rejected)
+    assert list(checked) == ['GOOD', 'GOOD']
+    assert rejected == ['BAD']
+
+
 ##############################################################################
 # TEST: timestamp
 ##############################################################################
@@ -240,3 +272,21 @@ def test_timestamp():
     #r = '^\d{4}-[A-Za-z]{3}-\d{1,2}\s{1}\d{2}:\d{2}:\d{2}$'
     #assert re.match(r, t)
     assert isinstance(t, str)
+
+
+##############################################################################
+# TEST: deep_sizeof
+##############################################################################
+
+def test_deep_sizeof():
+    """
+    GIVEN objects nesting containers and instances
+    WHEN deep_sizeof() is called
+    THEN assert everything reachable is counted, shared objects only once
+    """
+    data = b'x' * 10000
+    assert deep_sizeof(data) == sys.getsizeof(data)
+    assert deep_sizeof([data, data]) == sys.getsizeof([data, data]) + sys.getsizeof(data)
+    t = DummyClass('s3cr3t', {'key': [data]})
+    assert deep_sizeof(t) > len(data)
+    assert deep_sizeof(DummyClass) == 0